@@ -0,0 +1,59 @@
+"""
+Measures what each blob codec costs on stored images: write (encode) and read (decode) CPU time
+and the resulting size.
+
+    python benchmarks/blob_codecs.py path/to/sdxl_pngs/    # a folder of generated PNGs
+    python benchmarks/blob_codecs.py                       # every image in IMDB_PATH
+
+"zlib" is what every blob paid before codecs existed; "policy" is what write_v2 picks now.
+"""
+import os
+import sys
+import time
+import zlib
+
+from imagineit_app import imdb
+from imagineit_app.imdb import BLOB_RAW, BLOB_ZLIB, BLOB_ZSTD, _encode_blob_v2, _decode_blob_v2
+
+def load_corpus(path: str=None) -> list[bytes]:
+    if path is None:
+        return [bytes(imdb.read_img_v2(identity)) for identity in imdb.read_metadata_v2(["identity"])['identity'].tolist()]
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(".png"):
+            with open(os.path.join(path, name), "rb") as f:
+                corpus.append(f.read())
+    return corpus
+
+def encoders() -> dict:
+    codecs = {
+        "zlib": lambda img: (zlib.compress(img), BLOB_ZLIB),
+        "raw": lambda img: (img, BLOB_RAW),
+        "policy": _encode_blob_v2,
+    }
+    if imdb.zstandard is not None:
+        compressor = imdb.zstandard.ZstdCompressor(level=3)
+        codecs["zstd"] = lambda img: (compressor.compress(img), BLOB_ZSTD)
+    return codecs
+
+def main():
+    corpus = load_corpus(sys.argv[1] if len(sys.argv) > 1 else None)
+    if not corpus:
+        print("no images found")
+        return
+    original = sum(len(img) for img in corpus)
+    print(f"images: {len(corpus)}   total {original / 2**20:.1f} MiB")
+    print(f"{'codec':>8} {'stored MiB':>11} {'ratio':>7} {'write ms/img':>13} {'read ms/img':>12}")
+    for name, encode in encoders().items():
+        start = time.process_time()
+        blobs = [encode(img) for img in corpus]
+        write_seconds = time.process_time() - start
+        start = time.process_time()
+        for blob, codec in blobs:
+            _decode_blob_v2(memoryview(blob), codec)
+        read_seconds = time.process_time() - start
+        stored = sum(len(blob) for blob, _ in blobs)
+        print(f"{name:>8} {stored / 2**20:11.2f} {stored / original:7.3f} {write_seconds * 1000 / len(corpus):13.2f} {read_seconds * 1000 / len(corpus):12.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Measures decode + downscale CPU time of each downscale tier, per thumbnail level, on synthetic
+images of SDXL-like sizes stored as PNG and as JPEG (where the fast tier decodes through draft()).
+
+    python benchmarks/downscale.py              # 1024, 1536 and 2048 pixel squares
+    python benchmarks/downscale.py 1024 4096    # other sizes
+
+"best" is what every thumbnail cost before tiers existed. "diff" is the mean absolute pixel
+difference against it, 0-255.
+"""
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from imagineit_app.thumbnails import render_pyramid, DOWNSCALE_TIERS, THUMBNAIL_LEVELS
+
+ROUNDS = 5
+
+def synthetic_image(side: int, format: str) -> bytes:
+    # smooth gradients with noise on top, so both the filters and the PNG encoder have work to do
+    y, x = np.mgrid[0:side, 0:side] / side
+    rng = np.random.default_rng(side)
+    pixels = np.stack([x, y, (x + y) / 2], axis=-1) * 200 + rng.normal(0, 12, (side, side, 3))
+    buf = BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8), "RGB").save(buf, format=format)
+    return buf.getvalue()
+
+def timed(img: bytes, level: int, tier: str) -> tuple:
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        _, _, png = render_pyramid(img, [level], tier)[level]
+    return (time.process_time() - start) * 1000 / ROUNDS, np.asarray(Image.open(BytesIO(png)), dtype=np.int16)
+
+def main():
+    sides = [int(side) for side in sys.argv[1:]] or [1024, 1536, 2048]
+    print(f"{'source':>10} {'level':>5} " + " ".join(f"{tier + ' ms':>12} {'diff':>5}" for tier in DOWNSCALE_TIERS))
+    for side in sides:
+        for format in ("PNG", "JPEG"):
+            img = synthetic_image(side, format)
+            for level in THUMBNAIL_LEVELS:
+                results = {tier: timed(img, level, tier) for tier in DOWNSCALE_TIERS}
+                reference = results["best"][1]
+                cells = " ".join(f"{ms:12.2f} {np.abs(pixels - reference).mean():5.2f}" for ms, pixels in results.values())
+                print(f"{f'{side} {format}':>10} {level:>5} {cells}")
+
+if __name__ == "__main__":
+    main()
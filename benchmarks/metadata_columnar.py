@@ -0,0 +1,83 @@
+"""
+Compares the columnar metadata section against the zlib'd CSV blob it replaces.
+
+    python benchmarks/metadata_columnar.py [rows]
+
+Reports section size, load time and peak traced memory for a full load and for the
+identity/labeled projection used by the hash list endpoint.
+"""
+import os
+import sys
+import time
+import random
+import zlib
+import tracemalloc
+from io import BytesIO
+
+import pandas as pd
+
+from imagineit_app.imdb import _serialize_metadata_v2, _read_metadata_section_v2
+
+TAGS = [
+    "1girl", "solo", "looking at viewer", "smile", "long hair", "short hair", "blue eyes", "outdoors",
+    "masterpiece", "best quality", "absurdres", "full body", "upper body", "night", "city", "flowers",
+    "school uniform", "hat", "holding", "sky", "cloud", "water", "sitting", "standing", "from above",
+]
+NEGATIVE = "lowres,bad anatomy,bad hands,text,error,missing finger,extra digits,fewer digits,cropped,worst quality,low quality"
+
+def build_metadata(rows: int) -> pd.DataFrame:
+    random.seed(0)
+    records = []
+    for _ in range(rows):
+        prompt = ",".join(random.sample(TAGS, random.randint(5, 15)))
+        records.append({
+            "seed": random.getrandbits(63),
+            "prompt": prompt,
+            "negative_prompt": NEGATIVE,
+            "width": 1024,
+            "height": 1024,
+            "steps": 28,
+            "guidance_scale": 5.0,
+            "labeled": random.random() < 0.3,
+            "label": prompt,
+            "identity": f"{os.urandom(16).hex()}${os.urandom(32).hex()}",
+        })
+    return pd.DataFrame(records)
+
+def load_csv(section: bytes, columns=None):
+    usecols = None if columns is None else (lambda name: name in columns)
+    return pd.read_csv(BytesIO(zlib.decompress(section)), usecols=usecols)
+
+def load_columnar(section: bytes, columns=None):
+    return _read_metadata_section_v2(BytesIO(section), 0, columns=columns)[0]
+
+def measure(load, section: bytes, columns, repeat: int=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load(section, columns)
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    load(section, columns)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    metadata_df = build_metadata(rows)
+    sections = {
+        "csv+zlib": (load_csv, zlib.compress(metadata_df.to_csv(index=False).encode('utf-8'))),
+        "columnar": (load_columnar, _serialize_metadata_v2(metadata_df)),
+    }
+    print(f"rows: {rows}")
+    for name, (_, section) in sections.items():
+        print(f"{name:>10} section size: {len(section) / 2**20:8.2f} MiB")
+    for label, columns in (("all columns", None), ("identity+labeled", ["identity", "labeled"])):
+        print(f"load {label}:")
+        for name, (load, section) in sections.items():
+            seconds, peak = measure(load, section, columns)
+            print(f"{name:>10} {seconds * 1000:9.1f} ms   peak {peak / 2**20:8.1f} MiB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Compares importing images one write_v2 call at a time against a single write_many call.
+
+    python benchmarks/write_many.py [images] [image KiB]
+
+Both runs write into fresh imdbs in a temporary directory; IMDB_PATH is not touched.
+"""
+import os
+import sys
+import time
+import tempfile
+import contextlib
+import io
+
+from imagineit_app import imdb
+
+def build_records(count: int, size: int) -> list:
+    return [
+        (b"\x89PNG\r\n\x1a\n" + os.urandom(size), {
+            "seed": i, "prompt": f"1girl,solo,tag{i % 50}", "negative_prompt": "lowres", "width": 1024,
+            "height": 1024, "steps": 28, "guidance_scale": 5.0,
+        })
+        for i in range(count)
+    ]
+
+def one_by_one(records: list):
+    for img, params in records:
+        imdb.write_v2(None, img, **params)
+    imdb.checkpoint_v2()
+
+def bulk(records: list):
+    imdb.write_many(records)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 64) * 1024
+    records = build_records(count, size)
+    print(f"images: {count} x {size // 1024} KiB")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, insert in (("write_v2", one_by_one), ("write_many", bulk)):
+            imdb.IMDB_PATH = os.path.join(tmp, f"{name}.imdb")
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                insert(records)
+            seconds = time.perf_counter() - start
+            print(f"{name:>10} {seconds:8.2f} s   {count / seconds:8.1f} images/s")
+
+if __name__ == "__main__":
+    main()
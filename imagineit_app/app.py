@@ -1,19 +1,19 @@
 
 import os
 import time
-from io import BytesIO
 from pathlib import Path
 import zipfile
-from PIL import Image
 import json
 
-from fastapi import FastAPI
-from fastapi.responses import Response, StreamingResponse
+from fastapi import FastAPI, Header, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 # from imagineit_app.dataio import save_img, load_img_metadata, load_img
-from imagineit_app.imdb import write_v2, read_img_v2, read_metadata_v2, del_img_v2, read_mapper_v2
+from imagineit_app.imdb import write_v2, read_imgs_v2, read_metadata_v2, del_img_v2, read_mapper_v2, select_tags_v2, tag_counts_v2
 from imagineit_app.resources import register_resources
+from imagineit_app.resources.image import image_response
+from imagineit_app.thumbnails import MAX_THUMBNAIL_LEVEL
 
 try:
     from imagineit_app.inference import MODEL
@@ -42,17 +42,13 @@ def get_unlabeled_image(include_filter_prompt: str=None, include_filter_negative
     """
     Get a list of unlabeled images with optional filtering by prompt and negative prompt
     """
-    metadata_df = read_metadata_v2()
+    metadata_df = read_metadata_v2(["identity", "labeled"])
     if metadata_df is None:
         return {"error": "No images found."}
-    if include_filter_prompt:
-        metadata_df = metadata_df[metadata_df['prompt'].str.split(',').apply(lambda x: any(item in x for item in include_filter_prompt.split(',')))]
-    if include_filter_negative_prompt:
-        metadata_df = metadata_df[metadata_df['negative_prompt'].str.split(',').apply(lambda x: any(item in x for item in include_filter_negative_prompt.split(',')))]
-    if exclude_filter_prompt:
-        metadata_df = metadata_df[~metadata_df['prompt'].str.split(',').apply(lambda x: any(item in x for item in exclude_filter_prompt.split(',')))]
-    if exclude_filter_negative_prompt:
-        metadata_df = metadata_df[~metadata_df['negative_prompt'].str.split(',').apply(lambda x: any(item in x for item in exclude_filter_negative_prompt.split(',')))]
+    include = {field: value.split(',') for field, value in (("prompt", include_filter_prompt), ("negative_prompt", include_filter_negative_prompt)) if value}
+    exclude = {field: value.split(',') for field, value in (("prompt", exclude_filter_prompt), ("negative_prompt", exclude_filter_negative_prompt)) if value}
+    if include or exclude:
+        metadata_df = metadata_df[metadata_df['identity'].isin(select_tags_v2(include, exclude))]
     if labeled is not None:
         metadata_df = metadata_df[metadata_df['labeled'] == labeled]
     return metadata_df["identity"].tolist()
@@ -63,19 +59,16 @@ def get_unlabeled_image(include_filter_prompt: str=None, include_filter_negative
 # Image
 ###
 @app.get("/api/v1/{hash}/image")
-def get_image_small(hash: str, level: int):
+async def get_image_small(hash: str, level: int=Query(ge=0, le=MAX_THUMBNAIL_LEVEL), format: str=None, quality: int=Query(None, ge=1, le=100), accept: str=Header(None), if_none_match: str=Header(None), range: str=Header(None), if_range: str=Header(None), tier: str=None):
     """
-    Get a small version of an image by its hash
+    Get a small version of an image by its hash, in the format asked for or negotiated by Accept
+    and scaled by the downscale tier (fast, balanced or best). Level 0 is the stored image itself
+    and supports Range requests
     """
-    image = read_img_v2(hash)
-    if image is None:
+    response = await image_response(hash, level, format, quality, accept, if_none_match, range, if_range, tier)
+    if response is None:
         return {"error": "Image not found."}
-    image = Image.open(BytesIO(image))
-    small_image = image.resize((image.width // (2 ** level), image.height // (2 ** level)), resample=Image.Resampling.LANCZOS)
-    buf = BytesIO()
-    small_image.save(buf, format="PNG")
-    buf.seek(0)
-    return Response(content=buf.read(), media_type="image/png")
+    return response
 
 @app.delete("/api/v1/{hash}/image")
 def delete_image(hash: str):
@@ -97,7 +90,7 @@ def post_image(width: int, height: int, image: ImagePayload):
 
 @app.get("/api/v1/{hash}/prompt")
 def get_prompt(hash: str):
-    metadata_df = read_metadata_v2()
+    metadata_df = read_metadata_v2(["identity", "prompt"])
     if metadata_df is None:
         return {"error": "No images found."}
     prompt = metadata_df.loc[metadata_df['identity'] == hash, 'prompt']
@@ -107,7 +100,7 @@ def get_prompt(hash: str):
 
 @app.get("/api/v1/{hash}/label")
 def get_label(hash: str):
-    metadata_df = read_metadata_v2()
+    metadata_df = read_metadata_v2(["identity", "label"])
     if metadata_df is None:
         return {"error": "No images found."}
     label = metadata_df.loc[metadata_df['identity'] == hash, 'label']
@@ -126,49 +119,78 @@ class ZipFilePayload(BaseModel):
     img_hashes: list[str]
     return_file: bool
 
-@app.post("/api/v1/zipfile")
-def create_zipfile(zip_info: ZipFilePayload):
-    # Create a zip file containing the specified images
-    file_structure = []
+class _ZipChunks:
+    """
+    Write-only stream the archive is written into, handed out chunk by chunk. Having no tell()
+    makes zipfile write it as an unseekable stream, with sizes after each entry.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> list:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def _zip_entries(zip_info: ZipFilePayload):
+    """
+    Yields (name, content) of the archive members as they are read from the imdb.
+    """
+    image_folder = Path("train_data") if zip_info.is_train_data else Path("images")
     if zip_info.is_train_data:
-        metadata_df = read_metadata_v2()
+        metadata_df = read_metadata_v2(["identity", "labeled", "label"])
         metadata_df = metadata_df[metadata_df['identity'].isin(zip_info.img_hashes)]
-    for identity_hash in zip_info.img_hashes:
-        image_folder = Path("images")
-        img = read_img_v2(identity_hash)
+        labels = dict(zip(metadata_df['identity'], zip(metadata_df['labeled'], metadata_df['label'])))
+    for identity_hash, img in read_imgs_v2(zip_info.img_hashes):
         if img is None:
             continue
         if zip_info.is_train_data:
-            image_folder = Path("train_data")
-            if metadata_df.loc[metadata_df['identity'] == identity_hash, "labeled"].item() is False:
+            labeled, text_content = labels[identity_hash]
+            if not labeled:
                 continue
-            text_content: str = metadata_df.loc[metadata_df['identity'] == identity_hash, "label"].item()
-            file_structure.append((f"{identity_hash}.txt", BytesIO(text_content.encode('utf-8'))))
-            file_structure.append((f"{identity_hash}.png", BytesIO(img)))
-        else:
-            file_structure.append((f"{identity_hash}.png", BytesIO(img)))
-    zipped_file = BytesIO()
-    with zipfile.ZipFile(zipped_file, 'w') as zipf:
-        for file_name, file_data in file_structure:
-            path = image_folder / file_name
-            zipf.writestr(str(path), file_data.getvalue())
-    return_json = {
-        "status": "success",
-    }
+            yield str(image_folder / f"{identity_hash}.txt"), text_content.encode('utf-8')
+        yield str(image_folder / f"{identity_hash}.png"), img
+
+def _stream_zip(zip_info: ZipFilePayload):
+    # PNGs are compressed already, entries are stored as is
+    out = _ZipChunks()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for name, content in _zip_entries(zip_info):
+            zipf.writestr(name, content)
+            yield from out.take()
+    yield from out.take()
+
+@app.post("/api/v1/zipfile")
+def create_zipfile(zip_info: ZipFilePayload):
+    """
+    Zip of the specified images, streamed back as application/zip with return_file, or else
+    written to zip_file_name.zip on the server. Entries are written as they are read, so memory
+    use stays flat however large the export
+    """
     if zip_info.return_file is True:
-        return_json["file"] = zipped_file.getvalue().hex()
-    else:
-        with open(zip_info.zip_file_name + ".zip", 'wb') as f:
-            f.write(zipped_file.getvalue())
-    return return_json
+        file_name = Path(zip_info.zip_file_name).name + ".zip"
+        headers = {"Content-Disposition": f'attachment; filename="{file_name}"'}
+        return StreamingResponse(_stream_zip(zip_info), media_type="application/zip", headers=headers)
+    with zipfile.ZipFile(zip_info.zip_file_name + ".zip", 'w', compression=zipfile.ZIP_STORED) as zipf:
+        for name, content in _zip_entries(zip_info):
+            zipf.writestr(name, content)
+    return {"status": "success"}
 
 @app.get("/api/v1/tags")
-def get_tags():
-    metadata_df = read_metadata_v2()
-    if metadata_df is None:
-        return {"error": "No images found."}
-    all_tags = set([tag.strip() for prompt in metadata_df["prompt"].astype(str).tolist() for tag in prompt.split(',')])
-    return all_tags
+def get_tags(counts: bool=False):
+    """
+    All prompt tags, or tag -> number of images with counts=true
+    """
+    tag_counts = tag_counts_v2("prompt")
+    if counts:
+        return tag_counts
+    return set(tag_counts)
 
 @app.get("/api/v1/imagine")
 def imagine(prompt: str, negative_prompt: str, width: int, height: int, num_inference_steps: int, guidance_scale: float, inference_size: int, seed: int=42):
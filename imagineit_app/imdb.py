@@ -7,11 +7,27 @@ import json
 import hashlib
 import hmac
 import threading
+import mmap
+import contextlib
+import time
+import bisect
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 IMDB_PATH = os.environ.get('IMDB_PATH', 'datav2.imdb')
-GLOBAL_DATABASE_THREAD_LOCK = threading.Lock()
+IDENTITY_FIELDS = ["seed", "prompt", "negative_prompt", "width", "height", "steps", "guidance_scale"]
+GLOBAL_DATABASE_THREAD_LOCK = threading.RLock()
 
 def metadata_size(f):
     f.seek(0)
@@ -133,194 +149,1074 @@ def add_img(img: bytes, seed: int, prompt: str, negative_prompt: str, width: int
         f.write(img)
     return hex_digest
 
-def write_v2(identity_hash: str, uncompressed_img: bytes=None, seed: int=None, prompt: str=None, negative_prompt: str=None, width: int=None, height: int=None, steps: int=None, guidance_scale: float=None, labeled: bool=None, label: str=None):
-    if not os.path.exists(IMDB_PATH):
-        with open(IMDB_PATH, "wb") as f:
-            empty_df_with_heads = pd.DataFrame(columns=["seed", "prompt", "negative_prompt", "width", "height", "steps", "guidance_scale", "labeled", "label", "identity"])
-            df_bytes = zlib.compress(empty_df_with_heads.to_csv(index=False).encode('utf-8'))
-            f.write(int.to_bytes(16, 8, "little", signed=False)) 
-            f.write(int.to_bytes(16, 8, "little", signed=False))
-            f.write(df_bytes)
-    with open(IMDB_PATH, "rb") as f:
-        mapper_loc = int.from_bytes(f.read(8), "little", signed=False)
-        metadata_loc = int.from_bytes(f.read(8), "little", signed=False)
-        f.seek(mapper_loc)
-        mapper_buff = BytesIO(f.read(metadata_loc - mapper_loc))
-        f.seek(metadata_loc)
-        metadata_bytes = BytesIO(zlib.decompress(f.read()))
+def _read_header_v2(f):
+    f.seek(0)
+    mapper_loc = int.from_bytes(f.read(8), "little", signed=False)
+    metadata_loc = int.from_bytes(f.read(8), "little", signed=False)
+    return mapper_loc, metadata_loc
+
+def _write_header_v2(f, mapper_loc: int, metadata_loc: int):
+    f.seek(0)
+    f.write(int.to_bytes(mapper_loc, 8, "little", signed=False))
+    f.write(int.to_bytes(metadata_loc, 8, "little", signed=False))
+
+###
+# Blob codecs
+#
+# The top byte of a mapper record's size field holds the codec of the blob. Records written
+# before codecs existed read as 0, which is zlib, the only codec used back then.
+###
+BLOB_ZLIB = 0
+BLOB_RAW = 1
+BLOB_ZSTD = 2
+BLOB_SIZE_MASK = (1 << 56) - 1
+# formats that are compressed already and never shrink enough to be worth another pass
+PRECOMPRESSED_SIGNATURES = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF8", b"\x00\x00\x00\x0cjXL ", b"\xff\x0a")
+BLOB_MIN_SAVING = 0.05
+
+def _encode_blob_v2(img: bytes):
+    """
+    Picks the codec for a new blob: already compressed images (PNG, JPEG, ...) are stored raw,
+    anything else is compressed with zstd (or zlib without zstandard installed) unless that saves
+    less than BLOB_MIN_SAVING.
+    """
+    if img.startswith(PRECOMPRESSED_SIGNATURES) or (img[:4] == b"RIFF" and img[8:12] == b"WEBP"):
+        return img, BLOB_RAW
+    if zstandard is not None:
+        blob, codec = zstandard.ZstdCompressor(level=3).compress(img), BLOB_ZSTD
+    else:
+        blob, codec = zlib.compress(img), BLOB_ZLIB
+    if len(blob) > len(img) * (1 - BLOB_MIN_SAVING):
+        return img, BLOB_RAW
+    return blob, codec
+
+def _decode_blob_v2(blob, codec: int):
+    if codec == BLOB_RAW:
+        return blob
+    if codec == BLOB_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Blob is zstd compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+def _parse_mapper_v2(mapper_bytes: bytes) -> dict:
     mapper = {}
-    for i in range(len(mapper_buff.getvalue()) // 64):
-        mapper_buff.seek(i * 64)
-        salt = bytes(mapper_buff.read(16)[::-1]).hex()
-        hash = bytes(mapper_buff.read(32)[::-1]).hex()
-        index = int.from_bytes(mapper_buff.read(8), "little", signed=False)
-        size = int.from_bytes(mapper_buff.read(8), "little", signed=False)
-        mapper[salt + "$" + hash] = (index, size)
-    metadata_df = pd.read_csv(metadata_bytes)
-    mapper_buff.close()
-    metadata_bytes.close()
-    target = None if identity_hash is None else (metadata_df['identity'] == identity_hash)
-    target_metadata = None if target is None else metadata_df[target]
-    if target_metadata is None:
-        if uncompressed_img is None or seed is None or prompt is None or negative_prompt is None or width is None or height is None or steps is None or guidance_scale is None:
-            raise ValueError("All parameters must be provided when adding new image")
-        target_metadata = pd.DataFrame([img_metadata_v2(seed, prompt, negative_prompt, width, height, steps, guidance_scale)])
-        identity_hash = target_metadata['identity'].iloc[0]
-        metadata_df = pd.concat([metadata_df, target_metadata], ignore_index=True)
-        target_img = zlib.compress(uncompressed_img)
-        mapper[identity_hash] = (mapper_loc, len(target_img))
-    elif target_metadata.shape[0] == 0:
-        raise ValueError("No metadata found for image hash", hash)
+    for base in range(0, len(mapper_bytes) - 63, 64):
+        salt = mapper_bytes[base:base + 16][::-1].hex()
+        hash = mapper_bytes[base + 16:base + 48][::-1].hex()
+        index = int.from_bytes(mapper_bytes[base + 48:base + 56], "little", signed=False)
+        size = int.from_bytes(mapper_bytes[base + 56:base + 64], "little", signed=False)
+        mapper[salt + "$" + hash] = (index, size & BLOB_SIZE_MASK, size >> 56)
+    return mapper
+
+def _serialize_mapper_v2(mapper: dict) -> bytes:
+    mapper_buffer = BytesIO()
+    for key, (index, size, codec) in mapper.items():
+        salt, hash = key.split("$")
+        mapper_buffer.write(int.to_bytes(int(salt, 16), 16, "little", signed=False))
+        mapper_buffer.write(int.to_bytes(int(hash, 16), 32, "little", signed=False))
+        mapper_buffer.write(int.to_bytes(index, 8, "little", signed=False))
+        mapper_buffer.write(int.to_bytes(size | (codec << 56), 8, "little", signed=False))
+    return mapper_buffer.getvalue()
+
+###
+# Columnar metadata
+#
+# Checkpoints store the metadata table column by column so readers can load only what they need:
+#   magic(4) | version(1) | column count(2) | row count(8) | section size(8)
+#   per column: name size(2) | name | type(1) | codec(1) | offset(8) | size(8)
+#   column data, offsets relative to the section start
+# Numeric columns are raw little-endian arrays. String columns are
+#   offsets(8 * (rows + 1)) | null mask(rows) | utf-8 heap
+# compressed with zlib. Sections written before this layout are a zlib'd CSV and are still read.
+###
+METADATA_MAGIC = b"IMCM"
+METADATA_HEADER = struct.Struct("<4sBHQQ")
+METADATA_COLUMN = struct.Struct("<BBQQ")
+COLUMN_INT64 = 0
+COLUMN_UINT64 = 1
+COLUMN_FLOAT64 = 2
+COLUMN_BOOL = 3
+COLUMN_STRING = 4
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+
+def _encode_column_v2(series: pd.Series):
+    nulls = series.isna().to_numpy()
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind == "boolean":
+        values = np.where(nulls, 2, series.where(~nulls, False).astype(bool).to_numpy())
+        return COLUMN_BOOL, CODEC_RAW, values.astype(np.uint8).tobytes()
+    if kind == "integer" and not nulls.any():
+        for column_type, dtype in ((COLUMN_INT64, "<i8"), (COLUMN_UINT64, "<u8")):
+            try:
+                return column_type, CODEC_RAW, np.array(series.tolist(), dtype=dtype).tobytes()
+            except OverflowError:
+                continue
+    if kind in ("integer", "floating", "mixed-integer-float", "decimal"):
+        try:
+            return COLUMN_FLOAT64, CODEC_RAW, series.astype("<f8").to_numpy().tobytes()
+        except (TypeError, ValueError, OverflowError):
+            pass
+    texts = [b"" if null else str(value).encode('utf-8') for value, null in zip(series.tolist(), nulls)]
+    offsets = np.zeros(len(texts) + 1, dtype="<u8")
+    np.cumsum([len(text) for text in texts], out=offsets[1:])
+    data = offsets.tobytes() + nulls.astype(np.uint8).tobytes() + b"".join(texts)
+    return COLUMN_STRING, CODEC_ZLIB, zlib.compress(data)
+
+def _decode_column_v2(column_type: int, data: bytes, rows: int):
+    if column_type == COLUMN_INT64:
+        return np.frombuffer(data, dtype="<i8", count=rows)
+    if column_type == COLUMN_UINT64:
+        return np.frombuffer(data, dtype="<u8", count=rows)
+    if column_type == COLUMN_FLOAT64:
+        return np.frombuffer(data, dtype="<f8", count=rows)
+    if column_type == COLUMN_BOOL:
+        values = np.frombuffer(data, dtype=np.uint8, count=rows)
+        if (values == 2).any():
+            return np.array([None if value == 2 else bool(value) for value in values.tolist()], dtype=object)
+        return values.astype(bool)
+    offsets = np.frombuffer(data, dtype="<u8", count=rows + 1).tolist()
+    nulls = np.frombuffer(data, dtype=np.uint8, count=rows, offset=8 * (rows + 1))
+    heap = data[9 * rows + 8:]
+    text = heap.decode('utf-8')
+    if len(text) == len(heap):
+        # ascii only: byte offsets are character offsets, slice the decoded heap directly
+        values = [text[offsets[i]:offsets[i + 1]] for i in range(rows)]
     else:
-        if seed is not None:
-            metadata_df.loc[target, 'seed'] = seed
-        if prompt is not None:
-            metadata_df.loc[target, 'prompt'] = prompt
-        if negative_prompt is not None:
-            metadata_df.loc[target, 'negative_prompt'] = negative_prompt
-        if width is not None:
-            metadata_df.loc[target, 'width'] = width
-        if height is not None:
-            metadata_df.loc[target, 'height'] = height
-        if steps is not None:
-            metadata_df.loc[target, 'steps'] = steps
-        if guidance_scale is not None:
-            metadata_df.loc[target, 'guidance_scale'] = guidance_scale
-        new_metadata = img_metadata_v2(**metadata_df.loc[target, ['seed', 'prompt', 'negative_prompt', 'width', 'height', 'steps', 'guidance_scale']].iloc[0].to_dict())
-        if not identity_hash_validation_v2(identity_hash.split('$')[1], new_metadata['identity']):
-            mapper[new_metadata['identity']] = mapper.pop(target_metadata['identity'].iloc[0])
-            metadata_df.loc[target, 'identity'] = new_metadata['identity']
-        if labeled is not None:
-            metadata_df.loc[target, 'labeled'] = labeled
-        if label is not None:
-            metadata_df.loc[target, 'label'] = label
-        # TODO mapper update (Done)
-        target_img = None
-        if uncompressed_img is not None:
-            target_img = zlib.compress(uncompressed_img)
-            mapper[new_metadata['identity']] = (mapper[new_metadata['identity']][0], len(target_img))
-    new_mapper_loc = mapper_loc
-    new_metadata_loc = metadata_loc
-    with open(IMDB_PATH, "r+b") as f:
-        if target_img is not None:
-            f.seek(mapper_loc)
-            f.write(target_img)
-            new_mapper_loc = mapper_loc + len(target_img)
-            new_metadata_loc = metadata_loc + len(target_img)
-        mapper_buffer = BytesIO()
-        for key, (index, size) in mapper.items():
-            salt, hash = key.split("$")
-            mapper_buffer.write(int.to_bytes(int(salt, 16), 16, "little", signed=False))
-            mapper_buffer.write(int.to_bytes(int(hash, 16), 32, "little", signed=False))
-            mapper_buffer.write(int.to_bytes(index, 8, "little", signed=False))
-            mapper_buffer.write(int.to_bytes(size, 8, "little", signed=False))
-        mapper_bytes = mapper_buffer.getvalue()
-        mapper_buffer.close()
-        f.seek(new_mapper_loc)
-        f.write(mapper_bytes)
-        exceeded_bytes = len(mapper_bytes) - (new_metadata_loc - new_mapper_loc)
-        if exceeded_bytes > 0:
-            new_metadata_loc += exceeded_bytes
-        f.seek(new_metadata_loc)
-        f.write(zlib.compress(metadata_df.to_csv(index=False).encode('utf-8')))
-        f.seek(0)
-        f.write(int.to_bytes(new_mapper_loc, 8, "little", signed=False))
-        f.write(int.to_bytes(new_metadata_loc, 8, "little", signed=False))
-    return identity_hash
+        values = [heap[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(rows)]
+    values = np.array(values, dtype=object)
+    values[nulls.astype(bool)] = None
+    return values
+
+def _serialize_metadata_v2(metadata_df: pd.DataFrame) -> bytes:
+    encoded = [(str(name).encode('utf-8'), *_encode_column_v2(metadata_df[name])) for name in metadata_df.columns]
+    offset = METADATA_HEADER.size + sum(2 + len(name) + METADATA_COLUMN.size for name, _, _, _ in encoded)
+    directory = BytesIO()
+    for name, column_type, codec, data in encoded:
+        directory.write(struct.pack("<H", len(name)))
+        directory.write(name)
+        directory.write(METADATA_COLUMN.pack(column_type, codec, offset, len(data)))
+        offset += len(data)
+    header = METADATA_HEADER.pack(METADATA_MAGIC, 1, len(encoded), metadata_df.shape[0], offset)
+    return header + directory.getvalue() + b"".join(data for _, _, _, data in encoded)
+
+def _read_metadata_section_v2(f, metadata_loc: int, parse: bool=True, columns: list[str]=None):
+    """
+    Reads the metadata section at metadata_loc, restricted to columns when given, and returns
+    it together with the section's end offset, which is where the log starts.
+    """
+    f.seek(metadata_loc)
+    header = f.read(METADATA_HEADER.size)
+    if header[:4] != METADATA_MAGIC:
+        return _read_csv_metadata_section_v2(f, metadata_loc, parse, columns)
+    _, _, column_count, rows, section_size = METADATA_HEADER.unpack(header)
+    if not parse:
+        return None, metadata_loc + section_size
+    directory = []
+    for _ in range(column_count):
+        name = f.read(struct.unpack("<H", f.read(2))[0]).decode('utf-8')
+        directory.append((name, *METADATA_COLUMN.unpack(f.read(METADATA_COLUMN.size))))
+    data = {}
+    for name, column_type, codec, offset, size in directory:
+        if columns is not None and name not in columns:
+            continue
+        f.seek(metadata_loc + offset)
+        column_bytes = f.read(size)
+        if codec == CODEC_ZLIB:
+            column_bytes = zlib.decompress(column_bytes)
+        data[name] = _decode_column_v2(column_type, column_bytes, rows)
+    return pd.DataFrame(data, index=pd.RangeIndex(rows)), metadata_loc + section_size
+
+def _read_csv_metadata_section_v2(f, metadata_loc: int, parse: bool, columns: list[str]):
+    """
+    Pre-columnar sections are a zlib'd CSV that does not record its own size. Decompress in
+    chunks until the zlib stream ends to find where the log starts.
+    """
+    f.seek(metadata_loc)
+    decompressor = zlib.decompressobj()
+    csv = BytesIO()
+    consumed = 0
+    while not decompressor.eof:
+        chunk = f.read(1 << 16)
+        if chunk == b'':
+            break
+        consumed += len(chunk)
+        data = decompressor.decompress(chunk)
+        if parse:
+            csv.write(data)
+    end = metadata_loc + consumed - len(decompressor.unused_data)
+    if not parse:
+        return None, end
+    csv.seek(0)
+    return pd.read_csv(csv, usecols=None if columns is None else (lambda name: name in columns)), end
+
+###
+# Append-only log
+#
+# Everything after the checkpointed metadata section is a sequence of log records:
+#   magic(2) | kind(1) | meta size(4) | blob size(8) | crc32(4) | meta (json) | blob
+# The crc covers kind, sizes and meta so a torn or foreign tail is detected and ignored.
+# Blobs stay where they were appended; a checkpoint only writes a fresh mapper and
+# metadata section behind the log and repoints the header at it. Records appended while the
+# checkpoint was built follow it as its log, referencing their blobs in place. Superseded
+# checkpoints are dead bytes until vacuum_v2, which the compactor runs past AUTO_VACUUM_RATIO.
+#
+# LOG_INSERT meta is the new metadata row plus the blob's "codec", blob the encoded image.
+# LOG_UPDATE meta is {"identity", "values", "rekey"?, "codec"?}: values overlay the row, rekey
+# renames the identity, and a non-empty blob replaces the stored image.
+# A missing "codec" means zlib, as for mapper records.
+# LOG_DELETE meta is {"identity"}: a tombstone, the blob stays in place until vacuum_v2.
+###
+LOG_RECORD_MAGIC = b"IL"
+LOG_RECORD_HEADER = struct.Struct("<2sBIQI")
+LOG_INSERT = 1
+LOG_UPDATE = 2
+LOG_DELETE = 3
+LOG_CHECKPOINT_MIN_RECORDS = 1024
+LOG_CHECKPOINT_RATIO = 0.125
+# share of dead bytes (superseded checkpoints, deleted blobs) at which the compactor vacuums a file
+AUTO_VACUUM_RATIO = 0.5
+# a checkpoint or vacuum keeps carrying over new records without the write lock until fewer are left
+CATCH_UP_RECORDS = 64
+CATCH_UP_ROUNDS = 8
+_IDENTITY_INDEXES = {}
+_IDENTITY_INDEX_LOCK = threading.Lock()
+_INDEX_LOCKS = {}
+_PATH_LOCKS = {}
+_PENDING_CHECKPOINTS = set()
+_COMPACTOR = None
+_COMPACTOR_WAKEUP = threading.Event()
+VACUUM_CHUNK_SIZE = 8 << 20
+CONCAT_POLICIES = ("skip", "replace", "error")
+_VACUUM_LOCK = threading.Lock()
+
+def _log_record_crc(kind: int, meta_bytes: bytes, blob_size: int) -> int:
+    return zlib.crc32(meta_bytes, zlib.crc32(struct.pack("<BIQ", kind, len(meta_bytes), blob_size)))
+
+def _encode_log_record(kind: int, meta: dict, blob: bytes=b"") -> bytes:
+    meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+    header = LOG_RECORD_HEADER.pack(LOG_RECORD_MAGIC, kind, len(meta_bytes), len(blob), _log_record_crc(kind, meta_bytes, len(blob)))
+    return header + meta_bytes + blob
+
+def _read_log_v2(f, log_start: int, file_size: int):
+    """
+    Returns the valid records from log_start as (kind, meta, blob_loc, blob_size) together
+    with the offset right after the last valid record.
+    """
+    records = []
+    pos = log_start
+    while pos + LOG_RECORD_HEADER.size <= file_size:
+        f.seek(pos)
+        magic, kind, meta_size, blob_size, crc = LOG_RECORD_HEADER.unpack(f.read(LOG_RECORD_HEADER.size))
+        blob_loc = pos + LOG_RECORD_HEADER.size + meta_size
+        if magic != LOG_RECORD_MAGIC or blob_loc + blob_size > file_size:
+            break
+        meta_bytes = f.read(meta_size)
+        if _log_record_crc(kind, meta_bytes, blob_size) != crc:
+            break
+        records.append((kind, json.loads(meta_bytes), blob_loc, blob_size))
+        pos = blob_loc + blob_size
+    return records, pos
+
+def _apply_log_record_to_mapper_v2(mapper: dict, kind: int, meta: dict, blob_loc: int, blob_size: int):
+    if "blob" in meta:
+        # the record shares a blob stored earlier instead of carrying its own
+        blob_loc, blob_size = meta["blob"]
+    if kind == LOG_INSERT:
+        mapper[meta['identity']] = (blob_loc, blob_size, meta.get('codec', BLOB_ZLIB))
+    elif kind == LOG_UPDATE and meta['identity'] in mapper:
+        location = mapper.pop(meta['identity'])
+        mapper[meta.get('rekey', meta['identity'])] = (blob_loc, blob_size, meta.get('codec', BLOB_ZLIB)) if blob_size > 0 else location
+    elif kind == LOG_DELETE:
+        mapper.pop(meta['identity'], None)
+
+def _overlay_row_v2(metadata_df: pd.DataFrame, position: int, values: dict, columns: list[str]=None):
+    """
+    Sets values on the row at position in place. Columns the table lacks, as in checkpoints
+    written before the column existed, are added and filled with None like pd.concat does for
+    inserts, unless columns leaves them out.
+    """
+    for name, value in values.items():
+        if name not in metadata_df.columns:
+            if columns is not None and name not in columns:
+                continue
+            metadata_df[name] = None
+        metadata_df.at[position, name] = value
+
+def _apply_log_v2(records: list, mapper: dict, metadata_df: pd.DataFrame, columns: list[str]=None) -> pd.DataFrame:
+    """
+    Overlays log records onto the checkpointed mapper (in place) and metadata table.
+    metadata_df must carry the identity column whenever the log holds updates.
+    """
+    inserted_rows = []
+    inserted_positions = {}
+    checkpoint_positions = None
+    deleted_positions = []
+    for kind, meta, blob_loc, blob_size in records:
+        _apply_log_record_to_mapper_v2(mapper, kind, meta, blob_loc, blob_size)
+        if kind == LOG_INSERT:
+            inserted_positions[meta['identity']] = len(inserted_rows)
+            inserted_rows.append({name: value for name, value in meta.items() if name not in ('codec', 'blob')})
+        elif kind == LOG_DELETE:
+            if meta['identity'] in inserted_positions:
+                inserted_rows[inserted_positions.pop(meta['identity'])] = None
+                continue
+            if checkpoint_positions is None:
+                checkpoint_positions = {value: position for position, value in enumerate(metadata_df['identity'].tolist())}
+            position = checkpoint_positions.pop(meta['identity'], None)
+            if position is not None:
+                deleted_positions.append(position)
+        elif kind == LOG_UPDATE:
+            identity = meta['identity']
+            values = dict(meta['values'], identity=meta.get('rekey', identity))
+            if identity in inserted_positions:
+                position = inserted_positions.pop(identity)
+                inserted_rows[position].update(values)
+                inserted_positions[values['identity']] = position
+                continue
+            if checkpoint_positions is None:
+                checkpoint_positions = {value: position for position, value in enumerate(metadata_df['identity'].tolist())}
+            position = checkpoint_positions.pop(identity, None)
+            if position is None:
+                continue
+            checkpoint_positions[values['identity']] = position
+            _overlay_row_v2(metadata_df, position, values, columns)
+    if deleted_positions:
+        metadata_df = metadata_df.drop(index=deleted_positions).reset_index(drop=True)
+    inserted_rows = [row for row in inserted_rows if row is not None]
+    if inserted_rows:
+        inserted_df = pd.DataFrame(inserted_rows)
+        if columns is not None:
+            inserted_df = inserted_df[[name for name in inserted_df.columns if name in columns]]
+        metadata_df = pd.concat([metadata_df, inserted_df], ignore_index=True)
+    return metadata_df
+
+def _create_v2(path: str):
+    with open(path, "wb") as f:
+        empty_df_with_heads = pd.DataFrame(columns=["seed", "prompt", "negative_prompt", "width", "height", "steps", "guidance_scale", "labeled", "label", "identity"])
+        _write_header_v2(f, 16, 16)
+        f.write(_serialize_metadata_v2(empty_df_with_heads))
+
+def _load_v2(f, columns: list[str]=None):
+    """
+    Reads checkpoint and log, returning the folded (mapper, metadata, log_end, log record count).
+    Only the given metadata columns are loaded when columns is set.
+    """
+    file_size = os.fstat(f.fileno()).st_size
+    mapper_loc, metadata_loc = _read_header_v2(f)
+    f.seek(mapper_loc)
+    mapper = _parse_mapper_v2(f.read(metadata_loc - mapper_loc))
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, "identity"]))
+    metadata_df, log_start = _read_metadata_section_v2(f, metadata_loc, columns=read_columns)
+    records, log_end = _read_log_v2(f, log_start, file_size)
+    metadata_df = _apply_log_v2(records, mapper, metadata_df, read_columns)
+    if columns is not None and "identity" not in columns:
+        metadata_df = metadata_df.drop(columns="identity")
+    return mapper, metadata_df, log_end, len(records)
+
+def _serialize_checkpoint_v2(path: str, mapper: dict, metadata_df: pd.DataFrame) -> dict:
+    """
+    Everything a checkpoint of mapper and metadata writes, built without touching the file,
+    along with the identity index the file starts over from once it is written.
+    """
+    mapper_bytes = _serialize_mapper_v2(mapper)
+    metadata_bytes = _serialize_metadata_v2(metadata_df)
+    checkpoint = {
+        "mapper_bytes": mapper_bytes,
+        "metadata_bytes": metadata_bytes,
+        "size": len(mapper_bytes) + len(metadata_bytes),
+        "sidecars": [],
+        "carried": [],
+        "carried_size": 0,
+        "index": None,
+    }
+    indexes = None
+    if path.endswith(THUMBS_SUFFIX):
+        indexes = {}
+    elif "identity" in metadata_df.columns:
+        tags = _build_tags_v2(list(mapper), metadata_df)
+        contents = _build_contents_v2(mapper, metadata_df)
+        if all(name in metadata_df.columns for name in TAG_FIELDS):
+            checkpoint["sidecars"].append(("tags", TAGS_MAGIC, _tags_chunks_v2(tags)))
+            indexes = {"tags": tags, "contents": contents}
+        checkpoint["sidecars"].append(("digests", DIGESTS_MAGIC, _contents_chunks_v2(list(mapper), contents)))
+    if indexes is not None:
+        checkpoint["index"] = {"path": path, "generation": None, "records": 0, "mapper": mapper, "mapping": None, **indexes}
+    return checkpoint
+
+def _carry_log_v2(checkpoint: dict, records: list, moved: dict=None, src=None):
+    """
+    Encodes log records read behind the snapshot a checkpoint was built from anew, to follow
+    the checkpoint, and applies them to its identity index. In place (moved None) their blobs
+    stay where they are and are referenced like shared ones. Into a rewritten file, whose
+    checkpoint_loc is known up front, they point at the blob's offset in moved, or carry the
+    blob over from src when it was not moved.
+    """
+    for kind, meta, blob_loc, blob_size in records:
+        offset, size = meta.get("blob", (blob_loc, blob_size))
+        blob = b""
+        if size > 0 and moved is None:
+            meta = {**meta, "blob": [offset, size]}
+        elif size > 0 and (offset, size) in moved:
+            meta = {**meta, "blob": [moved[(offset, size)], size]}
+        elif size > 0:
+            meta = {name: value for name, value in meta.items() if name != "blob"}
+            blob = os.pread(src.fileno(), size, offset)
+        record = _encode_log_record(kind, meta, blob)
+        blob_loc = 0
+        if blob:
+            blob_loc = checkpoint["checkpoint_loc"] + checkpoint["size"] + checkpoint["carried_size"] + len(record) - len(blob)
+            moved[(offset, size)] = blob_loc
+        checkpoint["carried"].append(record)
+        checkpoint["carried_size"] += len(record)
+        if checkpoint["index"] is not None:
+            _apply_index_record_v2(checkpoint["index"], kind, meta, blob_loc, len(blob))
+            checkpoint["index"]["records"] += 1
+
+def _catch_up_log_v2(checkpoint: dict, f, log_end: int, moved: dict=None) -> int:
+    """
+    Carries records appended to f behind log_end over into checkpoint until only a few are left
+    for the write lock, returning where it stopped.
+    """
+    for _ in range(CATCH_UP_ROUNDS):
+        records, log_end = _read_log_v2(f, log_end, os.fstat(f.fileno()).st_size)
+        _carry_log_v2(checkpoint, records, moved, f)
+        if len(records) < CATCH_UP_RECORDS:
+            break
+    return log_end
+
+def _write_checkpoint_v2(path: str, f, mapper: dict, metadata_df: pd.DataFrame, checkpoint_loc: int):
+    """
+    Writes mapper and metadata at checkpoint_loc, drops everything behind them, then repoints
+    the header. Until the header is rewritten the previous checkpoint plus its log stay valid.
+    """
+    _write_serialized_checkpoint_v2(path, f, _serialize_checkpoint_v2(path, mapper, metadata_df), checkpoint_loc)
+
+def _write_serialized_checkpoint_v2(path: str, f, checkpoint: dict, checkpoint_loc: int):
+    """
+    _write_checkpoint_v2 for a checkpoint from _serialize_checkpoint_v2, followed by the log
+    records carried along with it.
+    """
+    mapper_bytes = checkpoint["mapper_bytes"]
+    f.seek(checkpoint_loc)
+    f.write(mapper_bytes)
+    f.write(checkpoint["metadata_bytes"])
+    f.writelines(checkpoint["carried"])
+    f.truncate()
+    f.flush()
+    os.fsync(f.fileno())
+    stamp = _checkpoint_stamp_v2(checkpoint_loc, checkpoint_loc + len(mapper_bytes), mapper_bytes)
+    for kind, magic, chunks in checkpoint["sidecars"]:
+        _write_sidecar_v2(path, kind, magic, stamp, chunks)
+    _write_header_v2(f, checkpoint_loc, checkpoint_loc + len(mapper_bytes))
+    f.flush()
+    _IDENTITY_INDEXES.pop(path, None)
+
+def _install_identity_index_v2(path: str, f, checkpoint: dict, checkpoint_loc: int):
+    """
+    Hands the identity index of the checkpoint just written at checkpoint_loc through f to
+    later lookups, sparing them a reload from disk.
+    """
+    index = checkpoint["index"]
+    if index is None:
+        return
+    st = os.fstat(f.fileno())
+    f.seek(0)
+    index.update({
+        "inode": (st.st_dev, st.st_ino),
+        "header": f.read(16),
+        "log_end": checkpoint_loc + checkpoint["size"] + checkpoint["carried_size"],
+        "generation": _file_generation_v2(st),
+    })
+    with _index_lock_v2(path):
+        _IDENTITY_INDEXES[path] = index
+
+class _SharedFileLock:
+    """
+    Write lock of a file other processes append to as well: an in-process RLock plus an
+    exclusive flock on <file>.lock, taken once per thread however deeply it is nested.
+    """
+    def __init__(self, path: str):
+        self.lock_path = path + ".lock"
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.f = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                self.f = open(self.lock_path, "a+b")
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                if self.f is not None:
+                    self.f.close()
+                    self.f = None
+                self.lock.release()
+                raise
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            # closing the descriptor drops the flock
+            self.f.close()
+            self.f = None
+        self.lock.release()
+
+def _path_lock_v2(path: str):
+    """
+    Write lock of one imdb file. IMDB_PATH itself keeps using GLOBAL_DATABASE_THREAD_LOCK;
+    thumbs files, which the server and the thumbnails CLI fill at the same time, are flocked
+    across processes too.
+    """
+    if path == IMDB_PATH:
+        return GLOBAL_DATABASE_THREAD_LOCK
+    lock = _PATH_LOCKS.get(path)
+    if lock is None:
+        with _IDENTITY_INDEX_LOCK:
+            lock = _PATH_LOCKS.get(path)
+            if lock is None:
+                lock = _PATH_LOCKS[path] = _SharedFileLock(path) if path.endswith(THUMBS_SUFFIX) else threading.RLock()
+    return lock
+
+def _index_lock_v2(path: str):
+    """
+    Guards refreshing the identity index of one file and appending to it, so a reader catching
+    up on the log never replays records the appending thread is still applying.
+    """
+    lock = _INDEX_LOCKS.get(path)
+    if lock is None:
+        with _IDENTITY_INDEX_LOCK:
+            lock = _INDEX_LOCKS.setdefault(path, threading.Lock())
+    return lock
+
+def _file_generation_v2(st) -> tuple:
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _load_identity_index_v2(path: str, f, st, header: bytes) -> dict:
+    mapper_loc, metadata_loc = _read_header_v2(f)
+    f.seek(mapper_loc)
+    mapper_bytes = f.read(metadata_loc - mapper_loc)
+    mapper = _parse_mapper_v2(mapper_bytes)
+    _, log_start = _read_metadata_section_v2(f, metadata_loc, parse=False)
+    index = {
+        "path": path,
+        "inode": (st.st_dev, st.st_ino),
+        "header": header,
+        "generation": None,
+        "log_end": log_start,
+        "records": 0,
+        "mapper": mapper,
+        "mapping": None,
+    }
+    if os.path.basename(path) == JOURNAL_NAME:
+        index["journal"] = {"entries": {}, "aliases": {}}
+    elif not path.endswith(THUMBS_SUFFIX):
+        stamp = _checkpoint_stamp_v2(mapper_loc, metadata_loc, mapper_bytes)
+        index["tags"] = _load_tags_v2(path, f, stamp, list(mapper))
+        index["contents"] = _load_contents_v2(path, f, stamp, mapper)
+    return index
+
+def _identity_index_v2(path: str, f=None) -> dict:
+    """
+    Process-wide identity -> (offset, size) index of an imdb file, covering checkpoint and log.
+    While the file's generation (inode, size, mtime) is unchanged a lookup costs one stat.
+    Appends by other writers are caught up by reading only the new log records; a checkpoint,
+    rewrite or replaced file triggers a full reload.
+    """
+    st = os.stat(path) if f is None else os.fstat(f.fileno())
+    index = _IDENTITY_INDEXES.get(path)
+    if index is not None and index["generation"] == _file_generation_v2(st):
+        return index
+    with _index_lock_v2(path):
+        if f is None:
+            with open(path, "rb") as f:
+                return _refresh_identity_index_v2(path, f, index)
+        return _refresh_identity_index_v2(path, f, index)
+
+def _refresh_identity_index_v2(path: str, f, index: dict) -> dict:
+    st = os.fstat(f.fileno())
+    f.seek(0)
+    header = f.read(16)
+    if index is None or index["inode"] != (st.st_dev, st.st_ino) or index["header"] != header or index["log_end"] > st.st_size:
+        index = _load_identity_index_v2(path, f, st, header)
+    if index["log_end"] < st.st_size:
+        records, log_end = _read_log_v2(f, index["log_end"], st.st_size)
+        for record in records:
+            _apply_index_record_v2(index, *record)
+        index["records"] += len(records)
+        index["log_end"] = log_end
+    index["generation"] = _file_generation_v2(st)
+    _IDENTITY_INDEXES[path] = index
+    return index
+
+def _apply_index_record_v2(index: dict, kind: int, meta: dict, blob_loc: int, blob_size: int):
+    _apply_log_record_to_mapper_v2(index["mapper"], kind, meta, blob_loc, blob_size)
+    if "tags" in index:
+        _apply_tags_record_v2(index["tags"], kind, meta)
+    if "contents" in index:
+        _apply_contents_record_v2(index["contents"], index["mapper"], kind, meta)
+    if "journal" in index:
+        _apply_journal_record_v2(index["journal"], kind, meta, blob_loc, blob_size)
+
+def _append_log_v2(path: str, kind: int, meta: dict, blob: bytes=b"") -> dict:
+    return _append_log_batch_v2(path, [(kind, meta, blob)])
+
+def _append_log_batch_v2(path: str, records: list) -> dict:
+    """
+    Appends (kind, meta, blob) records with one write and flush, returning the updated index.
+    Inserts of content the file already holds share the stored blob instead of writing it again.
+    """
+    with open(path, "r+b") as f, _index_lock_v2(path):
+        index = _IDENTITY_INDEXES.get(path)
+        if index is None or index["generation"] != _file_generation_v2(os.fstat(f.fileno())):
+            index = _refresh_identity_index_v2(path, f, index)
+        if index["log_end"] < os.fstat(f.fileno()).st_size:
+            # torn append or leftovers of a pre-log writer past the metadata stream
+            f.truncate(index["log_end"])
+        encoded = []
+        batch_contents = {}
+        pos = index["log_end"]
+        for kind, meta, blob in records:
+            meta, blob = _share_blob_v2(index.get("contents"), batch_contents, kind, meta, blob)
+            record = _encode_log_record(kind, meta, blob)
+            if kind == LOG_INSERT and len(blob) > 0 and meta.get("content_digest"):
+                batch_contents[meta["content_digest"]] = (pos + len(record) - len(blob), len(blob), meta["codec"])
+            encoded.append((kind, meta, record, len(blob)))
+            pos += len(record)
+        f.seek(index["log_end"])
+        f.writelines(record for _, _, record, _ in encoded)
+        f.flush()
+        for kind, meta, record, blob_size in encoded:
+            _apply_index_record_v2(index, kind, meta, index["log_end"] + len(record) - blob_size, blob_size)
+            index["log_end"] += len(record)
+        index["records"] += len(records)
+        index["generation"] = _file_generation_v2(os.fstat(f.fileno()))
+        # a journal folds into one record per entry rather than into a checkpoint
+        live = 2 * len(index["journal"]["entries"]) if "journal" in index else len(index["mapper"]) * LOG_CHECKPOINT_RATIO
+        if index["records"] >= max(LOG_CHECKPOINT_MIN_RECORDS, live):
+            _queue_checkpoint_v2(path)
+    return index
+
+def _queue_checkpoint_v2(path: str):
+    global _COMPACTOR
+    with _IDENTITY_INDEX_LOCK:
+        _PENDING_CHECKPOINTS.add(path)
+        if _COMPACTOR is None:
+            _COMPACTOR = threading.Thread(target=_compactor_loop_v2, name="imdb-compactor", daemon=True)
+            _COMPACTOR.start()
+    _COMPACTOR_WAKEUP.set()
+
+def _compactor_loop_v2():
+    while True:
+        _COMPACTOR_WAKEUP.wait()
+        _COMPACTOR_WAKEUP.clear()
+        with _IDENTITY_INDEX_LOCK:
+            paths = list(_PENDING_CHECKPOINTS)
+            _PENDING_CHECKPOINTS.clear()
+        for path in paths:
+            try:
+                if os.path.basename(path) == JOURNAL_NAME:
+                    _compact_journal_v2(os.path.dirname(path))
+                elif _checkpoint_file_v2(path) and _auto_vacuum_due_v2(path):
+                    with _VACUUM_LOCK:
+                        _vacuum_file_v2(path, VACUUM_CHUNK_SIZE)
+            except FileNotFoundError:
+                # a sealed segment vacuumed away before its turn
+                pass
+            except RuntimeError:
+                # vacuumed by another process sharing the file (thumbs) while this one copied
+                pass
+            except Exception as e:
+                print(f"Warning: imdb checkpoint of {path} failed: {e}")
+
+def _auto_vacuum_due_v2(path: str) -> bool:
+    # segments are rewritten under a new name once sealed, the claim of an open one is a flock on its inode
+    if os.path.basename(path).startswith("segment-"):
+        return False
+    return _fragmentation_file_v2(path)["fragmentation"] >= AUTO_VACUUM_RATIO
+
+def _checkpoint_file_v2(path: str) -> bool:
+    """
+    Folds the log of one file into a new checkpoint behind it. The checkpoint is built from a
+    snapshot without the write lock, together with the records appended while building it; the
+    lock is only taken to carry over the last few, write it all and repoint the header.
+    """
+    while True:
+        with open(path, "rb") as f:
+            header = f.read(16)
+            mapper, metadata_df, log_end, log_records = _load_v2(f)
+            if log_records == 0:
+                return False
+            checkpoint = _serialize_checkpoint_v2(path, mapper, metadata_df)
+            log_end = _catch_up_log_v2(checkpoint, f, log_end)
+        with _path_lock_v2(path), open(path, "r+b") as f:
+            if f.read(16) != header:
+                # checkpointed or rewritten meanwhile, the snapshot no longer describes the file
+                continue
+            records, end = _read_log_v2(f, log_end, os.fstat(f.fileno()).st_size)
+            _carry_log_v2(checkpoint, records)
+            _write_serialized_checkpoint_v2(path, f, checkpoint, end)
+            _install_identity_index_v2(path, f, checkpoint, end)
+            return True
+
+def checkpoint_v2() -> bool:
+    """
+    Folds the log into a fresh mapper and metadata section. A background compactor runs it
+    once the log grows past LOG_CHECKPOINT_MIN_RECORDS or LOG_CHECKPOINT_RATIO of the stored images.
+    """
+    return _checkpoint_imdb_v2(IMDB_PATH)
+
+def _checkpoint_imdb_v2(path: str) -> bool:
+    if _v3_store(path) is not None:
+        # every v3 write commits straight into the catalog, there is no log to fold
+        return False
+    if os.path.isdir(path):
+        return _checkpoint_segmented_v2(path)
+    return _checkpoint_file_v2(path)
+
+def _new_record_v2(uncompressed_img: bytes, values: dict):
+    if uncompressed_img is None or any(values.get(name) is None for name in IDENTITY_FIELDS):
+        raise ValueError("All parameters must be provided when adding new image")
+    new_metadata = img_metadata_v2(**{name: values[name] for name in IDENTITY_FIELDS})
+    new_metadata.update({name: values[name] for name in ("labeled", "label") if name in values})
+    new_metadata["content_digest"] = content_digest_v2(uncompressed_img)
+    if _content_known_v2(new_metadata["content_digest"]):
+        # shares the stored blob once committed, encoding it would be wasted
+        return {**new_metadata, "codec": None}, uncompressed_img
+    blob, codec = _encode_blob_v2(uncompressed_img)
+    return {**new_metadata, "codec": codec}, blob
+
+def _update_record_v2(identity_hash: str, uncompressed_img: bytes, values: dict):
+    update = {"identity": identity_hash, "values": values}
+    if any(name in IDENTITY_FIELDS for name in values):
+        store = _v3_store(IMDB_PATH)
+        if store is not None:
+            current = store.row(identity_hash, IDENTITY_FIELDS)
+        else:
+            metadata_df = read_metadata_v2(IDENTITY_FIELDS + ["identity"])
+            current = metadata_df[metadata_df['identity'] == identity_hash].iloc[0][IDENTITY_FIELDS].to_dict()
+        new_metadata = img_metadata_v2(**{**current, **{name: value for name, value in values.items() if name in IDENTITY_FIELDS}})
+        # the identity only changes when the new parameters no longer hash to it under its own salt
+        if not identity_hash_validation_v2(_identity_data_v2(new_metadata).hex(), identity_hash):
+            update["rekey"] = new_metadata['identity']
+    blob = b""
+    if uncompressed_img is not None:
+        update["values"] = {**values, "content_digest": content_digest_v2(uncompressed_img)}
+        blob, update["codec"] = _encode_blob_v2(uncompressed_img)
+    return update, blob
+
+def write_v2(identity_hash: str, uncompressed_img: bytes=None, seed: int=None, prompt: str=None, negative_prompt: str=None, width: int=None, height: int=None, steps: int=None, guidance_scale: float=None, labeled: bool=None, label: str=None):
+    values = {
+        name: value for name, value in (
+            ("seed", seed), ("prompt", prompt), ("negative_prompt", negative_prompt), ("width", width),
+            ("height", height), ("steps", steps), ("guidance_scale", guidance_scale), ("labeled", labeled), ("label", label),
+        ) if value is not None
+    }
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return _write_v3(store, identity_hash, uncompressed_img, values)
+    if os.path.isdir(IMDB_PATH):
+        return _write_segmented_v2(IMDB_PATH, identity_hash, uncompressed_img, values)
+    with GLOBAL_DATABASE_THREAD_LOCK:
+        if not os.path.exists(IMDB_PATH):
+            _create_v2(IMDB_PATH)
+        if identity_hash is None:
+            new_metadata, blob = _new_record_v2(uncompressed_img, values)
+            _append_log_v2(IMDB_PATH, LOG_INSERT, new_metadata, blob)
+            return new_metadata['identity']
+        if identity_hash not in _identity_index_v2(IMDB_PATH)["mapper"]:
+            raise ValueError("No metadata found for image hash", identity_hash)
+        update, blob = _update_record_v2(identity_hash, uncompressed_img, values)
+        _append_log_v2(IMDB_PATH, LOG_UPDATE, update, blob)
+        return update.get("rekey", identity_hash)
+
+def _mapped_view_v2(index: dict, end: int):
+    """
+    Read-only mmap of the file the index was built from, shared by all threads. Appends past
+    the mapped length remap it; superseded maps stay alive for as long as views reference them.
+    """
+    mapping = index["mapping"]
+    if mapping is not None and len(mapping) >= end:
+        return mapping
+    with _IDENTITY_INDEX_LOCK:
+        mapping = index["mapping"]
+        if mapping is not None and len(mapping) >= end:
+            return mapping
+        try:
+            f = open(index["path"], "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            st = os.fstat(f.fileno())
+            if (st.st_dev, st.st_ino) != index["inode"] or st.st_size < end:
+                return None
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index["mapping"] = mapping
+        return mapping
+
+def _locate_v2(identity_hash: str):
+    """
+    Returns (index, location) of the stored blob, location being None if the identity is unknown.
+    For a v3 imdb the index is the store itself.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store, store.locate(identity_hash)
+    if os.path.isdir(IMDB_PATH):
+        return _locate_segmented_v2(IMDB_PATH, identity_hash)
+    index = _identity_index_v2(IMDB_PATH)
+    return index, index["mapper"].get(identity_hash)
+
+def read_blob_v2(identity_hash: str):
+    """
+    Returns (blob, codec) with the stored, still encoded blob as a zero-copy memoryview over the
+    shared mapping of the imdb, or None if the identity is unknown. A v3 imdb returns bytes.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.read_blob(identity_hash)
+    while True:
+        index, location = _locate_v2(identity_hash)
+        if location is None:
+            return None
+        offset, size, codec = location
+        mapping = _mapped_view_v2(index, offset + size)
+        if mapping is not None:
+            return memoryview(mapping)[offset:offset + size], codec
+        # the file was replaced between indexing and mapping, index it again
 
 def read_img_v2(identity_hash: str):
     if not "$" in identity_hash:
         raise ValueError("Invalid identity_hash format: must contain '$' to separate salt and hash")
-    identity_salt, target_hash = identity_hash.split("$")
-    with open(IMDB_PATH, "rb") as f:
-        mapper_loc = int.from_bytes(f.read(8), "little", signed=False)
-        metadata_loc = int.from_bytes(f.read(8), "little", signed=False)
-        f.seek(mapper_loc)
-        mapper_bytes = BytesIO(f.read(metadata_loc - mapper_loc))
-        for _ in range(len(mapper_bytes.getvalue()) // 64):
-            salt = hex(int.from_bytes(mapper_bytes.read(16), "little", signed=False))
-            hash = hex(int.from_bytes(mapper_bytes.read(32), "little", signed=False))
-            #print('checking', salt +"$" + hash)
-            if int(identity_salt, 16) == int(salt, 16) and int(target_hash, 16) == int(hash, 16):
-                index = int.from_bytes(mapper_bytes.read(8), "little", signed=False)
-                size = int.from_bytes(mapper_bytes.read(8), "little", signed=False)
-                f.seek(index)
-                img = zlib.decompress(f.read(size))
-                return img
-            mapper_bytes.read(16)
-    return None
+    blob = read_blob_v2(identity_hash)
+    if blob is None:
+        return None
+    # raw blobs come back as the zero-copy view itself
+    return _decode_blob_v2(*blob)
+
+def read_imgs_v2(identity_hashes):
+    """
+    Yields (identity, image) for many identities, resolving them all up front and reading each
+    file once in offset order so large exports stream sequentially with flat memory. Images come
+    in file order rather than in the given order; unknown identities come first with None.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        for identity_hash, blob, codec in store.read_blobs(identity_hashes):
+            yield identity_hash, None if blob is None else _decode_blob_v2(blob, codec)
+        return
+    groups = {}
+    for identity_hash in dict.fromkeys(identity_hashes):
+        index, location = _locate_v2(identity_hash)
+        if location is None:
+            yield identity_hash, None
+            continue
+        groups.setdefault(index["path"], (index, []))[1].append((location, identity_hash))
+    for path, (index, located) in sorted(groups.items()):
+        located.sort()
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if (st.st_dev, st.st_ino) != index["inode"]:
+                # rewritten since it was indexed, fall back to fresh lookups
+                for _, identity_hash in located:
+                    yield identity_hash, read_img_v2(identity_hash)
+                continue
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for (offset, size, codec), identity_hash in located:
+                f.seek(offset)
+                yield identity_hash, _decode_blob_v2(f.read(size), codec)
+
+def _copy_range(src, dst, size: int, chunk_size: int=1 << 20):
+    while size > 0:
+        chunk = src.read(min(size, chunk_size))
+        if chunk == b'':
+            break
+        dst.write(chunk)
+        size -= len(chunk)
 
 def del_img_v2(identity_hash: str):
-    with open(IMDB_PATH, "rb") as f:
-        mapper_loc = int.from_bytes(f.read(8), "little", signed=False)
-        metadata_loc = int.from_bytes(f.read(8), "little", signed=False)
-        f.seek(mapper_loc)
-        mapper_buff = BytesIO(f.read(metadata_loc - mapper_loc))
-        f.seek(metadata_loc)
-        metadata_bytes = BytesIO(zlib.decompress(f.read()))
-    mapper = {}
-    for i in range(len(mapper_buff.getvalue()) // 64):
-        mapper_buff.seek(i * 64)
-        salt = bytes(mapper_buff.read(16)[::-1]).hex()
-        hash = bytes(mapper_buff.read(32)[::-1]).hex()
-        index = int.from_bytes(mapper_buff.read(8), "little", signed=False)
-        size = int.from_bytes(mapper_buff.read(8), "little", signed=False)
-        mapper[salt + "$" + hash] = (index, size)
-    metadata_df = pd.read_csv(metadata_bytes)
-    mapper_buff.close()
-    metadata_bytes.close()
-    if identity_hash not in mapper:
-        return False
-    img_loc, img_size = mapper.pop(identity_hash)
-    metadata_df = metadata_df[metadata_df['identity'] != identity_hash]
-    with open(IMDB_PATH, "r+b") as f:
-        f.seek(img_loc + img_size)
-        img_bytes = f.read(mapper_loc - (img_loc + img_size))
-        f.seek(img_loc)
-        f.write(img_bytes)
-        for key, (index, size) in mapper.items():
-            if index >= img_loc + img_size:
-                mapper[key] = (index - img_size, size)
-        mapper_loc -= img_size
-        f.seek(mapper_loc)
-        mapper_buffer = BytesIO()
-        for key, (index, size) in mapper.items():
-            salt, hash = key.split("$")
-            mapper_buffer.write(int.to_bytes(int(salt, 16), 16, "little", signed=False))
-            mapper_buffer.write(int.to_bytes(int(hash, 16), 32, "little", signed=False))
-            mapper_buffer.write(int.to_bytes(index, 8, "little", signed=False))
-            mapper_buffer.write(int.to_bytes(size, 8, "little", signed=False))
-        mapper_bytes = mapper_buffer.getvalue()
-        mapper_buffer.close()
-        f.write(mapper_bytes)
-        metadata_loc = mapper_loc + len(mapper_bytes)
-        f.seek(metadata_loc)
-        f.write(zlib.compress(metadata_df.to_csv(index=False).encode('utf-8')))
-        f.seek(0)
-        f.write(int.to_bytes(mapper_loc, 8, "little", signed=False))
-        f.write(int.to_bytes(metadata_loc, 8, "little", signed=False))
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.apply([(LOG_DELETE, {"identity": identity_hash}, b"")])[0]
+    if os.path.isdir(IMDB_PATH):
+        return _del_segmented_v2(IMDB_PATH, identity_hash)
+    with GLOBAL_DATABASE_THREAD_LOCK:
+        if identity_hash not in _identity_index_v2(IMDB_PATH)["mapper"]:
+            return False
+        _append_log_v2(IMDB_PATH, LOG_DELETE, {"identity": identity_hash})
     return True
 
-def read_mapper_v2():
-    with open(IMDB_PATH, "rb") as f:
-        mapper_loc = int.from_bytes(f.read(8), "little", signed=False)
-        metadata_loc = int.from_bytes(f.read(8), "little", signed=False)
+def _fragmentation_file_v2(path: str) -> dict:
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        mapper_loc, metadata_loc = _read_header_v2(f)
         f.seek(mapper_loc)
-        mapper_bytes = f.read(metadata_loc - mapper_loc)
-        mapper = {}
-        for i in range(len(mapper_bytes) // 64):
-            base = i * 64
-            f.seek(mapper_loc + base)
-            salt = bytes(f.read(16)[::-1]).hex()
-            hash = bytes(f.read(32)[::-1]).hex()
-            index = int.from_bytes(f.read(8), "little", signed=False)
-            size = int.from_bytes(f.read(8), "little", signed=False)
-            mapper[salt + "$" + hash] = (index, size)
-        return mapper
-    
+        mapper = _parse_mapper_v2(f.read(metadata_loc - mapper_loc))
+        _, log_start = _read_metadata_section_v2(f, metadata_loc, parse=False)
+        records, log_end = _read_log_v2(f, log_start, file_size)
+    for record in records:
+        _apply_log_record_to_mapper_v2(mapper, *record)
+    live_bytes = sum(size for _, size in set(location[:2] for location in mapper.values()))
+    log_overhead = (log_end - log_start) - sum(blob_size for _, _, _, blob_size in records)
+    dead_bytes = file_size - 16 - live_bytes - (log_start - mapper_loc) - log_overhead
+    return {
+        "file_bytes": file_size,
+        "live_images": len(mapper),
+        "live_bytes": live_bytes,
+        "checkpoint_bytes": log_start - mapper_loc,
+        "log_records": len(records),
+        "tombstones": sum(1 for kind, _, _, _ in records if kind == LOG_DELETE),
+        "dead_bytes": dead_bytes,
+        "fragmentation": dead_bytes / file_size if file_size else 0.0,
+    }
+
+def fragmentation_v2() -> dict:
+    """
+    Space accounting of IMDB_PATH. dead_bytes covers deleted or replaced blobs and superseded
+    checkpoints, all of which vacuum_v2 reclaims; fragmentation is their share of the file.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.fragmentation()
+    if os.path.isdir(IMDB_PATH):
+        return _fragmentation_segmented_v2(IMDB_PATH)
+    return _fragmentation_file_v2(IMDB_PATH)
+
+def _blob_runs_v2(locations: list) -> list:
+    """
+    Coalesces (offset, size) blobs into the sorted (start, end) runs of adjacent blobs they form.
+    """
+    runs = []
+    run_start = run_end = None
+    for offset, size in sorted(set(locations)):
+        if run_end != offset:
+            if run_start is not None:
+                runs.append((run_start, run_end))
+            run_start = offset
+        run_end = offset + size
+    if run_start is not None:
+        runs.append((run_start, run_end))
+    return runs
+
+def _moved_offsets_v2(locations: list, runs: list, run_offsets: dict) -> dict:
+    moved = {}
+    run_iter = iter(runs)
+    run_start, run_end = None, -1
+    for offset, size in sorted(set(locations)):
+        while offset >= run_end:
+            run_start, run_end = next(run_iter)
+        moved[(offset, size)] = run_offsets[run_start] + (offset - run_start)
+    return moved
+
+def _copy_blobs_v2(src, dst, locations: list, chunk_size: int) -> dict:
+    """
+    Appends the given (offset, size) blobs to dst in file order, coalescing adjacent blobs into
+    runs copied chunk_size bytes at a time. Returns old location -> new offset.
+    """
+    runs = _blob_runs_v2(locations)
+    run_offsets = {}
+    for run_start, run_end in runs:
+        run_offsets[run_start] = dst.tell()
+        src.seek(run_start)
+        _copy_range(src, dst, run_end - run_start, chunk_size)
+    return _moved_offsets_v2(locations, runs, run_offsets)
+
+def _kernel_copy_v2(src_fd: int, dst_fd: int, src_offset: int, dst_offset: int, size: int):
+    """
+    Copies size bytes between descriptors at explicit offsets without passing them through
+    Python: copy_file_range (which reflinks on CoW filesystems), else sendfile, else pread/pwrite.
+    """
+    while size > 0:
+        count = min(size, 1 << 30)
+        copied = 0
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+        except (AttributeError, OSError):
+            try:
+                os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+                copied = os.sendfile(dst_fd, src_fd, src_offset, count)
+            except (AttributeError, OSError):
+                chunk = os.pread(src_fd, min(count, VACUUM_CHUNK_SIZE), src_offset)
+                copied = os.pwrite(dst_fd, chunk, dst_offset)
+        if copied == 0:
+            raise EOFError("imdb source ended inside a blob")
+        src_offset += copied
+        dst_offset += copied
+        size -= copied
+
+def _vacuum_file_v2(path: str, chunk_size: int) -> dict:
+    before = _fragmentation_file_v2(path)
+    # private to this thread, another process may be vacuuming a shared thumbs file as well
+    tmp_path = f"{path}.vacuum.{os.getpid()}.{threading.get_ident()}"
+    try:
+        return _vacuum_into_v2(path, tmp_path, before, chunk_size)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+def _vacuum_into_v2(path: str, tmp_path: str, before: dict, chunk_size: int) -> dict:
+    while True:
+        with open(path, "rb") as src, open(tmp_path, "w+b") as dst:
+            src_st = os.fstat(src.fileno())
+            header = src.read(16)
+            mapper, metadata_df, log_end, _ = _load_v2(src)
+            _write_header_v2(dst, 16, 16)
+            moved = _copy_blobs_v2(src, dst, [location[:2] for location in mapper.values()], chunk_size)
+            mapper = {identity: (moved[location[:2]], *location[1:]) for identity, location in mapper.items()}
+            checkpoint = _serialize_checkpoint_v2(path, mapper, metadata_df)
+            checkpoint["checkpoint_loc"] = dst.tell()
+            log_end = _catch_up_log_v2(checkpoint, src, log_end, moved)
+            with _path_lock_v2(path):
+                st = os.stat(path)
+                if (st.st_dev, st.st_ino) != (src_st.st_dev, src_st.st_ino):
+                    raise RuntimeError("imdb was replaced during vacuum")
+                if os.pread(src.fileno(), 16, 0) != header:
+                    # checkpointed meanwhile, start over from the new checkpoint
+                    continue
+                records, _ = _read_log_v2(src, log_end, st.st_size)
+                _carry_log_v2(checkpoint, records, moved, src)
+                _write_serialized_checkpoint_v2(path, dst, checkpoint, checkpoint["checkpoint_loc"])
+                os.replace(tmp_path, path)
+                _install_identity_index_v2(path, dst, checkpoint, checkpoint["checkpoint_loc"])
+        return {"before": before, "after": _fragmentation_file_v2(path)}
+
+def vacuum_v2(chunk_size: int=VACUUM_CHUNK_SIZE) -> dict:
+    """
+    Rewrites IMDB_PATH with only live blobs and a fresh checkpoint, then swaps it in atomically.
+    Live blobs and the checkpoint are prepared without holding the write lock; the lock is only
+    taken to carry over whatever was written meanwhile and to swap. The compactor runs it on its
+    own once AUTO_VACUUM_RATIO of a file is dead. Readers are served throughout from
+    the old file. Returns fragmentation_v2() from before and after.
+    """
+    with _VACUUM_LOCK:
+        store = _v3_store(IMDB_PATH)
+        if store is not None:
+            return store.vacuum()
+        if os.path.isdir(IMDB_PATH):
+            return _vacuum_segmented_v2(IMDB_PATH, chunk_size)
+        return _vacuum_file_v2(IMDB_PATH, chunk_size)
+
+def read_mapper_v2():
+    """
+    Returns identity -> (offset, size, codec). In a segmented imdb each location also names the
+    file holding the blob.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.mapper()
+    if os.path.isdir(IMDB_PATH):
+        return _read_segmented_mapper_v2(IMDB_PATH)
+    return dict(_identity_index_v2(IMDB_PATH)["mapper"])
+
 def select_idx_v2(indices: list[int]) -> list[str]:
     mapper = read_mapper_v2()
-    indexed_mapper = [m[0] for i, m in enumerate(sorted(mapper.items(), key=lambda item: item[1][0])) if i in indices]
+    indexed_mapper = [m[0] for i, m in enumerate(sorted(mapper.items(), key=lambda item: (item[1][3:], item[1][0]))) if i in indices]
     return indexed_mapper
 
 def export_v2(dst_folder_path: str, hash_list: list[str]=None):
@@ -329,29 +1225,1263 @@ def export_v2(dst_folder_path: str, hash_list: list[str]=None):
     metadata_df = read_metadata_v2()
     if hash_list is None:
         hash_list = metadata_df['identity'].astype(str).tolist()
-    imgs = {}
-    for hash in hash_list:
-        img = read_img_v2(hash)
+    exported = []
+    for hash, img in read_imgs_v2(hash_list):
         if img is None:
             print("Image not found for hash:", hash)
             continue
-        imgs[hash] = img
-    export_metadata_df = metadata_df[metadata_df['identity'].isin(imgs.keys())]
-    for hash, img in imgs.items():
         with open(os.path.join(dst_folder_path, f"{hash}.png"), "wb") as f:
             f.write(img)
+        exported.append(hash)
+    export_metadata_df = metadata_df[metadata_df['identity'].isin(exported)]
     with open(os.path.join(dst_folder_path, "metadata.csv"), "w") as f:
         f.write(export_metadata_df.to_csv(index=False))
 
-def concat_imdb_v2():
-    raise NotImplementedError
+def _plan_concat_v2(existing, src_paths: list[str], on_duplicate: str):
+    """
+    Loads each source and picks the identities to take from it. existing is the set of
+    identities already in the destination and grows as sources are planned.
+    """
+    if on_duplicate not in CONCAT_POLICIES:
+        raise ValueError(f"on_duplicate must be one of {CONCAT_POLICIES}")
+    plan = []
+    replaced = set()
+    for path in src_paths:
+        if os.path.isdir(path):
+            raise ValueError("Only single-file imdbs can be merged in", path)
+        with open(path, "rb") as src:
+            src_mapper, src_df, _, _ = _load_v2(src)
+        duplicates = [identity for identity in src_mapper if identity in existing]
+        if duplicates and on_duplicate == "error":
+            raise ValueError(f"{len(duplicates)} identities of {path} are already present", duplicates[:10])
+        take = [identity for identity in src_mapper if on_duplicate == "replace" or identity not in existing]
+        replaced.update(duplicates if on_duplicate == "replace" else ())
+        existing.update(take)
+        plan.append((path, src_mapper, src_df[src_df['identity'].isin(take)], take))
+    return plan, replaced
+
+def _concat_into_v2(dst, plan: list, pos: int):
+    """
+    Copies the planned blobs of every source into dst from pos on, returning the rebased
+    identity -> location entries and the end offset.
+    """
+    mapper = {}
+    for path, src_mapper, _, take in plan:
+        locations = [src_mapper[identity][:2] for identity in take]
+        runs = _blob_runs_v2(locations)
+        run_offsets = {}
+        with open(path, "rb") as src:
+            for run_start, run_end in runs:
+                _kernel_copy_v2(src.fileno(), dst.fileno(), run_start, pos, run_end - run_start)
+                run_offsets[run_start] = pos
+                pos += run_end - run_start
+        moved = _moved_offsets_v2(locations, runs, run_offsets)
+        mapper.update({identity: (moved[src_mapper[identity][:2]], *src_mapper[identity][1:]) for identity in take})
+    return mapper, pos
+
+def concat_imdb_v2(src_paths: list[str], on_duplicate: str="skip") -> dict:
+    """
+    Merges the single-file imdbs at src_paths into IMDB_PATH. Blob ranges are copied file to file
+    in the kernel without decoding or rehashing, their offsets rebased, and mapper and metadata
+    are committed with one checkpoint. on_duplicate decides for identities already present:
+    "skip" keeps the existing image, "replace" takes the incoming one, "error" raises before
+    anything is written. A segmented IMDB_PATH receives each source as a new sealed segment and
+    does not support "replace".
+    """
+    if isinstance(src_paths, str):
+        src_paths = [src_paths]
+    if _v3_store(IMDB_PATH) is not None:
+        raise ValueError("A v3 imdb takes other imdbs through python -m imagineit_app.migrate <src> <dst> --to v3")
+    if os.path.isdir(IMDB_PATH):
+        return _concat_segmented_v2(IMDB_PATH, src_paths, on_duplicate)
+    with GLOBAL_DATABASE_THREAD_LOCK:
+        if not os.path.exists(IMDB_PATH):
+            _create_v2(IMDB_PATH)
+        with open(IMDB_PATH, "r+b") as dst:
+            mapper, metadata_df, log_end, _ = _load_v2(dst)
+            plan, replaced = _plan_concat_v2(set(mapper), src_paths, on_duplicate)
+            dst.truncate(log_end)
+            added, end = _concat_into_v2(dst, plan, log_end)
+            mapper.update(added)
+            frames = [metadata_df[~metadata_df['identity'].isin(replaced)]] + [src_df for _, _, src_df, _ in plan]
+            metadata_df = pd.concat([frame for frame in frames if len(frame) > 0] or frames[:1], ignore_index=True)
+            _write_checkpoint_v2(IMDB_PATH, dst, mapper, metadata_df, end)
+    return {"images": len(added), "replaced": len(replaced), "bytes": end - log_end}
+
+def _concat_segmented_v2(directory: str, src_paths: list[str], on_duplicate: str) -> dict:
+    if on_duplicate == "replace":
+        raise ValueError("A segmented imdb only merges with on_duplicate 'skip' or 'error'")
+    _ensure_segmented_v2(directory)
+    stats = {"images": 0, "replaced": 0, "bytes": 0}
+    with _flocked_v2(os.path.join(directory, "journal.lock")):
+        plan, _ = _plan_concat_v2(set(_read_segmented_mapper_v2(directory)), src_paths, on_duplicate)
+        for source in plan:
+            if not source[3]:
+                continue
+            def allocate(manifest):
+                manifest["next_segment"] += 1
+                return f"segment-{manifest['next_segment'] - 1:06d}.imdb"
+            name = _update_manifest_v2(directory, allocate)
+            path = os.path.join(directory, name)
+            with open(path, "w+b") as dst:
+                _write_header_v2(dst, 16, 16)
+                dst.flush()
+                mapper, end = _concat_into_v2(dst, [source], 16)
+                _write_checkpoint_v2(path, dst, mapper, source[2].reset_index(drop=True), end)
+            _update_manifest_v2(directory, lambda manifest: manifest["segments"].append({"name": name, "sealed": True}))
+            stats["images"] += len(mapper)
+            stats["bytes"] += end - 16
+    return stats
 
-def read_metadata_v2() -> pd.DataFrame:
+def read_metadata_v2(columns: list[str]=None) -> pd.DataFrame:
+    """
+    Returns the metadata table. Pass columns to load only those, e.g. ["identity", "labeled"].
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.read_metadata(columns)
+    if os.path.isdir(IMDB_PATH):
+        return _read_segmented_metadata_v2(IMDB_PATH, columns)
     with open(IMDB_PATH, "rb") as f:
-        f.seek(8)
-        metadata_loc = int.from_bytes(f.read(8), "little", signed=False)
-        f.seek(metadata_loc)
-        return pd.read_csv(BytesIO(zlib.decompress(f.read())))
+        _, metadata_df, _, _ = _load_v2(f, columns)
+        return metadata_df
+
+###
+# Segmented layout
+#
+# IMDB_PATH may instead name a directory holding
+#   manifest.json         {"version", "segment_bytes", "next_segment", "segments": [{"name", "sealed"}]}
+#   segment-NNNNNN.imdb   single-file imdbs that only ever receive inserts
+#   journal.imdb          updates and deletes of images in any segment
+# Each writer thread claims an unsealed segment with an exclusive flock and appends its inserts
+# there, so writer threads and processes fill different segments at the same time. A segment
+# growing past segment_bytes is checkpointed and sealed; a sealed segment is never modified
+# again, only replaced as a whole by vacuum_v2 under a new name, which lets readers keep its
+# index and mapping without checking the file.
+# The journal is shared by all writers and appended under journal.lock. Its records are keyed
+# by the identity the image was inserted with and folded into one entry per image.
+###
+SEGMENT_BYTES = 1 << 30
+SEGMENT_VACUUM_RATIO = 0.1
+MANIFEST_NAME = "manifest.json"
+JOURNAL_NAME = "journal.imdb"
+_MANIFESTS = {}
+_SEGMENT_CLAIMS = threading.local()
+
+def create_segmented_v2(path: str, segment_bytes: int=SEGMENT_BYTES):
+    """
+    Creates an empty segmented imdb at path; point IMDB_PATH at the directory to use it.
+    """
+    if fcntl is None:
+        raise RuntimeError("segmented imdb requires fcntl")
+    os.makedirs(path, exist_ok=True)
+    if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+        return
+    _create_v2(os.path.join(path, JOURNAL_NAME))
+    _write_manifest_v2(path, {"version": 1, "segment_bytes": segment_bytes, "next_segment": 0, "segments": []})
+
+@contextlib.contextmanager
+def _flocked_v2(path: str):
+    """
+    Exclusive flock on a lock file. Threads exclude each other too, each holding its own descriptor.
+    """
+    with open(path, "a+b") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield f
+
+def _read_manifest_v2(directory: str) -> dict:
+    path = os.path.join(directory, MANIFEST_NAME)
+    cached = _MANIFESTS.get(directory)
+    if cached is not None and cached[0] == _file_generation_v2(os.stat(path)):
+        return cached[1]
+    with open(path, "rb") as f:
+        generation = _file_generation_v2(os.fstat(f.fileno()))
+        manifest = json.loads(f.read())
+    _MANIFESTS[directory] = (generation, manifest)
+    return manifest
+
+def _write_manifest_v2(directory: str, manifest: dict):
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + ".tmp", "wb") as f:
+        f.write(json.dumps(manifest, indent=1).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def _update_manifest_v2(directory: str, update):
+    """
+    Applies update(manifest) to a private copy under manifest.lock and swaps the result in.
+    """
+    with _flocked_v2(os.path.join(directory, "manifest.lock")):
+        manifest = json.loads(json.dumps(_read_manifest_v2(directory)))
+        result = update(manifest)
+        _write_manifest_v2(directory, manifest)
+        return result
+
+def _try_claim_segment_v2(path: str):
+    f = open(path, "rb")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+def _claimed_segment_v2(directory: str) -> str:
+    """
+    Path of the unsealed segment this thread appends to, claiming a free one or creating a new
+    one on first use. The claim lasts until the segment is sealed or the thread exits.
+    """
+    claims = getattr(_SEGMENT_CLAIMS, "claims", None)
+    if claims is None:
+        claims = _SEGMENT_CLAIMS.claims = {}
+    if directory in claims:
+        return claims[directory][0]
+    def claim(manifest):
+        for segment in manifest["segments"]:
+            if segment["sealed"]:
+                continue
+            path = os.path.join(directory, segment["name"])
+            lock = _try_claim_segment_v2(path)
+            if lock is not None:
+                return path, lock
+        name = f"segment-{manifest['next_segment']:06d}.imdb"
+        manifest["next_segment"] += 1
+        manifest["segments"].append({"name": name, "sealed": False})
+        path = os.path.join(directory, name)
+        _create_v2(path)
+        return path, _try_claim_segment_v2(path)
+    claims[directory] = _update_manifest_v2(directory, claim)
+    return claims[directory][0]
+
+def _seal_segment_v2(directory: str, path: str):
+    _checkpoint_file_v2(path)
+    def seal(manifest):
+        for segment in manifest["segments"]:
+            if segment["name"] == os.path.basename(path):
+                segment["sealed"] = True
+    _update_manifest_v2(directory, seal)
+    _, lock = _SEGMENT_CLAIMS.claims.pop(directory)
+    lock.close()
+
+def _segment_index_v2(directory: str, segment: dict) -> dict:
+    path = os.path.join(directory, segment["name"])
+    index = _IDENTITY_INDEXES.get(path)
+    if segment["sealed"] and index is not None and index.get("sealed"):
+        return index
+    index = _identity_index_v2(path)
+    if segment["sealed"]:
+        index["sealed"] = True
+    return index
+
+def _apply_journal_record_v2(journal: dict, kind: int, meta: dict, blob_loc: int, blob_size: int):
+    original = journal["aliases"].pop(meta['identity'], meta['identity'])
+    entry = journal["entries"].setdefault(original, {"identity": original, "values": {}, "location": None, "deleted": False})
+    if kind == LOG_DELETE:
+        entry["deleted"] = True
+    elif kind == LOG_UPDATE:
+        entry["values"].update(meta['values'])
+        entry["identity"] = meta.get('rekey', entry["identity"])
+        if blob_size > 0:
+            entry["location"] = (blob_loc, blob_size, meta.get('codec', BLOB_ZLIB))
+    journal["aliases"][entry["identity"]] = original
+
+def _locate_segmented_v2(directory: str, identity_hash: str):
+    while True:
+        manifest = _read_manifest_v2(directory)
+        try:
+            journal_index = _identity_index_v2(os.path.join(directory, JOURNAL_NAME))
+            journal = journal_index["journal"]
+            original = journal["aliases"].get(identity_hash, identity_hash)
+            entry = journal["entries"].get(original)
+            if entry is not None:
+                if entry["deleted"] or entry["identity"] != identity_hash:
+                    return None, None
+                if entry["location"] is not None:
+                    return journal_index, entry["location"]
+            for segment in reversed(manifest["segments"]):
+                index = _segment_index_v2(directory, segment)
+                # a vacuumed segment already holds the entry under its current identity
+                location = index["mapper"].get(original) or index["mapper"].get(identity_hash)
+                if location is not None:
+                    return index, location
+            return None, None
+        except FileNotFoundError:
+            # a segment was vacuumed away since the manifest was read
+            if _read_manifest_v2(directory) is manifest:
+                raise
+
+def _ensure_segmented_v2(directory: str):
+    if not os.path.exists(os.path.join(directory, MANIFEST_NAME)):
+        with GLOBAL_DATABASE_THREAD_LOCK:
+            create_segmented_v2(directory)
+
+def _append_inserts_segmented_v2(directory: str, records: list):
+    path = _claimed_segment_v2(directory)
+    with _path_lock_v2(path):
+        index = _append_log_batch_v2(path, records)
+        if index["log_end"] >= _read_manifest_v2(directory)["segment_bytes"]:
+            _seal_segment_v2(directory, path)
+
+def _write_segmented_v2(directory: str, identity_hash: str, uncompressed_img: bytes, values: dict):
+    _ensure_segmented_v2(directory)
+    if identity_hash is None:
+        new_metadata, blob = _new_record_v2(uncompressed_img, values)
+        _append_inserts_segmented_v2(directory, [(LOG_INSERT, new_metadata, blob)])
+        return new_metadata['identity']
+    journal_path = os.path.join(directory, JOURNAL_NAME)
+    with _flocked_v2(os.path.join(directory, "journal.lock")), _path_lock_v2(journal_path):
+        if _locate_segmented_v2(directory, identity_hash)[1] is None:
+            raise ValueError("No metadata found for image hash", identity_hash)
+        update, blob = _update_record_v2(identity_hash, uncompressed_img, values)
+        _append_log_v2(journal_path, LOG_UPDATE, update, blob)
+        return update.get("rekey", identity_hash)
+
+def _del_segmented_v2(directory: str, identity_hash: str) -> bool:
+    journal_path = os.path.join(directory, JOURNAL_NAME)
+    with _flocked_v2(os.path.join(directory, "journal.lock")), _path_lock_v2(journal_path):
+        if _locate_segmented_v2(directory, identity_hash)[1] is None:
+            return False
+        _append_log_v2(journal_path, LOG_DELETE, {"identity": identity_hash})
+    return True
+
+def _rewrite_journal_v2(directory: str, folded=()):
+    """
+    Replaces the journal with one record per entry, leaving out the folded identities.
+    Callers hold journal.lock.
+    """
+    journal_path = os.path.join(directory, JOURNAL_NAME)
+    tmp_path = journal_path + ".compact"
+    with _path_lock_v2(journal_path):
+        index = _identity_index_v2(journal_path)
+        _create_v2(tmp_path)
+        with open(journal_path, "rb") as src, open(tmp_path, "ab") as dst:
+            for original, entry in index["journal"]["entries"].items():
+                if original in folded:
+                    continue
+                if entry["deleted"]:
+                    dst.write(_encode_log_record(LOG_DELETE, {"identity": original}))
+                    continue
+                update = {"identity": original, "values": entry["values"]}
+                if entry["identity"] != original:
+                    update["rekey"] = entry["identity"]
+                blob = b""
+                if entry["location"] is not None:
+                    offset, size, update["codec"] = entry["location"]
+                    src.seek(offset)
+                    blob = src.read(size)
+                dst.write(_encode_log_record(LOG_UPDATE, update, blob))
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, journal_path)
+
+def _compact_journal_v2(directory: str):
+    with _flocked_v2(os.path.join(directory, "journal.lock")):
+        _rewrite_journal_v2(directory)
+
+def _checkpoint_segmented_v2(directory: str) -> bool:
+    """
+    Checkpoints the unsealed segments this thread owns or can claim and compacts the journal.
+    Segments claimed by other writers are left to their own compactor.
+    """
+    checkpointed = False
+    claims = getattr(_SEGMENT_CLAIMS, "claims", {})
+    for segment in _read_manifest_v2(directory)["segments"]:
+        path = os.path.join(directory, segment["name"])
+        if segment["sealed"]:
+            continue
+        if claims.get(directory, (None,))[0] == path:
+            checkpointed |= _checkpoint_file_v2(path)
+            continue
+        lock = _try_claim_segment_v2(path)
+        if lock is not None:
+            with lock:
+                checkpointed |= _checkpoint_file_v2(path)
+    if _identity_index_v2(os.path.join(directory, JOURNAL_NAME))["records"] > 0:
+        _compact_journal_v2(directory)
+        checkpointed = True
+    return checkpointed
+
+def _read_segmented_metadata_v2(directory: str, columns: list[str]=None) -> pd.DataFrame:
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, "identity"]))
+    while True:
+        manifest = _read_manifest_v2(directory)
+        try:
+            frames = []
+            for segment in manifest["segments"]:
+                with open(os.path.join(directory, segment["name"]), "rb") as f:
+                    frames.append(_load_v2(f, read_columns)[1])
+            break
+        except FileNotFoundError:
+            if _read_manifest_v2(directory) is manifest:
+                raise
+    non_empty = [frame for frame in frames if len(frame) > 0]
+    if non_empty:
+        metadata_df = pd.concat(non_empty, ignore_index=True)
+    else:
+        metadata_df = frames[0] if frames else pd.DataFrame(columns=read_columns or IDENTITY_FIELDS + ["labeled", "label", "identity"])
+    entries = _identity_index_v2(os.path.join(directory, JOURNAL_NAME))["journal"]["entries"]
+    if entries:
+        positions = {identity: position for position, identity in enumerate(metadata_df['identity'].tolist())}
+        deleted_positions = []
+        for original, entry in entries.items():
+            position = positions.get(original)
+            if position is None:
+                continue
+            if entry["deleted"]:
+                deleted_positions.append(position)
+                continue
+            _overlay_row_v2(metadata_df, position, dict(entry["values"], identity=entry["identity"]), read_columns)
+        if deleted_positions:
+            metadata_df = metadata_df.drop(index=deleted_positions).reset_index(drop=True)
+    if columns is not None and "identity" not in columns:
+        metadata_df = metadata_df.drop(columns="identity")
+    return metadata_df
+
+def _read_segmented_mapper_v2(directory: str) -> dict:
+    mapper = {}
+    for segment in _read_manifest_v2(directory)["segments"]:
+        index = _segment_index_v2(directory, segment)
+        mapper.update({identity: (*location, segment["name"]) for identity, location in index["mapper"].items()})
+    for original, entry in _identity_index_v2(os.path.join(directory, JOURNAL_NAME))["journal"]["entries"].items():
+        location = mapper.pop(original, None)
+        if location is None or entry["deleted"]:
+            continue
+        mapper[entry["identity"]] = location if entry["location"] is None else (*entry["location"], JOURNAL_NAME)
+    return mapper
+
+def _segment_dead_bytes_v2(index: dict, entries: dict) -> int:
+    """
+    Bytes of a segment's blobs that the journal deleted or replaced. A blob shared by several
+    identities is dead only once all of them are.
+    """
+    killed, kept = set(), set()
+    for identity, location in index["mapper"].items():
+        entry = entries.get(identity)
+        dead = entry is not None and (entry["deleted"] or entry["location"] is not None)
+        (killed if dead else kept).add(location[:2])
+    return sum(size for _, size in killed - kept)
+
+def _fragmentation_segmented_v2(directory: str) -> dict:
+    entries = _identity_index_v2(os.path.join(directory, JOURNAL_NAME))["journal"]["entries"]
+    segments = _read_manifest_v2(directory)["segments"]
+    stats = {"segments": len(segments), "sealed_segments": sum(1 for segment in segments if segment["sealed"])}
+    totals = dict.fromkeys(["file_bytes", "live_images", "live_bytes", "checkpoint_bytes", "log_records", "tombstones", "dead_bytes"], 0)
+    for segment in segments:
+        segment_stats = _fragmentation_file_v2(os.path.join(directory, segment["name"]))
+        killed = _segment_dead_bytes_v2(_segment_index_v2(directory, segment), entries)
+        segment_stats["live_bytes"] -= killed
+        segment_stats["dead_bytes"] += killed
+        for name in totals:
+            totals[name] += segment_stats[name]
+    journal_stats = _fragmentation_file_v2(os.path.join(directory, JOURNAL_NAME))
+    replacement_bytes = sum(entry["location"][1] for entry in entries.values() if entry["location"] is not None and not entry["deleted"])
+    totals["file_bytes"] += journal_stats["file_bytes"]
+    totals["live_bytes"] += replacement_bytes
+    totals["dead_bytes"] += journal_stats["dead_bytes"] - replacement_bytes
+    totals["checkpoint_bytes"] += journal_stats["checkpoint_bytes"]
+    totals["log_records"] += journal_stats["log_records"]
+    totals["live_images"] -= sum(1 for entry in entries.values() if entry["deleted"])
+    totals["tombstones"] = sum(1 for entry in entries.values() if entry["deleted"])
+    stats.update(totals)
+    stats["fragmentation"] = totals["dead_bytes"] / totals["file_bytes"] if totals["file_bytes"] else 0.0
+    return stats
+
+def _rewrite_segment_v2(directory: str, path: str, new_path: str, journal_index: dict, chunk_size: int):
+    """
+    Writes the live blobs of a sealed segment to new_path with its journal entries folded in:
+    deleted images are dropped, values and renames land in the rows, and replacement blobs are
+    copied over from the journal. Returns the folded identities.
+    """
+    entries = journal_index["journal"]["entries"]
+    with open(path, "rb") as src, open(new_path, "wb") as dst:
+        mapper, metadata_df, _, _ = _load_v2(src)
+        folded = [identity for identity in mapper if identity in entries]
+        positions = {identity: position for position, identity in enumerate(metadata_df['identity'].tolist())}
+        deleted_positions = []
+        journal_blobs = {}
+        for identity in folded:
+            entry = entries[identity]
+            location = mapper.pop(identity)
+            if entry["deleted"]:
+                deleted_positions.append(positions[identity])
+                continue
+            _overlay_row_v2(metadata_df, positions[identity], dict(entry["values"], identity=entry["identity"]))
+            if entry["location"] is None:
+                mapper[entry["identity"]] = location
+            else:
+                journal_blobs[entry["identity"]] = entry["location"]
+        metadata_df = metadata_df.drop(index=deleted_positions).reset_index(drop=True)
+        _write_header_v2(dst, 16, 16)
+        moved = _copy_blobs_v2(src, dst, [location[:2] for location in mapper.values()], chunk_size)
+        mapper = {identity: (moved[location[:2]], *location[1:]) for identity, location in mapper.items()}
+        with open(journal_index["path"], "rb") as journal:
+            for identity, (offset, size, codec) in journal_blobs.items():
+                mapper[identity] = (dst.tell(), size, codec)
+                journal.seek(offset)
+                _copy_range(journal, dst, size, chunk_size)
+        _write_checkpoint_v2(new_path, dst, mapper, metadata_df, dst.tell())
+    return folded
+
+def _vacuum_segmented_v2(directory: str, chunk_size: int) -> dict:
+    """
+    Rewrites each sealed segment whose dead share reaches SEGMENT_VACUUM_RATIO under a new name,
+    folding its journal entries in, then compacts the journal. Unsealed segments are left to
+    their writers. Updates wait on journal.lock meanwhile; inserts and reads carry on.
+    """
+    before = _fragmentation_segmented_v2(directory)
+    with _flocked_v2(os.path.join(directory, "journal.lock")):
+        journal_index = _identity_index_v2(os.path.join(directory, JOURNAL_NAME))
+        entries = journal_index["journal"]["entries"]
+        folded = set()
+        for segment in _read_manifest_v2(directory)["segments"]:
+            if not segment["sealed"]:
+                continue
+            stats = _fragmentation_file_v2(os.path.join(directory, segment["name"]))
+            dead_bytes = stats["dead_bytes"] + _segment_dead_bytes_v2(_segment_index_v2(directory, segment), entries)
+            if dead_bytes < stats["file_bytes"] * SEGMENT_VACUUM_RATIO:
+                continue
+            def allocate(manifest):
+                manifest["next_segment"] += 1
+                return f"segment-{manifest['next_segment'] - 1:06d}.imdb"
+            new_name = _update_manifest_v2(directory, allocate)
+            folded.update(_rewrite_segment_v2(directory, os.path.join(directory, segment["name"]), os.path.join(directory, new_name), journal_index, chunk_size))
+            def swap(manifest, old_name=segment["name"]):
+                for entry in manifest["segments"]:
+                    if entry["name"] == old_name:
+                        entry["name"] = new_name
+            _update_manifest_v2(directory, swap)
+            os.remove(os.path.join(directory, segment["name"]))
+            _remove_sidecars_v2(os.path.join(directory, segment["name"]))
+        _rewrite_journal_v2(directory, folded)
+    return {"before": before, "after": _fragmentation_segmented_v2(directory)}
+
+###
+# Checkpoint sidecars
+#
+# Indexes derived from a checkpoint are stored next to the file in <file>.<kind>, stamped with
+# the checkpoint they were built from so a load can tell whether they still apply:
+#   magic(4) | mapper_loc(8) | metadata_loc(8) | mapper crc32(4) | payload
+# A missing or stale sidecar is rebuilt from the checkpointed metadata.
+###
+SIDECAR_HEADER = struct.Struct("<4sQQI")
+SIDECAR_KINDS = ("tags", "digests")
+# companion imdb files of imagineit_app.thumbnails, holding renditions that need neither index
+THUMBS_SUFFIX = ".thumbs"
+
+def _checkpoint_stamp_v2(mapper_loc: int, metadata_loc: int, mapper_bytes: bytes) -> tuple:
+    return (mapper_loc, metadata_loc, zlib.crc32(mapper_bytes))
+
+def _sidecar_path_v2(path: str, kind: str) -> str:
+    return f"{path}.{kind}"
+
+def _read_sidecar_v2(path: str, kind: str, magic: bytes, stamp: tuple):
+    """
+    Returns the payload of a sidecar built for the checkpoint stamp, or None.
+    """
+    try:
+        with open(_sidecar_path_v2(path, kind), "rb") as f:
+            data = f.read()
+        file_magic, *file_stamp = SIDECAR_HEADER.unpack_from(data)
+    except (FileNotFoundError, struct.error):
+        return None
+    if file_magic != magic or tuple(file_stamp) != stamp:
+        return None
+    return memoryview(data)[SIDECAR_HEADER.size:]
+
+def _write_sidecar_v2(path: str, kind: str, magic: bytes, stamp: tuple, chunks):
+    tmp_path = f"{_sidecar_path_v2(path, kind)}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(SIDECAR_HEADER.pack(magic, *stamp))
+            f.writelines(chunks)
+        os.replace(tmp_path, _sidecar_path_v2(path, kind))
+    except OSError as e:
+        # rebuilt from metadata on the next load, a read-only imdb just pays that every time
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        print(f"Warning: could not store {kind} index of {path}: {e}")
+
+def _remove_sidecars_v2(path: str):
+    for kind in SIDECAR_KINDS:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(_sidecar_path_v2(path, kind))
+
+###
+# Tag index
+#
+# Every imdb file carries an inverted index from the comma separated tags of TAG_FIELDS to the
+# images holding them, kept in its identity index next to the mapper. Images are numbered in
+# mapper order of the last checkpoint and log inserts are numbered on from there, so posting
+# lists are sorted uint32 arrays that only ever get appended to; deletes and relabels clear the
+# image's bit in a liveness mask, relabels then number the image anew. A checkpoint stores its
+# postings in the <file>.tags sidecar and loading replays the log on top of them like it does
+# for the mapper. Sidecar payload:
+#   json size(4) | json {field: [[tag, count], ...]} | postings, uint32 little-endian, in json order
+# A segmented imdb queries every segment and overlays the journal; a v3 imdb keeps an image_tags
+# table instead.
+###
+TAG_FIELDS = ("prompt", "negative_prompt")
+TAGS_MAGIC = b"ITG2"
+
+def split_tags_v2(text: str) -> list[str]:
+    """
+    Tags of a prompt as img_metadata_v2 normalizes them: stripped, without empties or repeats.
+    """
+    if not isinstance(text, str):
+        return []
+    return [tag for tag in dict.fromkeys(tag.strip() for tag in text.split(",")) if tag]
+
+def _new_tags_v2(identities: list) -> dict:
+    return {
+        "docs": identities,
+        "doc_of": {identity: doc for doc, identity in enumerate(identities)},
+        "live": bytearray(b"\x01") * len(identities),
+        "postings": {field: {} for field in TAG_FIELDS},
+    }
+
+def _build_tags_v2(identities: list, metadata_df: pd.DataFrame) -> dict:
+    tags = _new_tags_v2(identities)
+    doc_of = tags["doc_of"]
+    docs = [doc_of.get(identity) for identity in metadata_df['identity'].tolist()]
+    for field in TAG_FIELDS:
+        if field not in metadata_df.columns:
+            continue
+        postings = {}
+        for doc, text in zip(docs, metadata_df[field].tolist()):
+            if doc is None:
+                continue
+            for tag in split_tags_v2(text):
+                postings.setdefault(tag, []).append(doc)
+        tags["postings"][field] = {tag: array("I", sorted(doc_list)) for tag, doc_list in postings.items()}
+    return tags
+
+def _tags_chunks_v2(tags: dict) -> list:
+    listing = {field: [[tag, len(doc_array)] for tag, doc_array in tags["postings"][field].items()] for field in TAG_FIELDS}
+    listing_bytes = json.dumps(listing, separators=(',', ':')).encode('utf-8')
+    chunks = [struct.pack("<I", len(listing_bytes)), listing_bytes]
+    for field in TAG_FIELDS:
+        chunks.extend(np.asarray(doc_array, dtype="<u4").tobytes() for doc_array in tags["postings"][field].values())
+    return chunks
+
+def _save_tags_v2(path: str, stamp: tuple, tags: dict):
+    _write_sidecar_v2(path, "tags", TAGS_MAGIC, stamp, _tags_chunks_v2(tags))
+
+def _load_tags_v2(path: str, f, stamp: tuple, identities: list) -> dict:
+    """
+    Tag index as of the checkpoint f's header points at: from the sidecar when it is current,
+    else built from the checkpointed metadata and stored for the next load.
+    """
+    data = _read_sidecar_v2(path, "tags", TAGS_MAGIC, stamp)
+    if data is not None:
+        tags = _new_tags_v2(identities)
+        listing_size, = struct.unpack_from("<I", data)
+        listing = json.loads(bytes(data[4:4 + listing_size]))
+        pos = 4 + listing_size
+        for field in TAG_FIELDS:
+            postings = tags["postings"][field]
+            for tag, count in listing[field]:
+                postings[tag] = array("I", np.frombuffer(data, dtype="<u4", count=count, offset=pos).astype(np.uint32).tobytes())
+                pos += 4 * count
+        return tags
+    metadata_df, _ = _read_metadata_section_v2(f, stamp[1], columns=["identity", *TAG_FIELDS])
+    tags = _build_tags_v2(identities, metadata_df)
+    if identities:
+        _save_tags_v2(path, stamp, tags)
+    return tags
+
+def _add_tag_doc_v2(tags: dict, identity: str, doc_tags: dict):
+    doc = len(tags["docs"])
+    for field, names in doc_tags.items():
+        postings = tags["postings"][field]
+        for tag in names:
+            if tag not in postings:
+                postings[tag] = array("I")
+            postings[tag].append(doc)
+    tags["docs"].append(identity)
+    tags["live"].append(1)
+    tags["doc_of"][identity] = doc
+
+def _doc_tags_v2(tags: dict, field: str, doc: int) -> list[str]:
+    """
+    Tags of one image in one field, found by probing every posting list; only relabels need it.
+    """
+    found = []
+    for tag, doc_array in list(tags["postings"][field].items()):
+        position = bisect.bisect_left(doc_array, doc)
+        if position < len(doc_array) and doc_array[position] == doc:
+            found.append(tag)
+    return found
+
+def _apply_tags_record_v2(tags: dict, kind: int, meta: dict):
+    if kind == LOG_INSERT:
+        _add_tag_doc_v2(tags, meta['identity'], {field: split_tags_v2(meta.get(field)) for field in TAG_FIELDS})
+        return
+    doc = tags["doc_of"].get(meta['identity'])
+    if doc is None:
+        return
+    if kind == LOG_DELETE:
+        del tags["doc_of"][meta['identity']]
+        tags["live"][doc] = 0
+    elif kind == LOG_UPDATE:
+        identity = meta.get('rekey', meta['identity'])
+        if not any(field in meta['values'] for field in TAG_FIELDS):
+            del tags["doc_of"][meta['identity']]
+            tags["docs"][doc] = identity
+            tags["doc_of"][identity] = doc
+            return
+        doc_tags = {
+            field: split_tags_v2(meta['values'][field]) if field in meta['values'] else _doc_tags_v2(tags, field, doc)
+            for field in TAG_FIELDS
+        }
+        del tags["doc_of"][meta['identity']]
+        tags["live"][doc] = 0
+        _add_tag_doc_v2(tags, identity, doc_tags)
+
+def _tag_mask_v2(tags: dict, field: str, names: list[str], size: int) -> np.ndarray:
+    mask = np.zeros(size, dtype=bool)
+    postings = tags["postings"][field]
+    for name in names:
+        doc_array = postings.get(name)
+        if doc_array is not None:
+            docs = np.array(doc_array, dtype=np.uint32)
+            mask[docs[:np.searchsorted(docs, size)]] = True
+    return mask
+
+def _live_mask_v2(tags: dict, hidden=()) -> np.ndarray:
+    live = np.frombuffer(bytes(tags["live"]), dtype=np.uint8).astype(bool)
+    doc_of = tags["doc_of"]
+    live[[doc for doc in (doc_of.get(identity) for identity in hidden) if doc is not None and doc < len(live)]] = False
+    return live
+
+def _tag_match_v2(tags: dict, include: dict, exclude: dict, hidden=()) -> list[str]:
+    """
+    Identities of the live images of one file passing include and exclude, leaving out hidden.
+    """
+    mask = _live_mask_v2(tags, hidden)
+    for field, names in include.items():
+        mask &= _tag_mask_v2(tags, field, names, len(mask))
+    for field, names in exclude.items():
+        mask &= ~_tag_mask_v2(tags, field, names, len(mask))
+    docs = tags["docs"]
+    return [docs[doc] for doc in np.flatnonzero(mask)]
+
+def _tag_counts_file_v2(tags: dict, field: str, hidden=()) -> dict:
+    live = _live_mask_v2(tags, hidden)
+    counts = {}
+    for tag, doc_array in list(tags["postings"][field].items()):
+        docs = np.array(doc_array, dtype=np.uint32)
+        count = int(np.count_nonzero(live[docs[:np.searchsorted(docs, len(live))]]))
+        if count:
+            counts[tag] = count
+    return counts
+
+def _tags_pass_v2(doc_tags: dict, include: dict, exclude: dict) -> bool:
+    return (
+        all(any(name in doc_tags[field] for name in names) for field, names in include.items())
+        and not any(any(name in doc_tags[field] for name in names) for field, names in exclude.items())
+    )
+
+def _journal_tag_overlay_v2(directory: str):
+    """
+    Journal entries that change what the tag index of their segment says: deletes and relabels
+    of a tag field, by original identity.
+    """
+    entries = _identity_index_v2(os.path.join(directory, JOURNAL_NAME))["journal"]["entries"]
+    changed = {
+        original: entry for original, entry in entries.items()
+        if entry["deleted"] or any(field in entry["values"] for field in TAG_FIELDS)
+    }
+    return entries, changed
+
+def _relabeled_docs_v2(tags: dict, changed: dict):
+    """
+    Yields (current identity, tags per field) of the relabeled images living in one segment.
+    """
+    for original, entry in changed.items():
+        doc = tags["doc_of"].get(original)
+        if doc is None or entry["deleted"]:
+            continue
+        yield entry["identity"], {
+            field: split_tags_v2(entry["values"][field]) if field in entry["values"] else _doc_tags_v2(tags, field, doc)
+            for field in TAG_FIELDS
+        }
+
+def _segments_tags_v2(directory: str):
+    while True:
+        manifest = _read_manifest_v2(directory)
+        try:
+            return [_segment_index_v2(directory, segment)["tags"] for segment in manifest["segments"]]
+        except FileNotFoundError:
+            if _read_manifest_v2(directory) is manifest:
+                raise
+
+def select_tags_v2(include: dict=None, exclude: dict=None) -> list[str]:
+    """
+    Identities of the images that carry, for every field of include, at least one of its tags and,
+    for every field of exclude, none of its tags, e.g. select_tags_v2({"prompt": ["1girl"]},
+    {"negative_prompt": ["blurry"]}). Answered from the tag index without reading metadata.
+    """
+    include = {field: split_tags_v2(",".join(names)) for field, names in (include or {}).items()}
+    exclude = {field: split_tags_v2(",".join(names)) for field, names in (exclude or {}).items()}
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.select_tags(include, exclude)
+    if not os.path.isdir(IMDB_PATH):
+        return _tag_match_v2(_identity_index_v2(IMDB_PATH)["tags"], include, exclude)
+    entries, changed = _journal_tag_overlay_v2(IMDB_PATH)
+    selected = []
+    for tags in _segments_tags_v2(IMDB_PATH):
+        for identity in _tag_match_v2(tags, include, exclude, changed):
+            entry = entries.get(identity)
+            selected.append(identity if entry is None else entry["identity"])
+        selected.extend(identity for identity, doc_tags in _relabeled_docs_v2(tags, changed) if _tags_pass_v2(doc_tags, include, exclude))
+    return selected
+
+def tag_counts_v2(field: str="prompt") -> dict[str, int]:
+    """
+    Returns tag -> number of images carrying it in one of TAG_FIELDS.
+    """
+    if field not in TAG_FIELDS:
+        raise ValueError(f"field must be one of {TAG_FIELDS}")
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.tag_counts(field)
+    if not os.path.isdir(IMDB_PATH):
+        return _tag_counts_file_v2(_identity_index_v2(IMDB_PATH)["tags"], field)
+    _, changed = _journal_tag_overlay_v2(IMDB_PATH)
+    counts = {}
+    for tags in _segments_tags_v2(IMDB_PATH):
+        for tag, count in _tag_counts_file_v2(tags, field, changed).items():
+            counts[tag] = counts.get(tag, 0) + count
+        for _, doc_tags in _relabeled_docs_v2(tags, changed):
+            for tag in doc_tags[field]:
+                counts[tag] = counts.get(tag, 0) + 1
+    return counts
+
+###
+# Content digests
+#
+# Image rows record content_digest, the BLAKE2b-256 of the image bytes as written. Every imdb
+# file indexes them as digest -> [blob location, references] in its identity index, kept like
+# the tag index: the <file>.digests sidecar holds the digest of every image in checkpoint mapper
+# order (zeros for none) and the log is replayed on top. An insert of content the file already
+# stores is logged with meta "blob": [offset, size] and no blob of its own, so its identity
+# shares the stored blob; deleting any of the sharing identities only drops a reference, and
+# vacuum_v2 keeps a blob for as long as one mapper entry points at it. Segments only share blobs
+# within themselves. Images stored before digests existed are hashed and merged by dedup_v2.
+###
+DIGESTS_MAGIC = b"IDG1"
+
+def content_digest_v2(img: bytes) -> str:
+    return hashlib.blake2b(img, digest_size=32).hexdigest()
+
+def _new_contents_v2() -> dict:
+    return {"by_digest": {}, "of": {}}
+
+def _add_content_ref_v2(contents: dict, identity: str, digest: str, location: tuple):
+    entry = contents["by_digest"].get(digest)
+    if entry is None:
+        contents["by_digest"][digest] = [location, 1]
+    else:
+        entry[1] += 1
+    contents["of"][identity] = digest
+
+def _drop_content_ref_v2(contents: dict, identity: str):
+    digest = contents["of"].pop(identity, None)
+    if digest is None:
+        return
+    entry = contents["by_digest"][digest]
+    entry[1] -= 1
+    if entry[1] == 0:
+        del contents["by_digest"][digest]
+
+def _build_contents_v2(mapper: dict, metadata_df: pd.DataFrame) -> dict:
+    contents = _new_contents_v2()
+    if "content_digest" not in metadata_df.columns:
+        return contents
+    for identity, digest in zip(metadata_df['identity'].tolist(), metadata_df['content_digest'].tolist()):
+        location = mapper.get(identity)
+        if isinstance(digest, str) and location is not None:
+            _add_content_ref_v2(contents, identity, digest, location)
+    return contents
+
+def _contents_chunks_v2(identities: list, contents: dict) -> list:
+    of = contents["of"]
+    empty = bytes(32)
+    return [b"".join(bytes.fromhex(of[identity]) if identity in of else empty for identity in identities)]
+
+def _save_contents_v2(path: str, stamp: tuple, identities: list, contents: dict):
+    _write_sidecar_v2(path, "digests", DIGESTS_MAGIC, stamp, _contents_chunks_v2(identities, contents))
+
+def _load_contents_v2(path: str, f, stamp: tuple, mapper: dict) -> dict:
+    data = _read_sidecar_v2(path, "digests", DIGESTS_MAGIC, stamp)
+    if data is not None and len(data) == 32 * len(mapper):
+        contents = _new_contents_v2()
+        digests = np.frombuffer(data, dtype=np.uint8).reshape(-1, 32)
+        identities = list(mapper)
+        for position in np.flatnonzero(digests.any(axis=1)):
+            identity = identities[position]
+            _add_content_ref_v2(contents, identity, digests[position].tobytes().hex(), mapper[identity])
+        return contents
+    metadata_df, _ = _read_metadata_section_v2(f, stamp[1], columns=["identity", "content_digest"])
+    contents = _build_contents_v2(mapper, metadata_df)
+    if mapper:
+        _save_contents_v2(path, stamp, list(mapper), contents)
+    return contents
+
+def _apply_contents_record_v2(contents: dict, mapper: dict, kind: int, meta: dict):
+    identity = meta['identity']
+    if kind == LOG_INSERT:
+        if isinstance(meta.get("content_digest"), str):
+            _add_content_ref_v2(contents, identity, meta["content_digest"], mapper[identity])
+    elif kind == LOG_DELETE:
+        _drop_content_ref_v2(contents, identity)
+    elif kind == LOG_UPDATE:
+        current = meta.get('rekey', identity)
+        digest = meta['values'].get("content_digest")
+        if isinstance(digest, str):
+            _drop_content_ref_v2(contents, identity)
+            if current in mapper:
+                _add_content_ref_v2(contents, current, digest, mapper[current])
+        elif identity in contents["of"] and current != identity:
+            contents["of"][current] = contents["of"].pop(identity)
+
+def _content_digest_of_v2(identity_hash: str):
+    """
+    Returns (known, digest) for an identity of IMDB_PATH, digest being None for images stored
+    without one.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        row = store.row(identity_hash, ["content_digest"])
+        return row is not None, None if row is None else row["content_digest"]
+    index, location = _locate_v2(identity_hash)
+    if location is None:
+        return False, None
+    if not os.path.isdir(IMDB_PATH):
+        return True, index["contents"]["of"].get(identity_hash)
+    journal = _identity_index_v2(os.path.join(IMDB_PATH, JOURNAL_NAME))["journal"]
+    original = journal["aliases"].get(identity_hash, identity_hash)
+    entry = journal["entries"].get(original)
+    if "journal" in index or (entry is not None and "content_digest" in entry["values"]):
+        return True, entry["values"].get("content_digest")
+    of = index["contents"]["of"]
+    return True, of.get(original) or of.get(identity_hash)
+
+def _content_known_v2(digest: str) -> bool:
+    """
+    Whether IMDB_PATH, as far as this thread can tell without locking, stores the content already.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        return store.find_content(digest) is not None
+    path = getattr(_SEGMENT_CLAIMS, "claims", {}).get(IMDB_PATH, (None,))[0] if os.path.isdir(IMDB_PATH) else IMDB_PATH
+    if path is None:
+        return False
+    try:
+        return digest in _identity_index_v2(path)["contents"]["by_digest"]
+    except FileNotFoundError:
+        return False
+
+def _share_blob_v2(contents: dict, batch_contents: dict, kind: int, meta: dict, blob: bytes):
+    """
+    Resolves an insert against the content index while its file is locked: content stored
+    already becomes a reference to that blob, anything else keeps its blob, encoded here when
+    _new_record_v2 left it raw expecting to share it.
+    """
+    if kind != LOG_INSERT:
+        return meta, blob
+    digest = meta.get("content_digest")
+    location = None
+    if isinstance(digest, str):
+        entry = None if contents is None else contents["by_digest"].get(digest)
+        location = entry[0] if entry is not None else batch_contents.get(digest)
+    if location is not None:
+        offset, size, codec = location[:3]
+        return {**meta, "codec": codec, "blob": [offset, size]}, b""
+    if "codec" in meta and meta["codec"] is None:
+        blob, codec = _encode_blob_v2(blob)
+        meta = {**meta, "codec": codec}
+    return meta, blob
+
+def _hash_blobs_v2(path: str, located: list, workers: int=None) -> dict:
+    """
+    Returns identity -> content digest for (identity, location) blobs of one file, read in
+    offset order, decoded and hashed on a thread pool (both release the GIL).
+    """
+    located = sorted(located, key=lambda item: item[1][0])
+    with open(path, "rb") as f:
+        def digest(item):
+            identity, (offset, size, codec) = item[0], item[1][:3]
+            return identity, content_digest_v2(_decode_blob_v2(os.pread(f.fileno(), size, offset), codec))
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            return dict(pool.map(digest, located, chunksize=64))
+
+def _dedup_file_v2(path: str, workers: int=None) -> dict:
+    index = _identity_index_v2(path)
+    known = index["contents"]["of"]
+    snapshot = {identity: location for identity, location in index["mapper"].items() if identity not in known}
+    digests = _hash_blobs_v2(path, list(snapshot.items()), workers)
+    with _path_lock_v2(path), open(path, "r+b") as f:
+        mapper, metadata_df, log_end, _ = _load_v2(f)
+        identities = metadata_df['identity'].tolist()
+        column = metadata_df['content_digest'].tolist() if "content_digest" in metadata_df.columns else [None] * len(identities)
+        hashed = 0
+        for position, identity in enumerate(identities):
+            # images rewritten while hashing keep waiting for the next pass
+            if not isinstance(column[position], str) and identity in digests and mapper.get(identity) == snapshot[identity]:
+                column[position] = digests[identity]
+                hashed += 1
+        metadata_df['content_digest'] = column
+        stored_before = sum(size for _, size in set(location[:2] for location in mapper.values()))
+        canonical = {}
+        shared = 0
+        for identity, digest in zip(identities, column):
+            location = mapper.get(identity)
+            if not isinstance(digest, str) or location is None:
+                continue
+            first = canonical.setdefault(digest, location)
+            if first[:2] != location[:2]:
+                mapper[identity] = first
+                shared += 1
+        stored_after = sum(size for _, size in set(location[:2] for location in mapper.values()))
+        _write_checkpoint_v2(path, f, mapper, metadata_df, log_end)
+    return {"hashed": hashed, "shared": shared, "freed_bytes": stored_before - stored_after}
+
+def dedup_v2(workers: int=None, vacuum: bool=True) -> dict:
+    """
+    One-off pass for imdbs written before content digests: hashes every image that has none,
+    records the digests and points all identities of equal content at one blob. Blobs left
+    without references are reclaimed by vacuum_v2, run right away unless vacuum is False.
+    Returns the images hashed, the images now sharing another's blob and the bytes freed.
+    """
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        stats = store.dedup(workers)
+    elif os.path.isdir(IMDB_PATH):
+        raise ValueError("A segmented imdb shares blobs within each segment as they are written; dedup_v2 takes single-file and v3 imdbs")
+    else:
+        stats = _dedup_file_v2(IMDB_PATH, workers)
+    if vacuum and stats["shared"]:
+        stats["vacuum"] = vacuum_v2()
+    return stats
+
+###
+# v3 catalog
+#
+# IMDB_PATH may also name a directory holding an imagineit_app.imdbv3 store, recognized by its
+# catalog.sqlite3. Records are built exactly as for v2 and handed to the store, which commits
+# them in one SQLite transaction each.
+###
+_V3_STORES = {}
+_V3_STORES_LOCK = threading.Lock()
+
+def _v3_store(path: str):
+    """
+    Returns the IMDBv3 store at path, shared per process, or None if path is not a v3 imdb.
+    """
+    store = _V3_STORES.get(path)
+    if store is not None or not os.path.isdir(path):
+        return store
+    from imagineit_app import imdbv3
+    if not imdbv3.is_imdbv3(path):
+        return None
+    with _V3_STORES_LOCK:
+        if path not in _V3_STORES:
+            _V3_STORES[path] = imdbv3.IMDBv3(path)
+        return _V3_STORES[path]
+
+def create_v3(path: str):
+    """
+    Creates an empty v3 imdb in the directory at path; pointing IMDB_PATH at it switches to v3.
+    """
+    from imagineit_app import imdbv3
+    imdbv3.IMDBv3(path).close()
+
+def _write_v3(store, identity_hash: str, uncompressed_img: bytes, values: dict) -> str:
+    if identity_hash is None:
+        new_metadata, blob = _new_record_v2(uncompressed_img, values)
+        store.apply([(LOG_INSERT, new_metadata, blob)])
+        return new_metadata['identity']
+    if not store.contains(identity_hash):
+        raise ValueError("No metadata found for image hash", identity_hash)
+    update, blob = _update_record_v2(identity_hash, uncompressed_img, values)
+    if not store.apply([(LOG_UPDATE, update, blob)])[0]:
+        raise ValueError("No metadata found for image hash", identity_hash)
+    return update.get("rekey", identity_hash)
+
+###
+# Bulk insert
+###
+WRITE_MANY_BATCH = 256
+
+def _append_many_v2(path: str, records: list):
+    store = _v3_store(path)
+    if store is not None:
+        # inserts of identities already present are skipped, which keeps resumed migrations idempotent
+        store.apply(records)
+        return
+    if os.path.isdir(path):
+        _ensure_segmented_v2(path)
+        return _append_inserts_segmented_v2(path, records)
+    with _path_lock_v2(path):
+        if not os.path.exists(path):
+            _create_v2(path)
+        _append_log_batch_v2(path, records)
+
+def write_many(records, workers: int=None) -> list[str]:
+    """
+    Inserts (image bytes, params) pairs, params holding write_v2's keyword arguments seed through
+    guidance_scale plus optionally labeled and label. Hashing and encoding run on a thread pool,
+    every WRITE_MANY_BATCH images are appended with one write, and metadata and mapper are
+    checkpointed once at the end. Returns the new identities in input order.
+    """
+    identities = []
+    records = iter(records)
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        while True:
+            batch = [record for _, record in zip(range(WRITE_MANY_BATCH), records)]
+            if not batch:
+                break
+            encoded = list(pool.map(lambda record: _new_record_v2(record[0], record[1]), batch))
+            _append_many_v2(IMDB_PATH, [(LOG_INSERT, meta, blob) for meta, blob in encoded])
+            identities.extend(meta['identity'] for meta, _ in encoded)
+    if identities:
+        checkpoint_v2()
+    return identities
+
+###
+# Group commit
+#
+# GroupCommitWriter takes write_v2-style calls from many threads. Hashing and blob encoding run
+# in the calling thread; the log records are then queued and a committer thread appends every
+# record that arrived within GROUP_COMMIT_WINDOW (or up to GROUP_COMMIT_MAX_ITEMS) with one
+# lock acquisition, one write and one flush. Callers block until their record is in the log.
+###
+GROUP_COMMIT_WINDOW = 0.005
+GROUP_COMMIT_MAX_ITEMS = 64
+
+def _validate_group_v2(batch: list, present) -> list:
+    """
+    Drops updates and deletes of identities that are gone by the time their turn comes, failing
+    their callers, and returns the remaining (kind, meta, blob) records in order.
+    """
+    state = {}
+    records = []
+    for item in batch:
+        kind, meta = item["kind"], item["meta"]
+        identity = meta['identity']
+        if kind == LOG_INSERT:
+            state[identity] = True
+        elif not state.get(identity, False) and (identity in state or not present(identity)):
+            item["error"] = ValueError("No metadata found for image hash", identity)
+            continue
+        elif kind == LOG_UPDATE:
+            state[identity] = False
+            state[meta.get('rekey', identity)] = True
+        else:
+            state[identity] = False
+        records.append((kind, meta, item["blob"]))
+    return records
+
+def _commit_group_v2(batch: list):
+    store = _v3_store(IMDB_PATH)
+    if store is not None:
+        applied = store.apply([(item["kind"], item["meta"], item["blob"]) for item in batch])
+        for item, ok in zip(batch, applied):
+            if not ok:
+                item["error"] = ValueError("No metadata found for image hash" if item["kind"] != LOG_INSERT else "Image hash already present", item["meta"]['identity'])
+        return
+    if os.path.isdir(IMDB_PATH):
+        return _commit_group_segmented_v2(IMDB_PATH, batch)
+    with GLOBAL_DATABASE_THREAD_LOCK:
+        if not os.path.exists(IMDB_PATH):
+            _create_v2(IMDB_PATH)
+        mapper = _identity_index_v2(IMDB_PATH)["mapper"]
+        records = _validate_group_v2(batch, lambda identity: identity in mapper)
+        _append_log_batch_v2(IMDB_PATH, records)
+
+def _commit_group_segmented_v2(directory: str, batch: list):
+    _ensure_segmented_v2(directory)
+    inserts = [(item["kind"], item["meta"], item["blob"]) for item in batch if item["kind"] == LOG_INSERT]
+    if inserts:
+        _append_inserts_segmented_v2(directory, inserts)
+    changes = [item for item in batch if item["kind"] != LOG_INSERT]
+    if changes:
+        journal_path = os.path.join(directory, JOURNAL_NAME)
+        with _flocked_v2(os.path.join(directory, "journal.lock")), _path_lock_v2(journal_path):
+            records = _validate_group_v2(changes, lambda identity: _locate_segmented_v2(directory, identity)[1] is not None)
+            if records:
+                _append_log_batch_v2(journal_path, records)
+
+class GroupCommitWriter:
+    """
+    Batches writes from concurrent threads into shared log appends. write() and delete() take the
+    same arguments as write_v2 and del_img_v2 and return what they would.
+    """
+
+    def __init__(self, window: float=GROUP_COMMIT_WINDOW, max_items: int=GROUP_COMMIT_MAX_ITEMS):
+        self.window = window
+        self.max_items = max_items
+        self._pending = []
+        self._condition = threading.Condition()
+        self._committer = None
+
+    def write(self, identity_hash: str, uncompressed_img: bytes=None, seed: int=None, prompt: str=None, negative_prompt: str=None, width: int=None, height: int=None, steps: int=None, guidance_scale: float=None, labeled: bool=None, label: str=None) -> str:
+        values = {
+            name: value for name, value in (
+                ("seed", seed), ("prompt", prompt), ("negative_prompt", negative_prompt), ("width", width),
+                ("height", height), ("steps", steps), ("guidance_scale", guidance_scale), ("labeled", labeled), ("label", label),
+            ) if value is not None
+        }
+        if identity_hash is None:
+            meta, blob = _new_record_v2(uncompressed_img, values)
+            self._submit(LOG_INSERT, meta, blob)
+            return meta['identity']
+        if _locate_v2(identity_hash)[1] is None:
+            raise ValueError("No metadata found for image hash", identity_hash)
+        update, blob = _update_record_v2(identity_hash, uncompressed_img, values)
+        self._submit(LOG_UPDATE, update, blob)
+        return update.get("rekey", identity_hash)
+
+    def delete(self, identity_hash: str) -> bool:
+        try:
+            self._submit(LOG_DELETE, {"identity": identity_hash}, b"")
+        except ValueError:
+            return False
+        return True
+
+    def _submit(self, kind: int, meta: dict, blob: bytes):
+        item = {"kind": kind, "meta": meta, "blob": blob, "done": threading.Event(), "error": None}
+        with self._condition:
+            self._pending.append(item)
+            if self._committer is None:
+                self._committer = threading.Thread(target=self._commit_loop, name="imdb-group-commit", daemon=True)
+                self._committer.start()
+            self._condition.notify()
+        item["done"].wait()
+        if item["error"] is not None:
+            raise item["error"]
+
+    def _commit_loop(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_items and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                batch = self._pending[:self.max_items]
+                del self._pending[:self.max_items]
+            try:
+                _commit_group_v2(batch)
+            except Exception as e:
+                for item in batch:
+                    if item["error"] is None:
+                        item["error"] = e
+            for item in batch:
+                item["done"].set()
 
 def load_img(hash: str):
     hash = hex(int(hash, 16))
@@ -370,21 +2500,61 @@ def load_metadata():
     with open(IMDB_PATH, "rb") as f:
         return read_metadata(f)
 
+###
+# Identity schemes
+#
+# An identity is "salt$digest" in hex, 16 and 32 bytes, as laid out in mapper records. The
+# digest covers the canonical json of the IDENTITY_FIELDS. Salts starting with
+# IDENTITY_BLAKE2B_TAG mark BLAKE2b digests keyed with the salt; any other salt is a legacy
+# identity digested with 100k rounds of PBKDF2-SHA256. Both kinds are read and verified side by
+# side, new images get IDENTITY_SCHEME and rekey_v2 converts legacy ones in bulk.
+###
+IDENTITY_PBKDF2 = 1
+IDENTITY_BLAKE2B = 2
+IDENTITY_SCHEME = IDENTITY_BLAKE2B
+IDENTITY_BLAKE2B_TAG = b"b2id"
+REKEY_BATCH = 4096
+
+def identity_version_v2(identity: str) -> int:
+    salt = bytes.fromhex(identity.split("$")[0])
+    return IDENTITY_BLAKE2B if salt.startswith(IDENTITY_BLAKE2B_TAG) else IDENTITY_PBKDF2
+
+def _identity_digest_v2(data_bytes: bytes, salt: bytes) -> bytes:
+    if salt.startswith(IDENTITY_BLAKE2B_TAG):
+        return hashlib.blake2b(data_bytes, digest_size=32, salt=salt).digest()
+    return hashlib.pbkdf2_hmac('sha256', data_bytes, salt, 100000)
+
+def _identity_data_v2(img_metadata: dict) -> bytes:
+    data_string = json.dumps({k:v for k, v in img_metadata.items() if k in IDENTITY_FIELDS}, sort_keys=True, separators=(',', ':'))
+    return data_string.encode('utf-8')
+
+def _new_identity_v2(img_metadata: dict, scheme: int=None) -> str:
+    if (scheme or IDENTITY_SCHEME) == IDENTITY_BLAKE2B:
+        salt = IDENTITY_BLAKE2B_TAG + os.urandom(16 - len(IDENTITY_BLAKE2B_TAG))
+    else:
+        salt = os.urandom(16)
+        while salt.startswith(IDENTITY_BLAKE2B_TAG):
+            salt = os.urandom(16)
+    return f"{salt.hex()}${_identity_digest_v2(_identity_data_v2(img_metadata), salt).hex()}"
+
 def identity_hash_validation_v2(hash: str, identity: str):
+    """
+    Whether identity is the digest of the hex encoded identity data in hash, under either scheme.
+    """
     salt, expected_hash = identity.split("$")
     salt = bytes.fromhex(salt)
     expected_hash = bytes.fromhex(expected_hash)
-    compare_identity = hashlib.pbkdf2_hmac('sha256', bytes.fromhex(hash), salt, 100000)
+    compare_identity = _identity_digest_v2(bytes.fromhex(hash), salt)
     return hmac.compare_digest(compare_identity, expected_hash)
 
-def img_metadata_v2(seed: int, prompt: str, negative_prompt: str, width: int, height: int, steps: int, guidance_scale: float) -> dict:
+def _identity_fields_v2(seed: int, prompt: str, negative_prompt: str, width: int, height: int, steps: int, guidance_scale: float) -> dict:
     if type(prompt) is float:
         prompt = ""
     if type(negative_prompt) is float:
         negative_prompt = ""
     prompt = ",".join([tag.strip() for tag in prompt.split(",")])
     negative_prompt = ",".join([tag.strip() for tag in negative_prompt.split(",")])
-    img_metadata = {
+    return {
         "seed": int(seed),
         "prompt": prompt,
         "negative_prompt": negative_prompt,
@@ -392,18 +2562,47 @@ def img_metadata_v2(seed: int, prompt: str, negative_prompt: str, width: int, he
         "height": int(height),
         "steps": int(steps),
         "guidance_scale": float(guidance_scale),
-        "labeled": False,
-        "label": prompt,
     }
+
+def img_metadata_v2(seed: int, prompt: str, negative_prompt: str, width: int, height: int, steps: int, guidance_scale: float) -> dict:
+    img_metadata = _identity_fields_v2(seed, prompt, negative_prompt, width, height, steps, guidance_scale)
+    img_metadata["labeled"] = False
+    img_metadata["label"] = img_metadata["prompt"]
     print(img_metadata)
-    data_string = json.dumps({k:v for k, v in img_metadata.items() if k in ["seed", "prompt", "negative_prompt", "width", "height", "steps", "guidance_scale"]}, sort_keys=True, separators=(',', ':'))
-    data_bytes = data_string.encode('utf-8')
-    salt = os.urandom(16)
-    sha256_hash = hashlib.pbkdf2_hmac('sha256', data_bytes, salt, 100000)
-    identity_hash = f"{salt.hex()}${sha256_hash.hex()}"
-    img_metadata["identity"] = identity_hash
+    img_metadata["identity"] = _new_identity_v2(img_metadata)
     return img_metadata
 
+def _rekey_row_v2(row: dict) -> str:
+    return _new_identity_v2(_identity_fields_v2(**row), IDENTITY_BLAKE2B)
+
+def rekey_v2(identity_hashes: list[str]=None, workers: int=None) -> dict:
+    """
+    Gives legacy PBKDF2 identities (all of them, or those listed) new BLAKE2b identities over
+    the same parameters. Digests are computed on a process pool and the renames appended in
+    batches of REKEY_BATCH. Returns old identity -> new identity.
+    """
+    metadata_df = read_metadata_v2(IDENTITY_FIELDS + ["identity"])
+    if identity_hashes is not None:
+        metadata_df = metadata_df[metadata_df['identity'].isin(identity_hashes)]
+    metadata_df = metadata_df[[identity_version_v2(identity) == IDENTITY_PBKDF2 for identity in metadata_df['identity']]]
+    rows = metadata_df[IDENTITY_FIELDS].to_dict("records")
+    rekeyed = {}
+    with ProcessPoolExecutor(workers) as pool:
+        new_identities = pool.map(_rekey_row_v2, rows, chunksize=256)
+        batch = []
+        for identity, new_identity in zip(metadata_df['identity'].tolist(), new_identities):
+            batch.append({"kind": LOG_UPDATE, "meta": {"identity": identity, "values": {}, "rekey": new_identity}, "blob": b"", "error": None})
+            if len(batch) == REKEY_BATCH:
+                _commit_group_v2(batch)
+                rekeyed.update((item["meta"]["identity"], item["meta"]["rekey"]) for item in batch if item["error"] is None)
+                batch = []
+        if batch:
+            _commit_group_v2(batch)
+            rekeyed.update((item["meta"]["identity"], item["meta"]["rekey"]) for item in batch if item["error"] is None)
+    if rekeyed:
+        checkpoint_v2()
+    return rekeyed
+
 # m = pd.read_csv("/Users/kitsui/workingspace/prune/imagineit_app/static/data/sd_images/metadata.csv")
 # for i, row in m.iterrows():
 #     hash = row['hash']
@@ -425,47 +2624,23 @@ def img_metadata_v2(seed: int, prompt: str, negative_prompt: str, width: int, he
 # with open("test.png", "wb") as f:
 #     f.write(img)
 
-# migration v1 -> v2
-# meta = load_metadata()
-# for data in meta.itertuples(index=True):
-#     IMDB_PATH = "data.imdb"
-#     img = load_img(data.hash)
-#     seed = data.seed
-#     prompt = data.prompt
-#     negative_prompt = data.negative_prompt
-#     width = data.width
-#     height = data.height
-#     steps = data.steps
-#     guidance_scale = data.guidance_scale
-#     IMDB_PATH = "datav2.imdb"
-#     write_v2(
-#         identity_hash=None,
-#         uncompressed_img=img,
-#         seed=seed,
-#         prompt=prompt,
-#         negative_prompt=negative_prompt,
-#         width=width,
-#         height=height,
-#         steps=steps,
-#         guidance_scale=guidance_scale
-#     )
+# migration v1 -> v2: python -m imagineit_app.migrate data.imdb datav2.imdb
 
-# h = "f7426c5305500f6257aa62c1b4f76a28d5fd6a54e43b8ca4b1977447174e3479"
 # metadata_df = pd.read_csv("/Users/kitsui/workingspace/prune/imagineit_app/static/data/sd_images/metadata.csv")
-# for entry in metadata_df.itertuples(index=True):
-#     with open(f"/Users/kitsui/workingspace/prune/imagineit_app/static/data/sd_images/{entry.hash}.png", "rb") as f:
-#         img = f.read()
-#     write_v2(
-#         identity_hash=None,
-#         uncompressed_img=img,
-#         seed=entry.seed,
-#         prompt=entry.prompt,
-#         negative_prompt=entry.negative_prompt,
-#         width=entry.width,
-#         height=entry.height,
-#         steps=entry.steps,
-#         guidance_scale=entry.guidance_scale
-#     )
+# def sd_images():
+#     for entry in metadata_df.itertuples(index=True):
+#         with open(f"/Users/kitsui/workingspace/prune/imagineit_app/static/data/sd_images/{entry.hash}.png", "rb") as f:
+#             img = f.read()
+#         yield img, {
+#             "seed": entry.seed,
+#             "prompt": entry.prompt,
+#             "negative_prompt": entry.negative_prompt,
+#             "width": entry.width,
+#             "height": entry.height,
+#             "steps": entry.steps,
+#             "guidance_scale": entry.guidance_scale,
+#         }
+# write_many(sd_images())
 
 # df = read_metadata_v2()
 # hashes = df['identity'].tolist()
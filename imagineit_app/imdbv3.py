@@ -1,12 +1,413 @@
+import os
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from imagineit_app.imdb import (
+    LOG_INSERT, LOG_UPDATE, LOG_DELETE, BLOB_ZLIB, IDENTITY_FIELDS, TAG_FIELDS, split_tags_v2, content_digest_v2,
+    _encode_blob_v2, _decode_blob_v2, _blob_runs_v2, _moved_offsets_v2, _kernel_copy_v2,
+)
+
+###
+# v3 layout
+#
+# A directory holding
+#   catalog.sqlite3   one row per image: metadata, insertion time and the blob's offset, size and
+#                     codec, indexed on identity, labeled, width/height and inserted_at
+#                     and the image_tags inverted index over the tags of TAG_FIELDS. Rows with
+#                     equal content_digest share one blob.
+#   blobs-NNNNNN.bin  append-only encoded images, in the same codecs as v2
+# A write appends its blobs while holding SQLite's write lock, makes them durable, then commits
+# the rows that point at them, so a crash leaves at most unreferenced bytes at the end of the
+# blob file. Deleted or replaced blobs stay in place until vacuum(), which writes the next
+# generation of the blob file and switches the catalog over to it in one transaction. Every
+# lookup reads the generation together with the location, so readers in any process always
+# pair an offset with the file it belongs to.
+###
+CATALOG_NAME = "catalog.sqlite3"
+METADATA_COLUMNS = IDENTITY_FIELDS + ["labeled", "label", "identity", "content_digest"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    identity TEXT NOT NULL UNIQUE,
+    seed INTEGER,
+    prompt TEXT,
+    negative_prompt TEXT,
+    width INTEGER,
+    height INTEGER,
+    steps INTEGER,
+    guidance_scale REAL,
+    labeled INTEGER NOT NULL DEFAULT 0,
+    label TEXT,
+    inserted_at REAL NOT NULL,
+    blob_offset INTEGER NOT NULL,
+    blob_size INTEGER NOT NULL,
+    codec INTEGER NOT NULL,
+    content_digest TEXT
+);
+CREATE INDEX IF NOT EXISTS images_labeled ON images (labeled);
+CREATE INDEX IF NOT EXISTS images_size ON images (width, height);
+CREATE INDEX IF NOT EXISTS images_inserted_at ON images (inserted_at);
+CREATE TABLE IF NOT EXISTS image_tags (
+    field TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    image_id INTEGER NOT NULL,
+    PRIMARY KEY (field, tag, image_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS image_tags_image ON image_tags (image_id);
+CREATE TABLE IF NOT EXISTS blob_file (generation INTEGER NOT NULL);
+INSERT INTO blob_file SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM blob_file);
+"""
+# PRAGMA user_version: 1 once image_tags covers every image, 2 once images has content_digest
+SCHEMA_VERSION = 2
+LOCATE_QUERY = "SELECT blob_offset, blob_size, codec, (SELECT generation FROM blob_file) FROM images WHERE identity = ?"
+
+def _blobs_name(generation: int) -> str:
+    return f"blobs-{generation:06d}.bin"
+
+def is_imdbv3(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, CATALOG_NAME))
 
 class IMDBv3:
+    """
+    SQLite catalog plus append-only blob file. Takes the (kind, meta, blob) records of the v2 log,
+    so imdb.py hashes and encodes exactly as for v2 and only hands storage over.
+    """
+
     def __init__(self, path):
         self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._local = threading.local()
+        self._blob_fds = {}
+        self._blob_fds_lock = threading.Lock()
+        db = self._db()
+        db.executescript(SCHEMA)
+        if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._upgrade(db)
+        db.execute("CREATE INDEX IF NOT EXISTS images_content ON images (content_digest)")
+        os.close(os.open(os.path.join(path, _blobs_name(self._generation(db))), os.O_RDWR | os.O_CREAT, 0o644))
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.path, CATALOG_NAME), isolation_level=None, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _upgrade(self, db):
+        """
+        Brings catalogs created by earlier versions up to SCHEMA_VERSION.
+        """
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                rows = db.execute(f"SELECT id, {', '.join(TAG_FIELDS)} FROM images").fetchall()
+                for image_id, *texts in rows:
+                    self._insert_tags(db, image_id, dict(zip(TAG_FIELDS, texts)))
+            if version < 2 and "content_digest" not in [row[1] for row in db.execute("PRAGMA table_info(images)")]:
+                db.execute("ALTER TABLE images ADD COLUMN content_digest TEXT")
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def _insert_tags(self, db, image_id: int, texts: dict):
+        db.executemany(
+            "INSERT OR IGNORE INTO image_tags (field, tag, image_id) VALUES (?, ?, ?)",
+            [(field, tag, image_id) for field, text in texts.items() for tag in split_tags_v2(text)],
+        )
+
+    def _generation(self, db) -> int:
+        return db.execute("SELECT generation FROM blob_file").fetchone()[0]
+
+    def _blob_fd(self, generation: int) -> int:
+        """
+        Descriptor of the blob file of a generation, kept open for the life of the store so readers
+        holding an older location can finish after vacuum() removed its file.
+        """
+        fd = self._blob_fds.get(generation)
+        if fd is None:
+            with self._blob_fds_lock:
+                fd = self._blob_fds.get(generation)
+                if fd is None:
+                    fd = self._blob_fds[generation] = os.open(os.path.join(self.path, _blobs_name(generation)), os.O_RDWR)
+        return fd
+
+    def _write_blob(self, fd: int, blob, offset: int):
+        view = memoryview(blob)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+    def apply(self, records: list) -> list:
+        """
+        Applies (kind, meta, blob) records in one transaction, in order. Returns per record whether
+        it applied; updates and deletes of unknown identities and duplicate inserts do not.
+        Inserts of content stored already point at that blob instead of writing theirs.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            fd = self._blob_fd(self._generation(db))
+            start = end = os.fstat(fd).st_size
+            applied = []
+            for kind, meta, blob in records:
+                location = None
+                if kind == LOG_INSERT and isinstance(meta.get("content_digest"), str):
+                    location = self.find_content(meta["content_digest"])
+                if location is None and len(blob) > 0:
+                    codec = meta.get("codec", BLOB_ZLIB)
+                    if codec is None:
+                        blob, codec = _encode_blob_v2(blob)
+                    self._write_blob(fd, blob, end)
+                    location = (end, len(blob), codec)
+                    end += len(blob)
+                if kind == LOG_INSERT:
+                    row = {name: meta.get(name) for name in METADATA_COLUMNS}
+                    row["labeled"] = bool(row["labeled"])
+                    row["content_digest"] = row["content_digest"] if isinstance(row["content_digest"], str) else None
+                    try:
+                        cursor = db.execute(
+                            f"INSERT INTO images ({', '.join(row)}, inserted_at, blob_offset, blob_size, codec) "
+                            f"VALUES ({', '.join('?' * len(row))}, ?, ?, ?, ?)",
+                            [*row.values(), time.time(), *location],
+                        )
+                        self._insert_tags(db, cursor.lastrowid, {field: row[field] for field in TAG_FIELDS})
+                        applied.append(True)
+                    except sqlite3.IntegrityError:
+                        applied.append(False)
+                elif kind == LOG_UPDATE:
+                    values = {name: value for name, value in meta["values"].items() if name in METADATA_COLUMNS}
+                    values["identity"] = meta.get("rekey", meta["identity"])
+                    if location is not None:
+                        values.update(blob_offset=location[0], blob_size=location[1], codec=location[2])
+                    cursor = db.execute(
+                        f"UPDATE images SET {', '.join(f'{name} = ?' for name in values)} WHERE identity = ?",
+                        [*values.values(), meta["identity"]],
+                    )
+                    applied.append(cursor.rowcount == 1)
+                    retagged = {field: values[field] for field in TAG_FIELDS if field in values}
+                    if cursor.rowcount == 1 and retagged:
+                        image_id = db.execute("SELECT id FROM images WHERE identity = ?", (values["identity"],)).fetchone()[0]
+                        db.executemany("DELETE FROM image_tags WHERE field = ? AND image_id = ?", [(field, image_id) for field in retagged])
+                        self._insert_tags(db, image_id, retagged)
+                elif kind == LOG_DELETE:
+                    db.execute("DELETE FROM image_tags WHERE image_id = (SELECT id FROM images WHERE identity = ?)", (meta["identity"],))
+                    applied.append(db.execute("DELETE FROM images WHERE identity = ?", (meta["identity"],)).rowcount == 1)
+            if end > start:
+                os.fdatasync(fd)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return applied
+
+    def find_content(self, digest: str):
+        """
+        Location (offset, size, codec) of a stored blob with the given content digest, or None.
+        """
+        return self._db().execute("SELECT blob_offset, blob_size, codec FROM images WHERE content_digest = ? LIMIT 1", (digest,)).fetchone()
+
+    def dedup(self, workers: int=None) -> dict:
+        """
+        Hashes the images stored without a content digest, then points every row at the first
+        blob of its content. The blobs given up are reclaimed by vacuum().
+        """
+        db = self._db()
+        rows = db.execute("SELECT id, blob_offset, blob_size, codec, (SELECT generation FROM blob_file) FROM images WHERE content_digest IS NULL ORDER BY blob_offset").fetchall()
+        def digest(row):
+            image_id, offset, size, codec, generation = row
+            return image_id, offset, size, generation, content_digest_v2(_decode_blob_v2(os.pread(self._blob_fd(generation), size, offset), codec))
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            digests = list(pool.map(digest, rows, chunksize=64))
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            generation = self._generation(db)
+            # rows whose blob moved or changed while hashing keep waiting for the next pass
+            hashed = db.executemany(
+                "UPDATE images SET content_digest = ? WHERE id = ? AND blob_offset = ? AND blob_size = ? AND content_digest IS NULL",
+                [(content, image_id, offset, size) for image_id, offset, size, row_generation, content in digests if row_generation == generation],
+            ).rowcount
+            stored_bytes = "SELECT COALESCE(SUM(blob_size), 0) FROM (SELECT DISTINCT blob_offset, blob_size FROM images)"
+            stored_before = db.execute(stored_bytes).fetchone()[0]
+            canonical = {}
+            moves = []
+            for image_id, content, offset, size, codec in db.execute("SELECT id, content_digest, blob_offset, blob_size, codec FROM images WHERE content_digest IS NOT NULL ORDER BY id"):
+                first = canonical.setdefault(content, (offset, size, codec))
+                if first[:2] != (offset, size):
+                    moves.append((*first, image_id))
+            db.executemany("UPDATE images SET blob_offset = ?, blob_size = ?, codec = ? WHERE id = ?", moves)
+            stored_after = db.execute(stored_bytes).fetchone()[0]
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return {"hashed": hashed, "shared": len(moves), "freed_bytes": stored_before - stored_after}
+
+    def __len__(self) -> int:
+        return self._db().execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def contains(self, identity: str) -> bool:
+        return self._db().execute("SELECT 1 FROM images WHERE identity = ?", (identity,)).fetchone() is not None
+
+    def row(self, identity: str, columns: list[str]=None) -> dict:
+        columns = columns or METADATA_COLUMNS
+        found = self._db().execute(f"SELECT {', '.join(columns)} FROM images WHERE identity = ?", (identity,)).fetchone()
+        if found is None:
+            return None
+        row = dict(zip(columns, found))
+        if "labeled" in row:
+            row["labeled"] = bool(row["labeled"])
+        return row
+
+    def locate(self, identity: str):
+        """
+        Returns (offset, size, codec) of the stored blob, or None if the identity is unknown.
+        """
+        location = self._db().execute(LOCATE_QUERY, (identity,)).fetchone()
+        return None if location is None else location[:3]
+
+    def _read_located(self, identity: str):
+        while True:
+            location = self._db().execute(LOCATE_QUERY, (identity,)).fetchone()
+            if location is None:
+                return None
+            offset, size, codec, generation = location
+            try:
+                return os.pread(self._blob_fd(generation), size, offset), codec
+            except FileNotFoundError:
+                # vacuumed by another process since the lookup, look it up again
+                continue
+
+    def read_blob(self, identity: str):
+        return self._read_located(identity)
+
+    def read_blobs(self, identities):
+        """
+        Yields (identity, blob, codec) in blob file order; unknown identities come first with None.
+        """
+        located = []
+        for identity in dict.fromkeys(identities):
+            location = self._db().execute(LOCATE_QUERY, (identity,)).fetchone()
+            if location is None:
+                yield identity, None, None
+                continue
+            located.append((location[3], location[0], location[1], location[2], identity))
+        located.sort()
+        for generation, offset, size, codec, identity in located:
+            try:
+                blob = os.pread(self._blob_fd(generation), size, offset)
+            except FileNotFoundError:
+                yield identity, *(self._read_located(identity) or (None, None))
+                continue
+            yield identity, blob, codec
+
+    def read_metadata(self, columns: list[str]=None) -> pd.DataFrame:
+        columns = [name for name in (columns or METADATA_COLUMNS) if name in METADATA_COLUMNS]
+        rows = self._db().execute(f"SELECT {', '.join(columns)} FROM images ORDER BY id").fetchall()
+        metadata_df = pd.DataFrame(rows, columns=columns)
+        if "labeled" in metadata_df.columns:
+            metadata_df["labeled"] = metadata_df["labeled"].astype(bool)
+        return metadata_df
+
+    def select(self, labeled: bool=None, width: int=None, height: int=None, since: float=None, until: float=None, limit: int=None) -> list[str]:
+        """
+        Identities matching all given filters, oldest first, answered from the catalog indexes.
+        """
+        clauses, params = [], []
+        for clause, value in (("labeled = ?", labeled), ("width = ?", width), ("height = ?", height), ("inserted_at >= ?", since), ("inserted_at < ?", until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        query = "SELECT identity FROM images"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY inserted_at, id"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return [identity for identity, in self._db().execute(query, params)]
+
+    def select_tags(self, include: dict, exclude: dict) -> list[str]:
+        """
+        Identities carrying, per include field, any of its tags and, per exclude field, none of them.
+        """
+        clauses, params = [], []
+        for negate, filters in (("", include), ("NOT ", exclude)):
+            for field, names in filters.items():
+                clauses.append(f"id {negate}IN (SELECT image_id FROM image_tags WHERE field = ? AND tag IN ({', '.join('?' * len(names))}))")
+                params.extend([field, *names])
+        query = "SELECT identity FROM images"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        return [identity for identity, in self._db().execute(query + " ORDER BY id", params)]
+
+    def tag_counts(self, field: str) -> dict:
+        return dict(self._db().execute("SELECT tag, COUNT(*) FROM image_tags WHERE field = ? GROUP BY tag", (field,)))
+
+    def mapper(self) -> dict:
+        return {identity: (offset, size, codec) for identity, offset, size, codec in self._db().execute("SELECT identity, blob_offset, blob_size, codec FROM images")}
+
+    def fragmentation(self) -> dict:
+        db = self._db()
+        db.execute("BEGIN")
+        try:
+            live_images = db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+            live_bytes = db.execute("SELECT COALESCE(SUM(blob_size), 0) FROM (SELECT DISTINCT blob_offset, blob_size FROM images)").fetchone()[0]
+            blob_bytes = os.fstat(self._blob_fd(self._generation(db))).st_size
+        finally:
+            db.execute("COMMIT")
+        catalog_bytes = os.path.getsize(os.path.join(self.path, CATALOG_NAME))
+        return {
+            "file_bytes": blob_bytes + catalog_bytes,
+            "live_images": live_images,
+            "live_bytes": live_bytes,
+            "catalog_bytes": catalog_bytes,
+            "dead_bytes": blob_bytes - live_bytes,
+            "fragmentation": (blob_bytes - live_bytes) / blob_bytes if blob_bytes else 0.0,
+        }
 
-    def write(self, data):
-        with open(self.path, 'a') as f:
-            f.write(data + '\n')
+    def vacuum(self) -> dict:
+        """
+        Copies the live blobs into the next generation of the blob file and repoints the catalog in
+        the same transaction, then removes the old file. Writers wait for it; readers do not.
+        """
+        before = self.fragmentation()
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            generation = self._generation(db)
+            new_path = os.path.join(self.path, _blobs_name(generation + 1))
+            rows = db.execute("SELECT id, blob_offset, blob_size FROM images").fetchall()
+            locations = [(offset, size) for _, offset, size in rows]
+            runs = _blob_runs_v2(locations)
+            run_offsets = {}
+            with open(new_path, "wb") as dst:
+                pos = 0
+                for run_start, run_end in runs:
+                    _kernel_copy_v2(self._blob_fd(generation), dst.fileno(), run_start, pos, run_end - run_start)
+                    run_offsets[run_start] = pos
+                    pos += run_end - run_start
+                os.fsync(dst.fileno())
+            moved = _moved_offsets_v2(locations, runs, run_offsets)
+            db.executemany("UPDATE images SET blob_offset = ? WHERE id = ?", [(moved[(offset, size)], id) for id, offset, size in rows])
+            db.execute("UPDATE blob_file SET generation = ?", (generation + 1,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        os.remove(os.path.join(self.path, _blobs_name(generation)))
+        return {"before": before, "after": self.fragmentation()}
 
-    def read(self):
-        with open(self.path, 'r') as f:
-            return f.readlines()
\ No newline at end of file
+    def close(self):
+        with self._blob_fds_lock:
+            for fd in self._blob_fds.values():
+                os.close(fd)
+            self._blob_fds.clear()
@@ -11,7 +11,7 @@ import threading
 import time
 from uuid import uuid4
 
-from imagineit_app.imdb import write_v2, GLOBAL_DATABASE_THREAD_LOCK
+from imagineit_app.imdb import GroupCommitWriter
 
 class SDXLInferenceHelper:
     """
@@ -22,6 +22,7 @@ class SDXLInferenceHelper:
         self._pipes: list[StableDiffusionXLPipeline] = None
         self._pipe_free_flag: list[threading.Event] = []
         self._requests = {}
+        self._writer = GroupCommitWriter()
         self.status = {
             "loaded_model": "None",
             "loaded_loras": [],
@@ -100,9 +101,9 @@ class SDXLInferenceHelper:
         ).images[0]
         image_bytes = BytesIO()
         image.save(image_bytes, format="PNG")
-        with GLOBAL_DATABASE_THREAD_LOCK:
-            img_hash = write_v2(None, image_bytes.getvalue(), seed, prompt, negative_prompt, width, height, steps, guidance_scale)
         self._pipe_free_flag[available_pipe].clear()
+        # images finishing together on several GPUs are committed in one append
+        img_hash = self._writer.write(None, image_bytes.getvalue(), seed, prompt, negative_prompt, width, height, steps, guidance_scale)
         self._requests[reference] = {
             "status": "completed",
             "result": img_hash,
@@ -0,0 +1,282 @@
+"""
+Moves images between imdb formats:
+
+    python -m imagineit_app.migrate data.imdb datav2.imdb                  # v1 -> v2
+    python -m imagineit_app.migrate datav2.imdb imdb_dir/ --segmented     # v2 -> segmented v2
+    python -m imagineit_app.migrate datav2.imdb imdb_v3/ --to v3           # v2 -> v3 catalog
+
+The source is streamed in batches. v1 blobs are inflated, hashed and re-encoded on a process
+pool; v2 blobs keep their identity and encoding and are copied as they are. Every batch is
+committed with one append, and progress is kept next to the destination in
+<dst>.migration.json so an interrupted run picks up where it stopped when started again.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from imagineit_app import imdb
+from imagineit_app.imdbv3 import IMDBv3, is_imdbv3
+
+MIGRATION_BATCH = 1024
+
+###
+# Sources
+#
+# A source yields work items in a fixed order and names the function that turns an item into
+# (insert meta, blob) on a worker. items(start) begins at the start-th item, so a resumed run
+# skips the ones already migrated without reading their blobs again.
+###
+def detect_format(path: str) -> str:
+    if os.path.isdir(path):
+        return "v3" if is_imdbv3(path) else "v2"
+    with open(path, "rb") as f:
+        head = f.read(5)
+    # v1 starts with a u32 metadata size followed by a zlib stream, v2 with a u64 offset
+    return "v1" if len(head) == 5 and head[4] == 0x78 else "v2"
+
+def _prepare_v1(item):
+    compressed, params = item
+    meta = imdb._identity_fields_v2(**params)
+    meta["labeled"] = False
+    meta["label"] = meta["prompt"]
+    meta["identity"] = imdb._new_identity_v2(meta)
+    img = zlib.decompress(compressed)
+    meta["content_digest"] = imdb.content_digest_v2(img)
+    blob, meta["codec"] = imdb._encode_blob_v2(img)
+    return meta, blob
+
+def _prepare_v2(item):
+    return item
+
+class V1Source:
+    prepare = staticmethod(_prepare_v1)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def items(self, start: int=0):
+        with open(self.path, "rb") as f:
+            metadata_df = imdb.read_metadata(f)
+            metadata_end = imdb.metadata_size(f)
+            f.seek(metadata_end)
+            mapper = imdb.read_mapper(f)
+            blob_start = metadata_end + imdb.mapper_size(f) + 8
+            for row in metadata_df.to_dict("records")[start:]:
+                location = mapper.get(hex(int(str(row["hash"]), 16)))
+                if location is None:
+                    yield None
+                    continue
+                index, size = location
+                f.seek(blob_start + index)
+                yield f.read(size), {name: row[name] for name in imdb.IDENTITY_FIELDS}
+
+class V2Source:
+    """
+    Single-file or segmented v2 imdb, read in file and offset order.
+    """
+    prepare = staticmethod(_prepare_v2)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def items(self, start: int=0):
+        if os.path.isdir(self.path):
+            metadata_df = imdb._read_segmented_metadata_v2(self.path)
+            locate = lambda identity: imdb._locate_segmented_v2(self.path, identity)
+        else:
+            with open(self.path, "rb") as f:
+                _, metadata_df, _, _ = imdb._load_v2(f)
+            index = imdb._identity_index_v2(self.path)
+            locate = lambda identity: (index, index["mapper"].get(identity))
+        rows = []
+        for row in metadata_df.to_dict("records"):
+            index, location = locate(row["identity"])
+            if location is not None:
+                rows.append((index["path"], location, row))
+        rows.sort(key=lambda item: (item[0], item[1][0]))
+        files = {}
+        try:
+            for path, (offset, size, codec), row in rows[start:]:
+                if path not in files:
+                    files[path] = open(path, "rb")
+                yield {**row, "codec": codec}, os.pread(files[path].fileno(), size, offset)
+        finally:
+            for f in files.values():
+                f.close()
+
+class V3Source:
+    """
+    v3 catalog, read in blob file order.
+    """
+    prepare = staticmethod(_prepare_v2)
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def items(self, start: int=0):
+        store = IMDBv3(self.path)
+        try:
+            rows = {row["identity"]: row for row in store.read_metadata().to_dict("records")}
+            # the order read_blobs reads in, found from the catalog alone
+            located = sorted((location, identity) for identity, location in ((identity, store.locate(identity)) for identity in rows) if location is not None)
+            for identity, blob, codec in store.read_blobs([identity for _, identity in located[start:]]):
+                if blob is not None:
+                    yield {**rows[identity], "codec": codec}, blob
+        finally:
+            store.close()
+
+SOURCES = {"v1": V1Source, "v2": V2Source, "v3": V3Source}
+
+###
+# Sinks
+###
+class V2Sink:
+    """
+    Single-file v2 imdb, or a segmented one when segment_bytes is given or path is a directory.
+    """
+
+    def __init__(self, path: str, segment_bytes: int=None):
+        self.path = path
+        if segment_bytes is not None:
+            imdb.create_segmented_v2(path, segment_bytes)
+
+    def count(self) -> int:
+        if os.path.isdir(self.path):
+            if not os.path.exists(os.path.join(self.path, imdb.MANIFEST_NAME)):
+                return 0
+            return len(imdb._read_segmented_mapper_v2(self.path))
+        if not os.path.exists(self.path):
+            return 0
+        return len(imdb._identity_index_v2(self.path)["mapper"])
+
+    def write(self, records: list):
+        imdb._append_many_v2(self.path, [(imdb.LOG_INSERT, meta, blob) for meta, blob in records])
+
+    def close(self):
+        if os.path.exists(self.path):
+            imdb._checkpoint_imdb_v2(self.path)
+
+class V3Sink:
+    """
+    v3 catalog directory, created if missing. Identities and encoded blobs are kept as they are.
+    """
+
+    def __init__(self, path: str, segment_bytes: int=None):
+        if segment_bytes is not None:
+            raise ValueError("A v3 imdb is not segmented")
+        self.path = path
+        imdb.create_v3(path)
+
+    def count(self) -> int:
+        return len(imdb._v3_store(self.path))
+
+    def write(self, records: list):
+        imdb._append_many_v2(self.path, [(imdb.LOG_INSERT, meta, blob) for meta, blob in records])
+
+    def close(self):
+        pass
+
+SINKS = {"v2": V2Sink, "v3": V3Sink}
+
+###
+# Progress
+#
+# <dst>.migration.json holds the number of source items consumed and images written, plus the
+# position a batch will reach, stored before the batch is committed. On restart the image count
+# of the destination tells whether that batch made it in.
+###
+def _progress_path(dst: str) -> str:
+    return dst.rstrip(os.sep) + ".migration.json"
+
+def _load_progress(dst: str, src: str, sink) -> dict:
+    path = _progress_path(dst)
+    if os.path.exists(path):
+        with open(path) as f:
+            progress = json.load(f)
+        if progress["source"] != os.path.abspath(src):
+            raise ValueError(f"{path} belongs to a migration from {progress['source']}")
+        pending = progress.pop("pending", None)
+        if pending is not None and sink.count() - progress["baseline"] == pending["written"]:
+            progress.update(pending)
+        return progress
+    return {"source": os.path.abspath(src), "baseline": sink.count(), "consumed": 0, "written": 0, "skipped": 0}
+
+def _save_progress(dst: str, progress: dict):
+    path = _progress_path(dst)
+    with open(path + ".tmp", "w") as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def _batches(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def migrate(src: str, dst: str, src_format: str=None, dst_format: str="v2", workers: int=None, batch_size: int=MIGRATION_BATCH, segment_bytes: int=None, report=print) -> dict:
+    """
+    Copies every image of src into dst, resuming a previous run into the same dst. Returns and
+    reports throughput: items, images written, bytes written and seconds taken.
+    """
+    source = SOURCES[src_format or detect_format(src)](src)
+    sink = SINKS[dst_format](dst, segment_bytes=segment_bytes)
+    progress = _load_progress(dst, src, sink)
+    if progress["consumed"]:
+        report(f"resuming after {progress['consumed']} items ({progress['written']} images written)")
+    items = source.items(progress["consumed"])
+    start = time.perf_counter()
+    stats = {"items": 0, "images": 0, "bytes": 0}
+    with ProcessPoolExecutor(workers) as pool:
+        for batch in _batches(items, batch_size):
+            present = [item for item in batch if item is not None]
+            if source.prepare is _prepare_v2:
+                records = present
+            else:
+                records = list(pool.map(source.prepare, present, chunksize=max(1, len(present) // (4 * (workers or os.cpu_count())))))
+            pending = {
+                "consumed": progress["consumed"] + len(batch),
+                "written": progress["written"] + len(records),
+                "skipped": progress["skipped"] + len(batch) - len(present),
+            }
+            _save_progress(dst, {**progress, "pending": pending})
+            sink.write(records)
+            progress.update(pending)
+            _save_progress(dst, progress)
+            stats["items"] += len(batch)
+            stats["images"] += len(records)
+            stats["bytes"] += sum(len(blob) for _, blob in records)
+            elapsed = time.perf_counter() - start
+            report(f"{progress['consumed']} items, {stats['images'] / elapsed:.0f} images/s, {stats['bytes'] / elapsed / 2**20:.1f} MiB/s")
+    sink.close()
+    stats["seconds"] = time.perf_counter() - start
+    stats["skipped"] = progress["skipped"]
+    os.remove(_progress_path(dst))
+    report(f"migrated {stats['images']} images ({stats['bytes'] / 2**20:.1f} MiB) in {stats['seconds']:.1f}s, {progress['skipped']} skipped")
+    return stats
+
+def main(argv: list[str]=None):
+    parser = argparse.ArgumentParser(description="Migrate images between imdb formats.")
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    parser.add_argument("--from", dest="src_format", choices=sorted(SOURCES), help="source format, detected when omitted")
+    parser.add_argument("--to", dest="dst_format", choices=sorted(SINKS), default="v2")
+    parser.add_argument("--segmented", action="store_true", help="write a segmented v2 imdb into the dst directory")
+    parser.add_argument("--segment-bytes", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch", type=int, default=MIGRATION_BATCH)
+    args = parser.parse_args(argv)
+    segment_bytes = args.segment_bytes or (imdb.SEGMENT_BYTES if args.segmented else None)
+    migrate(args.src, args.dst, args.src_format, args.dst_format, args.workers, args.batch, segment_bytes)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
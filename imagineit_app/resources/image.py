@@ -1,31 +1,198 @@
 
-from io import BytesIO
-from PIL import Image
+import asyncio
+import hashlib
 
-from fastapi import APIRouter
-from fastapi.responses import Response
+from fastapi import APIRouter, Header, Query
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 
 from imagineit_app.imdb import read_img_v2
+from imagineit_app.thumbnails import read_rendition, rendition_quality, source_key, TransformPoolBusy, RENDITION_CACHE, RENDITION_FORMATS, RENDITION_MEDIA_TYPES, TRANSFORM_POOL, DOWNSCALE_TIER, DOWNSCALE_TIERS, MAX_THUMBNAIL_LEVEL
 
 router = APIRouter()
 
+###
+# Conditional requests
+#
+# Every rendition gets a strong ETag derived from the source key of its image (its content digest,
+# see thumbnails.source_key) and the rendition alone, so it may be cached for good: an image
+# replaced under its identity gets new ETags. A matching If-None-Match is answered with 304 after
+# looking up the metadata only.
+###
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def image_etag(source: str, *rendition) -> str:
+    key = "/".join(str(part) for part in (source, *rendition))
+    return '"' + hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest() + '"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match compares weakly
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def cached_response(etag: str, content: bytes=None, media_type: str="image/png", bytes_saved: int=None) -> Response:
+    """
+    The image with caching headers, or 304 Not Modified without content.
+    """
+    # the format of level 1 and up depends on Accept
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL, "Vary": "Accept"}
+    if content is None:
+        return Response(status_code=304, headers=headers)
+    if bytes_saved is not None:
+        headers["X-Bytes-Saved"] = str(bytes_saved)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+###
+# Format negotiation
+###
+# preferred first when Accept ranks several equally
+LOSSY_PREFERENCE = ("avif", "webp", "jpeg")
+
+def negotiate_format(accept: str, format: str=None) -> str:
+    """
+    Format of a level 1 and up rendition: the one asked for, else the lossy format Accept ranks
+    highest by name (wildcards keep PNG), else PNG. None for a format that cannot be served.
+    """
+    if format is not None:
+        format = {"jpg": "jpeg"}.get(format.lower(), format.lower())
+        return format if format in RENDITION_FORMATS else None
+    accepted = {}
+    for part in (accept or "").split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[media_type.lower()] = q
+    candidates = [name for name in LOSSY_PREFERENCE if name in RENDITION_FORMATS and accepted.get(RENDITION_MEDIA_TYPES[name], 0) > 0]
+    if not candidates:
+        return "png"
+    return max(candidates, key=lambda name: accepted[RENDITION_MEDIA_TYPES[name]])
+
+###
+# Originals
+#
+# Level 0 is the stored image itself. A raw blob is served straight from the shared mapping of
+# the imdb without decoding or copying it up front, and single byte ranges are honored.
+###
+ORIGINAL_CHUNK_SIZE = 1 << 20
+MEDIA_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"), (b"\xff\xd8\xff", "image/jpeg"), (b"GIF8", "image/gif"),
+    (b"\x00\x00\x00\x0cjXL ", "image/jxl"), (b"\xff\x0a", "image/jxl"),
+)
+
+def sniff_media_type(img) -> str:
+    head = bytes(img[:12])
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return next((media_type for signature, media_type in MEDIA_SIGNATURES if head.startswith(signature)), "application/octet-stream")
+
+def parse_range(byte_range: str, size: int):
+    """
+    Inclusive (start, end) of a single "bytes=" range, or None to send everything: no range,
+    several of them or one that does not parse. Raises ValueError for an unsatisfiable range.
+    """
+    if byte_range is None or not byte_range.startswith("bytes=") or "," in byte_range:
+        return None
+    first, _, last = byte_range[6:].strip().partition("-")
+    if not all(bound == "" or bound.isdigit() for bound in (first, last)) or first == last == "":
+        return None
+    if first == "":
+        start, end = max(0, size - int(last)), size - 1
+        if int(last) == 0:
+            start = size
+    else:
+        start = int(first)
+        end = size - 1 if last == "" else min(int(last), size - 1)
+    if start >= size or end < start:
+        raise ValueError(f"range {byte_range} outside of {size} bytes")
+    return start, end
+
+def _stream_view(view, start: int, end: int):
+    for pos in range(start, end + 1, ORIGINAL_CHUNK_SIZE):
+        yield bytes(view[pos:min(pos + ORIGINAL_CHUNK_SIZE, end + 1)])
+
+async def original_response(identity_hash: str, etag: str, byte_range: str=None, if_range: str=None) -> Response:
+    """
+    The stored image of identity_hash, or the requested part of it, or None if it is unknown.
+    """
+    # locating the blob may load the identity index or a v3 row
+    img = await asyncio.to_thread(read_img_v2, identity_hash)
+    if img is None:
+        return None
+    view = memoryview(img)
+    size = len(view)
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    # an If-Range naming another version asks for the whole image
+    try:
+        part = parse_range(byte_range, size) if if_range is None or if_range.strip() == etag else None
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    status_code = 200
+    start, end = 0, size - 1
+    if part is not None:
+        start, end = part
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_stream_view(view, start, end), status_code=status_code, media_type=sniff_media_type(view), headers=headers)
+
+async def image_response(identity_hash: str, level: int, format: str=None, quality: int=None, accept: str=None, if_none_match: str=None, byte_range: str=None, if_range: str=None, tier: str=None) -> Response:
+    """
+    Response for a rendition request: 304 when the client holds it already, 406 for a format that
+    cannot be served, 503 when the transform pool is full, None when the identity is unknown.
+    Level 0 is the original as stored.
+    """
+    source = await asyncio.to_thread(source_key, identity_hash)
+    if source is None:
+        return None
+    if level == 0:
+        etag = image_etag(source, 0)
+        if etag_matches(if_none_match, etag):
+            return cached_response(etag)
+        return await original_response(identity_hash, etag, byte_range, if_range)
+    rendition_format = negotiate_format(accept, format)
+    if rendition_format is None:
+        return Response(content=f"Unsupported format {format}, available: {', '.join(RENDITION_FORMATS)}", status_code=406, media_type="text/plain")
+    tier = tier or DOWNSCALE_TIER
+    if tier not in DOWNSCALE_TIERS:
+        return Response(content=f"Unknown tier {tier}, available: {', '.join(DOWNSCALE_TIERS)}", status_code=400, media_type="text/plain")
+    quality = rendition_quality(rendition_format, quality)
+    etag = image_etag(source, level, rendition_format, quality, tier)
+    if etag_matches(if_none_match, etag):
+        return cached_response(etag)
+    try:
+        rendition = await read_rendition(identity_hash, level, rendition_format, quality, tier, source)
+    except TransformPoolBusy as e:
+        return Response(content=str(e), status_code=503, media_type="text/plain", headers={"Retry-After": "1"})
+    if rendition is None:
+        return None
+    content, served_format, bytes_saved = rendition
+    return cached_response(etag, content, RENDITION_MEDIA_TYPES[served_format], bytes_saved)
+
+@router.get("/v1/images/cache")
+def get_image_cache_stats():
+    return RENDITION_CACHE.stats()
+
+@router.get("/v1/images/transforms")
+def get_image_transform_stats():
+    return TRANSFORM_POOL.stats()
+
 @router.get("/v1/images/{identity_hash}")
-def get_image(identity_hash: str, compression_level: int):
+async def get_image(identity_hash: str, compression_level: int=Query(ge=0, le=MAX_THUMBNAIL_LEVEL), format: str=None, quality: int=Query(None, ge=1, le=100), accept: str=Header(None), if_none_match: str=Header(None), range: str=Header(None), if_range: str=Header(None), tier: str=None):
     try:
-        image = read_img_v2(identity_hash)
+        response = await image_response(identity_hash, compression_level, format, quality, accept, if_none_match, range, if_range, tier)
     except Exception as e:
         return Response(content=str(e), status_code=500, media_type="text/plain")
-    if image is None:
+    if response is None:
         return Response(content="Image not found", status_code=404, media_type="text/plain")
-    image = Image.open(BytesIO(image))
-    small_image = image.resize(
-        (image.width // (2 ** compression_level), image.height // (2 ** compression_level)), 
-        resample=Image.Resampling.LANCZOS
-    )
-    buf = BytesIO()
-    small_image.save(buf, format="PNG")
-    return Response(content=buf.getvalue(), media_type="image/png")
+    return response
 
 class InferencePayload(BaseModel):
     prompt: str
@@ -0,0 +1,486 @@
+"""
+Thumbnail pyramid of the images in imagineit_app.imdb.IMDB_PATH.
+
+Level n of an image is the image scaled down by 2 ** n, as served by /api/v1/{hash}/image and
+/api/v1/images/{identity_hash}, made by one of the DOWNSCALE_TIERS. Renditions are PNGs kept in a
+companion imdb file: <file>.thumbs next to a single-file imdb, pyramid.thumbs inside a segmented or
+v3 directory. They are keyed by level, tier and the content digest of their image, so images of
+equal content share renditions and an image whose content is replaced never gets served stale
+ones; images stored without a digest use a digest of their identity instead.
+
+A rendition missing on request is made right away and stored along with the rest of its pyramid.
+Encoded responses are also kept in memory by RENDITION_CACHE under the same source key, see
+read_rendition, and the decoding and encoding for requests runs on TRANSFORM_POOL, off the event
+loop and the request threads.
+build_thumbnails backfills every image on a process pool of its own:
+
+    python -m imagineit_app.thumbnails [--levels 1 2 3] [--tier balanced] [--workers N] [--prune]
+"""
+import os
+import sys
+import time
+import hashlib
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, Future
+
+import numpy as np
+from PIL import Image
+try:
+    # AVIF for Pillow builds without native support
+    import pillow_avif
+except ImportError:
+    pillow_avif = None
+
+from imagineit_app import imdb
+
+THUMBNAIL_LEVELS = (1, 2, 3)
+# any image is down to a pixel by then; keeps levels clear of the tier bits of _thumb_key
+MAX_THUMBNAIL_LEVEL = 16
+# index in the tuple is stored in the rendition keys: append new tiers at the end
+DOWNSCALE_TIERS = ("best", "balanced", "fast")
+DOWNSCALE_TIER = os.environ.get("DOWNSCALE_TIER", "balanced")
+THUMBS_NAME = "pyramid" + imdb.THUMBS_SUFFIX
+THUMBNAIL_BATCH = 16
+RENDITION_CACHE_BYTES = int(os.environ.get("RENDITION_CACHE_BYTES", 256 << 20))
+TRANSFORM_WORKERS = int(os.environ.get("TRANSFORM_WORKERS", os.cpu_count()))
+TRANSFORM_QUEUE_DEPTH = int(os.environ.get("TRANSFORM_QUEUE_DEPTH", 8 * TRANSFORM_WORKERS))
+
+def thumbs_path(path: str) -> str:
+    if os.path.isdir(path):
+        return os.path.join(path, THUMBS_NAME)
+    return path + imdb.THUMBS_SUFFIX
+
+def _source_key(identity_hash: str, digest: str) -> str:
+    return digest if isinstance(digest, str) else hashlib.blake2b(identity_hash.encode("utf-8"), digest_size=32).hexdigest()
+
+def source_key(identity_hash: str) -> str:
+    """
+    Key of the content renditions of identity_hash are made from, looked up in the metadata
+    only, or None if the identity is unknown. Replacing an image records a digest, so the key
+    of an image stored without one changes along with its content all the same.
+    """
+    known, digest = imdb._content_digest_of_v2(identity_hash)
+    return _source_key(identity_hash, digest) if known else None
+
+def _thumb_key(source: str, level: int, tier: str) -> str:
+    assert 0 <= level <= MAX_THUMBNAIL_LEVEL, f"level {level} outside of 0 to {MAX_THUMBNAIL_LEVEL}"
+    # laid out like an identity so it fits the mapper records: tier and level as salt, source as digest
+    return f"{DOWNSCALE_TIERS.index(tier) << 16 | level:032x}${source}"
+
+###
+# Formats
+#
+# Stored renditions are PNG. Levels 1 and up may also be served lossy, encoded from the stored
+# PNG at a quality of 1 to 100. Level 0 is never rendered, it is served as stored.
+###
+RENDITION_MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "avif": "image/avif", "jpeg": "image/jpeg"}
+RENDITION_QUALITY = {"webp": 80, "avif": 60, "jpeg": 85}
+Image.init()
+RENDITION_FORMATS = tuple(format for format in RENDITION_MEDIA_TYPES if format.upper() in Image.SAVE)
+
+def rendition_quality(format: str, quality: int=None):
+    return None if format == "png" else quality or RENDITION_QUALITY[format]
+
+def encode_rendition(png: bytes, format: str, quality: int=None) -> bytes:
+    if format == "png":
+        return png
+    image = Image.open(BytesIO(png))
+    if format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA")
+    buf = BytesIO()
+    image.save(buf, format=format.upper(), quality=rendition_quality(format, quality))
+    return buf.getvalue()
+
+###
+# Downscaling
+#
+# Every level is an exact 2 ** level reduction of the decoded image, made by one of three tiers:
+#   fast      box filter: Pillow's reduce(), with JPEG decoded at reduced scale through draft()
+#             and NumPy block averaging for modes reduce() does not take
+#   balanced  box filter down to twice the target size, then LANCZOS for the final halving
+#   best      LANCZOS from the full image, as the image endpoints always did
+###
+def _block_average(image: Image.Image, factor: int) -> Image.Image:
+    pixels = np.asarray(image)
+    height, width = pixels.shape[0] // factor, pixels.shape[1] // factor
+    blocks = pixels[:height * factor, :width * factor].reshape(height, factor, width, factor, *pixels.shape[2:])
+    return Image.fromarray(blocks.mean(axis=(1, 3)).round().astype(pixels.dtype), image.mode)
+
+def _box_reduce(image: Image.Image, factor: int) -> Image.Image:
+    if factor == 1:
+        return image
+    # crop to whole boxes so sizes come out as width // factor like the other tiers
+    image = image.crop((0, 0, image.width - image.width % factor, image.height - image.height % factor))
+    try:
+        return image.reduce(factor)
+    except ValueError:
+        return _block_average(image, factor)
+
+def downscale(image: Image.Image, size: tuple, tier: str=DOWNSCALE_TIER) -> Image.Image:
+    """
+    image scaled down to size, a power of two below it, the way tier does it.
+    """
+    if image.mode not in ("1", "L", "LA", "RGB", "RGBA", "I", "F"):
+        image = image.convert("RGBA" if "transparency" in image.info or image.mode.endswith("A") else "RGB")
+    factor = max(1, image.width // size[0])
+    if tier == "fast":
+        image = _box_reduce(image, factor)
+    elif tier == "balanced":
+        image = _box_reduce(image, max(1, factor // 2))
+    if image.size != size:
+        image = image.resize(size, resample=Image.Resampling.LANCZOS)
+    return image
+
+def render_pyramid(img: bytes, levels, tier: str=DOWNSCALE_TIER) -> dict:
+    """
+    Decodes img once and returns {level: (width, height, png)} made by tier. Sizes are
+    width // 2 ** level of the original, at least one pixel.
+    """
+    image = Image.open(BytesIO(img))
+    width, height = image.size
+    sizes = {level: (max(1, width // 2 ** level), max(1, height // 2 ** level)) for level in levels}
+    if tier == "fast" and image.format == "JPEG":
+        # the decoder scales by up to 1/8 on its own, never below the largest level asked for
+        image.draft(image.mode, max(sizes.values()))
+    image.load()
+    renditions = {}
+    for level, size in sorted(sizes.items()):
+        buf = BytesIO()
+        downscale(image, size, tier).save(buf, format="PNG")
+        renditions[level] = (*size, buf.getvalue())
+    return renditions
+
+def _render_job(item):
+    source, img, levels, tier = item
+    return source, render_pyramid(img, levels, tier)
+
+###
+# Store
+###
+def _read_thumb(path: str, key: str):
+    try:
+        index = imdb._identity_index_v2(path)
+    except FileNotFoundError:
+        return None
+    location = index["mapper"].get(key)
+    if location is None:
+        return None
+    offset, size, codec = location
+    mapping = imdb._mapped_view_v2(index, offset + size)
+    if mapping is None:
+        # replaced by a vacuum since it was indexed
+        return _read_thumb(path, key)
+    return bytes(imdb._decode_blob_v2(memoryview(mapping)[offset:offset + size], codec))
+
+def _missing_levels(path: str, source: str, levels, tier: str) -> list:
+    try:
+        mapper = imdb._identity_index_v2(path)["mapper"]
+    except FileNotFoundError:
+        return sorted(levels)
+    return [level for level in sorted(levels) if _thumb_key(source, level, tier) not in mapper]
+
+def _store_thumbs(path: str, pyramids: dict, tier: str):
+    """
+    Appends {source: {level: (width, height, png)}} renditions the file does not hold yet.
+    """
+    with imdb._path_lock_v2(path):
+        if not os.path.exists(path):
+            imdb._create_v2(path)
+        mapper = imdb._identity_index_v2(path)["mapper"]
+        records = []
+        for source, renditions in pyramids.items():
+            for level, (width, height, png) in renditions.items():
+                key = _thumb_key(source, level, tier)
+                if key in mapper:
+                    continue
+                blob, codec = imdb._encode_blob_v2(png)
+                records.append((imdb.LOG_INSERT, {"identity": key, "level": level, "tier": tier, "width": width, "height": height, "codec": codec}, blob))
+        if records:
+            imdb._append_log_batch_v2(path, records)
+    return len(records)
+
+def _lookup_thumbnail(identity_hash: str, level: int, tier: str):
+    """
+    (thumbs path, source, stored PNG or None), or None if the identity is unknown.
+    """
+    source = source_key(identity_hash)
+    if source is None:
+        return None
+    path = thumbs_path(imdb.IMDB_PATH)
+    return path, source, _read_thumb(path, _thumb_key(source, level, tier))
+
+def _pyramid_source(identity_hash: str, path: str, source: str, level: int, tier: str):
+    """
+    (image bytes, levels to render along with level), image being None if the identity is gone.
+    """
+    img = imdb.read_img_v2(identity_hash)
+    if img is None:
+        return None, None
+    return bytes(img), _missing_levels(path, source, {*THUMBNAIL_LEVELS, level}, tier) or [level]
+
+def read_thumbnail(identity_hash: str, level: int, tier: str=DOWNSCALE_TIER) -> bytes:
+    """
+    PNG of the image scaled down by 2 ** level (level >= 1), or None if the identity is unknown.
+    A missing rendition is made from the image together with the rest of THUMBNAIL_LEVELS.
+    """
+    found = _lookup_thumbnail(identity_hash, level, tier)
+    if found is None or found[2] is not None:
+        return found and found[2]
+    path, source, _ = found
+    img, levels = _pyramid_source(identity_hash, path, source, level, tier)
+    if img is None:
+        return None
+    renditions = render_pyramid(img, levels, tier)
+    _store_thumbs(path, {source: renditions}, tier)
+    return renditions[level][2]
+
+async def read_thumbnail_async(identity_hash: str, level: int, tier: str=DOWNSCALE_TIER) -> bytes:
+    """
+    read_thumbnail for the event loop: storage is read and written on worker threads and
+    renditions are made on TRANSFORM_POOL.
+    """
+    found = await asyncio.to_thread(_lookup_thumbnail, identity_hash, level, tier)
+    if found is None or found[2] is not None:
+        return found and found[2]
+    path, source, _ = found
+    img, levels = await asyncio.to_thread(_pyramid_source, identity_hash, path, source, level, tier)
+    if img is None:
+        return None
+    renditions = await TRANSFORM_POOL.run(render_pyramid, img, levels, tier)
+    await asyncio.to_thread(_store_thumbs, path, {source: renditions}, tier)
+    return renditions[level][2]
+
+###
+# Transform pool
+#
+# Processes dedicated to decoding, resizing and encoding for requests, so that work neither holds
+# the GIL of the server process nor occupies the threads serving the cheap endpoints. At most
+# max_pending transforms may be queued or running; past that run raises TransformPoolBusy
+# right away rather than letting requests pile up.
+###
+class TransformPoolBusy(RuntimeError):
+    pass
+
+class TransformPool:
+    def __init__(self, workers: int=TRANSFORM_WORKERS, max_pending: int=TRANSFORM_QUEUE_DEPTH):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.completed = self.failed = self.rejected = 0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawned rather than forked, the server process runs threads
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                raise TransformPoolBusy(f"{self._pending} image transforms pending")
+            self._pending += 1
+        try:
+            result = await asyncio.wrap_future(self._pool().submit(fn, *args))
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+                self.failed += 1
+            raise
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"workers": self.workers, "pending": self._pending, "max_pending": self.max_pending, "completed": self.completed, "failed": self.failed, "rejected": self.rejected}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+TRANSFORM_POOL = TransformPool()
+
+###
+# Rendition cache
+#
+# Renditions (content, format, bytes saved against PNG) keyed by (source key, level, format,
+# quality, tier), the source key being the content digest of the image, see source_key. They are
+# evicted least recently used first once their bytes pass the budget. Concurrent misses of one
+# key are coalesced: the first caller renders while the others await its result.
+###
+class RenditionCache:
+    def __init__(self, max_bytes: int=RENDITION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = self.evictions = 0
+
+    async def get(self, key, render):
+        """
+        Cached value of key, else the coroutine render() awaited once for all concurrent callers.
+        None results are handed to the waiting callers but not cached.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            value = await render()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            if value is not None and len(value[0]) <= self.max_bytes:
+                self._entries[key] = value
+                self._bytes += len(value[0])
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted[0])
+                    self.evictions += 1
+        future.set_result(value)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+RENDITION_CACHE = RenditionCache()
+
+async def _render_rendition(identity_hash: str, level: int, format: str, quality: int, tier: str):
+    png = await read_thumbnail_async(identity_hash, level, tier)
+    if png is None:
+        return None
+    if format == "png":
+        return png, "png", 0
+    content = await TRANSFORM_POOL.run(encode_rendition, png, format, quality)
+    if len(content) >= len(png):
+        # tiny renditions can come out larger lossy
+        return png, "png", 0
+    return content, format, len(png) - len(content)
+
+async def read_rendition(identity_hash: str, level: int, format: str="png", quality: int=None, tier: str=DOWNSCALE_TIER, source: str=None):
+    """
+    (content, format, bytes saved against PNG) served for level >= 1, from RENDITION_CACHE when
+    there, or None if the identity is unknown. Renditions are cached under the source key, so a
+    replaced image misses; pass source when it is known already. Raises TransformPoolBusy when
+    it would have to render while TRANSFORM_POOL is full.
+    """
+    quality = rendition_quality(format, quality)
+    source = source or await asyncio.to_thread(source_key, identity_hash)
+    if source is None:
+        return None
+    return await RENDITION_CACHE.get((source, level, format, quality, tier), lambda: _render_rendition(identity_hash, level, format, quality, tier))
+
+###
+# Backfill
+###
+def build_thumbnails(levels=THUMBNAIL_LEVELS, workers: int=None, prune: bool=False, tier: str=DOWNSCALE_TIER, report=print) -> dict:
+    """
+    Renders the missing levels of every image of IMDB_PATH with tier on a process pool, one image
+    per distinct content. Images are read in file order and batches are appended as they finish.
+    With prune, renditions of contents no longer stored are dropped and the file vacuumed.
+    """
+    start = time.perf_counter()
+    path = thumbs_path(imdb.IMDB_PATH)
+    metadata_df = imdb.read_metadata_v2(["identity", "content_digest"])
+    if metadata_df is None:
+        return {"images": 0, "rendered": 0, "pruned": 0, "seconds": 0.0}
+    digests = metadata_df['content_digest'].tolist() if "content_digest" in metadata_df.columns else [None] * len(metadata_df)
+    sources = {}
+    for identity_hash, digest in zip(metadata_df['identity'].tolist(), digests):
+        sources.setdefault(_source_key(identity_hash, digest), identity_hash)
+    pending = {}
+    for source, identity_hash in sources.items():
+        missing = _missing_levels(path, source, levels, tier)
+        if missing:
+            pending[identity_hash] = (source, missing)
+    stats = {"images": len(metadata_df), "rendered": 0, "pruned": 0}
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+        batch = []
+        def flush():
+            pyramids = dict(pool.map(_render_job, batch))
+            stats["rendered"] += _store_thumbs(path, pyramids, tier)
+            batch.clear()
+            report(f"{stats['rendered']} renditions, {stats['rendered'] / (time.perf_counter() - start):.0f}/s")
+        for identity_hash, img in imdb.read_imgs_v2(list(pending)):
+            if img is None:
+                continue
+            source, missing = pending[identity_hash]
+            batch.append((source, img, missing, tier))
+            if len(batch) == THUMBNAIL_BATCH * workers:
+                flush()
+        if batch:
+            flush()
+    if prune and os.path.exists(path):
+        with imdb._path_lock_v2(path):
+            mapper = imdb._identity_index_v2(path)["mapper"]
+            dead = [key for key in mapper if key.split("$")[1] not in sources]
+            if dead:
+                imdb._append_log_batch_v2(path, [(imdb.LOG_DELETE, {"identity": key}, b"") for key in dead])
+        stats["pruned"] = len(dead)
+        if dead:
+            with imdb._VACUUM_LOCK:
+                imdb._vacuum_file_v2(path, imdb.VACUUM_CHUNK_SIZE)
+    if os.path.exists(path):
+        imdb._checkpoint_file_v2(path)
+    stats["seconds"] = time.perf_counter() - start
+    report(f"{stats['rendered']} renditions of {len(pending)} images in {stats['seconds']:.1f}s, {stats['pruned']} pruned")
+    return stats
+
+def main(argv: list[str]=None):
+    parser = argparse.ArgumentParser(description="Render the thumbnail pyramid of IMDB_PATH.")
+    parser.add_argument("--levels", type=int, nargs="+", choices=range(1, MAX_THUMBNAIL_LEVEL + 1), metavar="LEVEL", default=list(THUMBNAIL_LEVELS))
+    parser.add_argument("--tier", choices=DOWNSCALE_TIERS, default=DOWNSCALE_TIER)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--prune", action="store_true", help="drop renditions of images no longer stored")
+    args = parser.parse_args(argv)
+    build_thumbnails(args.levels, args.workers, args.prune, args.tier)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -528,23 +528,6 @@ export const saveTrainingImage = async (
     }
 };
 
-/**
- * Converts a hex string to an ArrayBuffer.
- * @param hex The hex string to convert.
- * @returns The resulting ArrayBuffer.
- */
-const hexToArrayBuffer = (hex: string): ArrayBuffer => {
-    if (hex.length % 2 !== 0) {
-        throw new Error('Hex string must have an even number of characters');
-    }
-    const bytes = new Uint8Array(hex.length / 2);
-    for (let i = 0; i < hex.length; i += 2) {
-        bytes[i / 2] = parseInt(hex.substr(i, 2), 16);
-    }
-    return bytes.buffer;
-};
-
-
 /**
  * Requests the backend to create a zip archive of specified images.
  * @param collectionName The name for the export collection.
@@ -578,28 +561,28 @@ export const createZipFile = async (
             body: JSON.stringify(payload),
         });
 
-        const responseData = await response.json();
-
         if (!response.ok) {
             let errorMessage = `API request failed with status ${response.status}`;
-            errorMessage = responseData.detail || errorMessage;
+            const errorData = await response.json().catch(() => null);
+            errorMessage = errorData?.detail || errorMessage;
             throw new Error(errorMessage);
         }
-        
-        if (responseData.status !== 'success') {
-            throw new Error('API returned a non-success status.');
-        }
 
         if (returnFile) {
-            if (!responseData.file || typeof responseData.file !== 'string') {
+            // The archive is streamed back as raw application/zip
+            if (response.headers.get('Content-Type') !== 'application/zip') {
                 throw new Error('API was expected to return a file, but did not.');
             }
-            const arrayBuffer = hexToArrayBuffer(responseData.file);
-            const blob = new Blob([arrayBuffer], { type: 'application/zip' });
+            const blob = await response.blob();
             const fileUrl = URL.createObjectURL(blob);
             return { status: 'success', fileUrl };
         }
 
+        const responseData = await response.json();
+        if (responseData.status !== 'success') {
+            throw new Error('API returned a non-success status.');
+        }
+
         return { status: 'success' };
 
     } catch (error) {
@@ -0,0 +1,91 @@
+import os
+import random
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from imagineit_app import imdb
+
+LAYOUTS = ("file", "segmented", "v3")
+
+def make_image(n: int) -> bytes:
+    # compressible filler of varying size, stored zlib-encoded like any non-image payload
+    rng = random.Random(n)
+    return bytes(rng.randrange(16) for _ in range(256 + n * 37))
+
+def make_png(n: int, size: tuple=(64, 64)) -> bytes:
+    pixels = np.random.default_rng(n).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buf = BytesIO()
+    Image.fromarray(pixels).save(buf, format="PNG")
+    return buf.getvalue()
+
+def write_pngs(count: int, start: int=0, size: tuple=(64, 64)) -> dict:
+    """
+    write_images with PNGs of the given size, for the image endpoints.
+    """
+    images = {}
+    for n in range(start, start + count):
+        img = make_png(n, size)
+        images[imdb.write_v2(None, img, n, f"prompt {n}", "negative", *size, 20, 7.5)] = img
+    return images
+
+def write_images(count: int, start: int=0) -> dict:
+    """
+    Writes count images into IMDB_PATH, returning {identity: image}.
+    """
+    images = {}
+    for n in range(start, start + count):
+        img = make_image(n)
+        images[imdb.write_v2(None, img, n, f"prompt {n}, tag{n % 3}", "negative", 64, 64, 20, 7.5)] = img
+    return images
+
+def metadata_by_identity(metadata_df) -> dict:
+    records = metadata_df.astype(object).where(metadata_df.notna(), None).to_dict("records")
+    return {row["identity"]: row for row in records}
+
+def read_all(identities) -> dict:
+    return {identity: None if img is None else bytes(img) for identity, img in imdb.read_imgs_v2(identities)}
+
+def load_file(path: str):
+    """
+    (mapper, {identity: metadata row}) of a single-file imdb as read from disk.
+    """
+    with open(path, "rb") as f:
+        mapper, metadata_df, _, _ = imdb._load_v2(f)
+    return mapper, metadata_by_identity(metadata_df)
+
+def create_imdb(path: str, layout: str) -> str:
+    if layout == "file":
+        return os.path.join(path, "test.imdb")
+    if layout == "segmented":
+        imdb.create_segmented_v2(os.path.join(path, "segmented"))
+        return os.path.join(path, "segmented")
+    imdb.create_v3(os.path.join(path, "v3"))
+    return os.path.join(path, "v3")
+
+@pytest.fixture(params=LAYOUTS)
+def layout_db(request, tmp_path, monkeypatch):
+    path = create_imdb(str(tmp_path), request.param)
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    return request.param, path
+
+@pytest.fixture
+def file_db(tmp_path, monkeypatch):
+    path = create_imdb(str(tmp_path), "file")
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    return path
+
+@pytest.fixture
+def client(layout_db):
+    """
+    TestClient of the app serving the layout_db imdb.
+    """
+    from fastapi.testclient import TestClient
+    from imagineit_app.app import app
+    from imagineit_app.thumbnails import RENDITION_CACHE
+    # renditions are cached per content, across imdbs
+    RENDITION_CACHE.clear()
+    with TestClient(app) as client:
+        yield client
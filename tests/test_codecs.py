@@ -0,0 +1,48 @@
+import os
+import zlib
+
+import pytest
+
+from imagineit_app import imdb
+
+from conftest import make_image, read_all, load_file
+
+###
+# Codec policy
+###
+@pytest.mark.parametrize("signature", [b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF8"])
+def test_compressed_images_are_stored_raw(signature):
+    img = signature + make_image(1)
+    assert imdb._encode_blob_v2(img) == (img, imdb.BLOB_RAW)
+
+def test_compressible_data_is_compressed():
+    img = make_image(1)
+    blob, codec = imdb._encode_blob_v2(img)
+    assert codec == (imdb.BLOB_ZLIB if imdb.zstandard is None else imdb.BLOB_ZSTD)
+    assert len(blob) < len(img)
+    assert imdb._decode_blob_v2(blob, codec) == img
+
+def test_incompressible_data_is_stored_raw():
+    img = os.urandom(4096)
+    assert imdb._encode_blob_v2(img) == (img, imdb.BLOB_RAW)
+
+def test_zlib_without_zstandard(monkeypatch):
+    monkeypatch.setattr(imdb, "zstandard", None)
+    blob, codec = imdb._encode_blob_v2(make_image(1))
+    assert codec == imdb.BLOB_ZLIB and zlib.decompress(blob) == make_image(1)
+    with pytest.raises(RuntimeError):
+        imdb._decode_blob_v2(b"", imdb.BLOB_ZSTD)
+
+###
+# Stored codecs
+###
+def test_codecs_survive_a_checkpoint(file_db):
+    images = {
+        imdb.write_v2(None, img, n, "a", "b", 64, 64, 20, 7.5): img
+        for n, img in enumerate([b"\x89PNG\r\n\x1a\n" + make_image(1), make_image(2), os.urandom(2048)])
+    }
+    codecs = {identity: location[2] for identity, location in load_file(file_db)[0].items()}
+    assert sorted(codecs.values()) == sorted([imdb.BLOB_RAW, imdb.BLOB_RAW, imdb._encode_blob_v2(make_image(2))[1]])
+    imdb.checkpoint_v2()
+    assert {identity: location[2] for identity, location in load_file(file_db)[0].items()} == codecs
+    assert read_all(images) == images
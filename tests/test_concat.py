@@ -0,0 +1,90 @@
+import shutil
+
+import pytest
+
+from imagineit_app import imdb
+
+from conftest import make_image, write_images, metadata_by_identity, read_all
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    """
+    Two single-file imdbs sharing their identities, the second with one image replaced and one
+    deleted, as {path: images}.
+    """
+    first, second = str(tmp_path / "first.imdb"), str(tmp_path / "second.imdb")
+    path = imdb.IMDB_PATH
+    monkeypatch.setattr(imdb, "IMDB_PATH", first)
+    images = write_images(8, start=100)
+    imdb.checkpoint_v2()
+    # a log on top of the checkpoint
+    images.update(write_images(2, start=108))
+    shutil.copyfile(first, second)
+    monkeypatch.setattr(imdb, "IMDB_PATH", second)
+    changed = dict(images)
+    replaced, deleted = list(images)[:2]
+    imdb.write_v2(replaced, make_image(500))
+    changed[replaced] = make_image(500)
+    imdb.del_img_v2(deleted)
+    changed.pop(deleted)
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    return {first: images, second: changed}
+
+def no_decoding(monkeypatch):
+    for name in ("_decode_blob_v2", "_encode_blob_v2", "content_digest_v2"):
+        monkeypatch.setattr(imdb, name, lambda *args: 1 / 0)
+
+def test_concat_into_file(file_db, sources, monkeypatch):
+    own = write_images(3)
+    first, second = sources
+    with monkeypatch.context() as patched:
+        no_decoding(patched)
+        stats = imdb.concat_imdb_v2([first])
+    assert stats["images"] == 10 and stats["replaced"] == 0
+    expected = {**own, **sources[first]}
+    assert read_all(expected) == expected
+    assert set(metadata_by_identity(imdb.read_metadata_v2())) == set(expected)
+    with open(file_db, "rb") as f:
+        assert imdb._load_v2(f)[3] == 0
+    # the images left after a merge take new writes as usual
+    expected.update(write_images(1, start=200))
+    assert read_all(expected) == expected
+
+def test_duplicate_policies(file_db, sources):
+    first, second = sources
+    imdb.concat_imdb_v2(first)
+    assert imdb.concat_imdb_v2(second)["images"] == 0
+    assert read_all(sources[first]) == sources[first]
+    with pytest.raises(ValueError):
+        imdb.concat_imdb_v2(second, on_duplicate="error")
+    assert read_all(sources[first]) == sources[first]
+    stats = imdb.concat_imdb_v2(second, on_duplicate="replace")
+    assert stats["images"] == stats["replaced"] == 9
+    expected = {**sources[first], **sources[second]}
+    assert read_all(expected) == expected
+    assert len(imdb.read_metadata_v2()) == 10
+    with pytest.raises(ValueError):
+        imdb.concat_imdb_v2(second, on_duplicate="overwrite")
+
+def test_concat_into_segmented(tmp_path, sources, monkeypatch):
+    first, second = sources
+    path = str(tmp_path / "segmented")
+    imdb.create_segmented_v2(path)
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    own = write_images(3)
+    with monkeypatch.context() as patched:
+        no_decoding(patched)
+        assert imdb.concat_imdb_v2([first, second])["images"] == 10
+    expected = {**own, **sources[first]}
+    assert read_all(expected) == expected
+    assert set(metadata_by_identity(imdb.read_metadata_v2())) == set(expected)
+    with pytest.raises(ValueError):
+        imdb.concat_imdb_v2(second, on_duplicate="replace")
+
+def test_concat_into_v3_is_refused(tmp_path, sources, monkeypatch):
+    path = str(tmp_path / "v3")
+    imdb.create_v3(path)
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    with pytest.raises(ValueError):
+        imdb.concat_imdb_v2(list(sources))
+    assert len(imdb.read_metadata_v2()) == 0
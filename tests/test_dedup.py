@@ -0,0 +1,81 @@
+import pytest
+
+from imagineit_app import imdb
+
+from conftest import make_image, write_images, metadata_by_identity, read_all, load_file
+
+def write_copies(img: bytes, count: int) -> list:
+    return [imdb.write_v2(None, img, n, "a", "b", 64, 64, 20, 7.5) for n in range(count)]
+
+###
+# Shared blobs
+###
+def test_equal_content_shares_a_blob(layout_db):
+    img = make_image(7)
+    first, second = write_copies(img, 2)
+    assert imdb.fragmentation_v2()["live_bytes"] < 2 * len(img)
+    imdb.del_img_v2(first)
+    assert bytes(imdb.read_img_v2(second)) == img
+
+@pytest.mark.parametrize("layout_db", ["file", "v3"], indirect=True)
+def test_blob_outlives_all_but_its_last_reference(layout_db):
+    img = make_image(7)
+    identities = write_copies(img, 3)
+    others = write_images(2, start=10)
+    imdb.del_img_v2(identities[0])
+    imdb.vacuum_v2()
+    assert read_all(identities[1:]) == {identity: img for identity in identities[1:]}
+    for identity in identities[1:]:
+        imdb.del_img_v2(identity)
+    imdb.vacuum_v2()
+    assert imdb.fragmentation_v2()["live_bytes"] == sum(len(imdb._encode_blob_v2(other)[0]) for other in others.values())
+    assert read_all(others) == others
+    # the content is stored again once nothing references it
+    identity = imdb.write_v2(None, img, 5, "a", "b", 64, 64, 20, 7.5)
+    assert bytes(imdb.read_img_v2(identity)) == img
+
+###
+# Dedup pass
+###
+@pytest.mark.parametrize("layout_db", ["file", "v3"], indirect=True)
+def test_dedup(layout_db, monkeypatch):
+    img = make_image(7)
+    with monkeypatch.context() as patched:
+        # images written before content digests
+        patched.setattr(imdb, "content_digest_v2", lambda img: None)
+        identities = write_copies(img, 3)
+        others = write_images(2, start=10)
+    before = imdb.fragmentation_v2()["live_bytes"]
+    stats = imdb.dedup_v2(workers=2)
+    assert stats["hashed"] == 5 and stats["shared"] == 2
+    assert stats["freed_bytes"] == 2 * len(imdb._encode_blob_v2(img)[0])
+    assert imdb.fragmentation_v2()["live_bytes"] == before - stats["freed_bytes"]
+    assert read_all(identities) == {identity: img for identity in identities}
+    assert read_all(others) == others
+    digests = metadata_by_identity(imdb.read_metadata_v2(["identity", "content_digest"]))
+    assert {digests[identity]["content_digest"] for identity in identities} == {imdb.content_digest_v2(img)}
+    assert imdb.dedup_v2()["hashed"] == 0
+    # new copies share the deduplicated blob
+    write_copies(img, 1)
+    assert imdb.fragmentation_v2()["live_bytes"] == before - stats["freed_bytes"]
+
+@pytest.mark.parametrize("layout_db", ["segmented"], indirect=True)
+def test_dedup_refuses_segmented(layout_db):
+    # segments share blobs as they are written
+    with pytest.raises(ValueError):
+        imdb.dedup_v2()
+
+def test_replace_on_a_checkpoint_without_digests(file_db):
+    identity = next(iter(write_images(1)))
+    # a checkpoint as written before the content_digest column existed
+    with open(file_db, "r+b") as f:
+        mapper, metadata_df, log_end, _ = imdb._load_v2(f)
+        imdb._write_checkpoint_v2(file_db, f, mapper, metadata_df.drop(columns="content_digest"), log_end)
+    imdb._IDENTITY_INDEXES.clear()
+    img = make_image(50)
+    imdb.write_v2(identity, img)
+    imdb.checkpoint_v2()
+    imdb._IDENTITY_INDEXES.clear()
+    assert load_file(file_db)[1][identity]["content_digest"] == imdb.content_digest_v2(img)
+    assert imdb._content_digest_of_v2(identity) == (True, imdb.content_digest_v2(img))
+    assert bytes(imdb.read_img_v2(identity)) == img
@@ -0,0 +1,55 @@
+import pytest
+
+from imagineit_app import imdb
+from imagineit_app.resources import image as image_resource
+
+from conftest import make_png, write_pngs
+
+def no_image_reads(monkeypatch):
+    for module in (imdb, image_resource):
+        monkeypatch.setattr(module, "read_img_v2", lambda *args: 1 / 0)
+    monkeypatch.setattr(imdb, "read_imgs_v2", lambda *args: 1 / 0)
+
+@pytest.mark.parametrize("url", ["/api/v1/{}/image?level=0", "/api/v1/{}/image?level=1", "/api/v1/images/{}?compression_level=2"])
+def test_not_modified(client, monkeypatch, url):
+    identity = next(iter(write_pngs(1)))
+    response = client.get(url.format(identity))
+    etag = response.headers["ETag"]
+    assert response.status_code == 200 and etag.startswith('"')
+    assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    with monkeypatch.context() as patched:
+        no_image_reads(patched)
+        for if_none_match in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            response = client.get(url.format(identity), headers={"If-None-Match": if_none_match})
+            assert response.status_code == 304 and response.content == b""
+            assert response.headers["ETag"] == etag
+    assert client.get(url.format(identity), headers={"If-None-Match": '"other"'}).status_code == 200
+
+def test_etags_follow_content(client):
+    identity, other = write_pngs(2)
+    etags = {level: client.get(f"/api/v1/{identity}/image", params={"level": level}).headers["ETag"] for level in (0, 1, 2)}
+    assert len(set(etags.values())) == 3
+    # equal content, equal tags
+    copy = imdb.write_v2(None, make_png(0), 5, "copy", "negative", 64, 64, 20, 7.5)
+    assert client.get(f"/api/v1/{copy}/image", params={"level": 1}).headers["ETag"] == etags[1]
+    assert client.get(f"/api/v1/{other}/image", params={"level": 1}).headers["ETag"] != etags[1]
+    imdb.write_v2(identity, make_png(9))
+    response = client.get(f"/api/v1/{identity}/image", params={"level": 1}, headers={"If-None-Match": etags[1]})
+    assert response.status_code == 200 and response.headers["ETag"] != etags[1]
+
+def test_images_without_digest(client, monkeypatch):
+    with monkeypatch.context() as patched:
+        # images written before content digests
+        patched.setattr(imdb, "content_digest_v2", lambda img: None)
+        identity = next(iter(write_pngs(1)))
+    etag = client.get(f"/api/v1/{identity}/image", params={"level": 1}).headers["ETag"]
+    with monkeypatch.context() as patched:
+        no_image_reads(patched)
+        assert client.get(f"/api/v1/{identity}/image", params={"level": 1}, headers={"If-None-Match": etag}).status_code == 304
+    imdb.write_v2(identity, make_png(9))
+    assert client.get(f"/api/v1/{identity}/image", params={"level": 1}, headers={"If-None-Match": etag}).status_code == 200
+
+def test_unknown_identity(client):
+    write_pngs(1)
+    assert client.get("/api/v1/images/2$unknown", params={"compression_level": 1}).status_code == 404
+    assert client.get("/api/v1/2$unknown/image", params={"level": 0}).json() == {"error": "Image not found."}
@@ -0,0 +1,50 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from imagineit_app.resources.image import negotiate_format
+
+from conftest import make_png, write_pngs
+
+@pytest.mark.parametrize("accept, format, expected", [
+    (None, None, "png"),
+    ("*/*", None, "png"),
+    ("image/avif,image/webp,*/*", None, "avif"),
+    ("image/webp;q=0.9,image/avif;q=0.5", None, "webp"),
+    ("image/avif;q=0,image/jpeg", None, "jpeg"),
+    ("image/webp;q=oops", None, "png"),
+    ("image/webp", "PNG", "png"),
+    (None, "jpg", "jpeg"),
+    ("image/webp", "gif", None),
+])
+def test_negotiate_format(accept, format, expected):
+    assert negotiate_format(accept, format) == expected
+
+@pytest.mark.parametrize("layout_db", ["file"], indirect=True)
+def test_accept(client):
+    identity = next(iter(write_pngs(1, size=(256, 256))))
+    png = client.get(f"/api/v1/{identity}/image", params={"level": 1})
+    assert png.headers["Content-Type"] == "image/png" and png.headers["X-Bytes-Saved"] == "0"
+    assert png.headers["Vary"] == "Accept"
+    webp = client.get(f"/api/v1/{identity}/image", params={"level": 1}, headers={"Accept": "image/webp,*/*;q=0.8"})
+    assert webp.headers["Content-Type"] == "image/webp"
+    assert int(webp.headers["X-Bytes-Saved"]) == len(png.content) - len(webp.content) > 0
+    assert Image.open(BytesIO(webp.content)).size == (128, 128)
+    assert webp.headers["ETag"] != png.headers["ETag"]
+    # the original is served as stored whatever Accept says
+    original = client.get(f"/api/v1/{identity}/image", params={"level": 0}, headers={"Accept": "image/webp"})
+    assert original.headers["Content-Type"] == "image/png" and original.content == make_png(0, (256, 256))
+
+@pytest.mark.parametrize("layout_db", ["file"], indirect=True)
+def test_format_and_quality(client):
+    identity = next(iter(write_pngs(1, size=(256, 256))))
+    url = f"/api/v1/images/{identity}"
+    low = client.get(url, params={"compression_level": 1, "format": "jpeg", "quality": 20}, headers={"Accept": "image/webp"})
+    high = client.get(url, params={"compression_level": 1, "format": "jpg", "quality": 95})
+    assert low.headers["Content-Type"] == high.headers["Content-Type"] == "image/jpeg"
+    assert len(low.content) < len(high.content) and low.headers["ETag"] != high.headers["ETag"]
+    unsupported = client.get(url, params={"compression_level": 1, "format": "bmp"})
+    assert unsupported.status_code == 406 and "png" in unsupported.text
+    for quality in (0, 101):
+        assert client.get(url, params={"compression_level": 1, "format": "webp", "quality": quality}).status_code == 422
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from imagineit_app import imdb
+
+from conftest import make_image, metadata_by_identity, read_all
+
+PARAMS = {"prompt": "a", "negative_prompt": "b", "width": 64, "height": 64, "steps": 20, "guidance_scale": 7.5}
+
+def test_concurrent_writes_share_commits(layout_db, monkeypatch):
+    commits = []
+    commit = imdb._commit_group_v2
+    monkeypatch.setattr(imdb, "_commit_group_v2", lambda batch: commits.append(len(batch)) or commit(batch))
+    writer = imdb.GroupCommitWriter(window=0.05)
+    barrier = threading.Barrier(16)
+    images = {}
+
+    def write(n):
+        barrier.wait()
+        images[writer.write(None, make_image(n), seed=n, **PARAMS)] = make_image(n)
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(images) == 16 and sum(commits) == 16
+    assert len(commits) < 16
+    assert read_all(images) == images
+    assert set(metadata_by_identity(imdb.read_metadata_v2())) == set(images)
+
+def test_updates_and_deletes(layout_db):
+    writer = imdb.GroupCommitWriter()
+    identities = [writer.write(None, make_image(n), seed=n, **PARAMS) for n in range(3)]
+    assert writer.write(identities[0], labeled=True, label="relabeled") == identities[0]
+    assert writer.delete(identities[1])
+    assert not writer.delete(identities[1])
+    with pytest.raises(ValueError):
+        writer.write(identities[1], labeled=True)
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert set(metadata) == {identities[0], identities[2]}
+    assert metadata[identities[0]]["label"] == "relabeled"
+
+def test_batch_is_validated_in_order():
+    def item(kind, identity):
+        return {"kind": kind, "meta": {"identity": identity, "values": {}}, "blob": b"", "error": None}
+    batch = [
+        item(imdb.LOG_INSERT, "1$new"),
+        item(imdb.LOG_DELETE, "1$new"),
+        item(imdb.LOG_UPDATE, "1$new"),
+        item(imdb.LOG_UPDATE, "2$stored"),
+        item(imdb.LOG_DELETE, "3$unknown"),
+    ]
+    records = imdb._validate_group_v2(batch, lambda identity: identity == "2$stored")
+    assert [(kind, meta["identity"]) for kind, meta, _ in records] == [(imdb.LOG_INSERT, "1$new"), (imdb.LOG_DELETE, "1$new"), (imdb.LOG_UPDATE, "2$stored")]
+    assert [item["error"] is not None for item in batch] == [False, False, True, False, True]
@@ -0,0 +1,69 @@
+from imagineit_app import imdb
+
+from conftest import make_image, write_images, metadata_by_identity, read_all
+
+def identity_data(row: dict) -> str:
+    return imdb._identity_data_v2(imdb._identity_fields_v2(**{name: row[name] for name in imdb.IDENTITY_FIELDS})).hex()
+
+###
+# Schemes
+###
+def test_new_identities_use_blake2b(file_db):
+    identity = next(iter(write_images(1)))
+    assert imdb.identity_version_v2(identity) == imdb.IDENTITY_BLAKE2B
+    row = metadata_by_identity(imdb.read_metadata_v2())[identity]
+    assert imdb.identity_hash_validation_v2(identity_data(row), identity)
+    assert not imdb.identity_hash_validation_v2(identity_data({**row, "seed": row["seed"] + 1}), identity)
+
+def test_legacy_identities_still_validate(file_db, monkeypatch):
+    monkeypatch.setattr(imdb, "IDENTITY_SCHEME", imdb.IDENTITY_PBKDF2)
+    identity = next(iter(write_images(1)))
+    assert imdb.identity_version_v2(identity) == imdb.IDENTITY_PBKDF2
+    row = metadata_by_identity(imdb.read_metadata_v2())[identity]
+    assert imdb.identity_hash_validation_v2(identity_data(row), identity)
+
+def test_label_updates_skip_hashing(file_db, monkeypatch):
+    identity = next(iter(write_images(1)))
+    monkeypatch.setattr(imdb, "_identity_digest_v2", lambda *args: 1 / 0)
+    assert imdb.write_v2(identity, labeled=True, label="relabeled") == identity
+
+def test_parameter_updates_rekey(layout_db):
+    images = write_images(2)
+    identity, other = images
+    new_identity = imdb.write_v2(identity, seed=99)
+    assert new_identity != identity
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert set(metadata) == {new_identity, other} and metadata[new_identity]["seed"] == 99
+    assert imdb.read_img_v2(identity) is None
+    assert bytes(imdb.read_img_v2(new_identity)) == images[identity]
+    # parameters hashing to the identity keep it
+    assert imdb.write_v2(new_identity, seed=99) == new_identity
+
+###
+# Bulk rekeying
+###
+def test_rekey(layout_db, monkeypatch):
+    monkeypatch.setattr(imdb, "IDENTITY_SCHEME", imdb.IDENTITY_PBKDF2)
+    legacy = write_images(4)
+    monkeypatch.setattr(imdb, "IDENTITY_SCHEME", imdb.IDENTITY_BLAKE2B)
+    current = write_images(2, start=4)
+    imdb.write_v2(next(iter(legacy)), labeled=True, label="kept")
+    before = metadata_by_identity(imdb.read_metadata_v2())
+    rekeyed = imdb.rekey_v2(workers=2)
+    assert set(rekeyed) == set(legacy)
+    assert all(imdb.identity_version_v2(identity) == imdb.IDENTITY_BLAKE2B for identity in rekeyed.values())
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert set(metadata) == set(rekeyed.values()) | set(current)
+    for old, new in rekeyed.items():
+        assert {**metadata[new], "identity": old} == before[old]
+        assert imdb.identity_hash_validation_v2(identity_data(metadata[new]), new)
+    assert read_all(list(rekeyed.values())) == {new: legacy[old] for old, new in rekeyed.items()}
+    assert imdb.rekey_v2(workers=2) == {}
+
+def test_rekey_listed(file_db, monkeypatch):
+    monkeypatch.setattr(imdb, "IDENTITY_SCHEME", imdb.IDENTITY_PBKDF2)
+    legacy = list(write_images(3))
+    rekeyed = imdb.rekey_v2(legacy[:1], workers=1)
+    assert list(rekeyed) == legacy[:1]
+    assert bytes(imdb.read_img_v2(rekeyed[legacy[0]])) == make_image(0)
+    assert all(imdb.read_img_v2(identity) is not None for identity in legacy[1:])
@@ -0,0 +1,62 @@
+import os
+
+from imagineit_app import imdb
+
+from conftest import make_image, write_images, metadata_by_identity, read_all, load_file
+
+###
+# Round trip
+###
+def test_round_trip(layout_db):
+    images = write_images(12)
+    for identity, img in images.items():
+        assert bytes(imdb.read_img_v2(identity)) == img
+    assert read_all(images) == images
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert set(metadata) == set(images)
+    first = next(iter(images))
+    assert metadata[first]["seed"] == 0 and metadata[first]["width"] == 64
+
+def test_insert_only_appends(file_db):
+    write_images(20)
+    with open(file_db, "rb") as f:
+        before = f.read()
+    img = make_image(20)
+    imdb.write_v2(None, img, 20, "prompt", "negative", 64, 64, 20, 7.5)
+    with open(file_db, "rb") as f:
+        after = f.read()
+    # nothing stored before is rewritten, the record adds the blob and a small meta
+    assert after.startswith(before)
+    assert len(after) - len(before) < len(img) + 512
+
+###
+# Torn and corrupt log tails
+###
+def test_truncated_tail_is_ignored(file_db):
+    images = write_images(5)
+    record = imdb._encode_log_record(imdb.LOG_INSERT, {"identity": "0$torn"}, make_image(50))
+    with open(file_db, "ab") as f:
+        f.write(record[:len(record) // 2])
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(images)
+    assert read_all(images) == images
+    # the next append overwrites the torn record
+    images.update(write_images(1, start=5))
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(images)
+
+def test_corrupt_record_ends_the_log(file_db):
+    images = write_images(5)
+    size = os.path.getsize(file_db)
+    last = write_images(1, start=5)
+    with open(file_db, "r+b") as f:
+        # flip a byte of the last record's metadata so its checksum fails
+        f.seek(size + imdb.LOG_RECORD_HEADER.size + 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+    imdb._IDENTITY_INDEXES.pop(file_db, None)
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(images)
+    assert imdb.read_img_v2(next(iter(last))) is None
+    assert read_all(images) == images
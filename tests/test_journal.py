@@ -0,0 +1,104 @@
+import time
+import threading
+
+from imagineit_app import imdb
+
+from conftest import make_image, write_images, metadata_by_identity, read_all, load_file
+
+###
+# Updates
+###
+def test_updates(layout_db):
+    images = write_images(6)
+    identities = list(images)
+    imdb.write_v2(identities[0], labeled=True, label="relabeled")
+    imdb.write_v2(identities[1], make_image(100))
+    images[identities[1]] = make_image(100)
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert len(metadata) == 6
+    assert metadata[identities[0]]["label"] == "relabeled" and metadata[identities[0]]["labeled"]
+    assert metadata[identities[2]]["label"] == metadata[identities[2]]["prompt"]
+    assert read_all(images) == images
+
+def test_update_appends_a_small_record(file_db):
+    images = write_images(20)
+    with open(file_db, "rb") as f:
+        before = f.read()
+    imdb.write_v2(next(iter(images)), labeled=True, label="relabeled")
+    with open(file_db, "rb") as f:
+        after = f.read()
+    assert after.startswith(before)
+    assert len(after) - len(before) < 256
+
+###
+# Checkpoints
+###
+def test_fold_matches_unfolded_read(file_db):
+    images = write_images(40)
+    identities = list(images)
+    for identity in identities[:10]:
+        imdb.write_v2(identity, labeled=True, label="checked")
+    for identity in identities[10:15]:
+        imdb.del_img_v2(identity)
+        images.pop(identity)
+    imdb.write_v2(identities[20], make_image(200))
+    images[identities[20]] = make_image(200)
+    unfolded_mapper, unfolded = load_file(file_db)
+    assert imdb.checkpoint_v2()
+    folded_mapper, folded = load_file(file_db)
+    assert folded == unfolded
+    assert set(folded_mapper) == set(unfolded_mapper) == set(images)
+    with open(file_db, "rb") as f:
+        assert imdb._load_v2(f)[3] == 0
+    assert read_all(images) == images
+    assert set(imdb.select_tags_v2({"prompt": ["tag1"]})) == {identity for identity, row in folded.items() if "tag1" in row["prompt"]}
+
+def test_writes_after_fold(file_db):
+    images = write_images(8)
+    imdb.checkpoint_v2()
+    images.update(write_images(4, start=8))
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(images)
+    assert read_all(images) == images
+
+def test_writes_during_fold(file_db):
+    images = write_images(200)
+    written = {}
+    done = threading.Event()
+
+    def writer():
+        n = 1000
+        while not done.is_set():
+            written.update(write_images(1, start=n))
+            n += 1
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        for n, identity in enumerate(list(images)[:100]):
+            imdb.write_v2(identity, labeled=True, label="during")
+            if n % 20 == 0:
+                imdb.checkpoint_v2()
+        imdb.checkpoint_v2()
+    finally:
+        done.set()
+        thread.join()
+    images.update(written)
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(images)
+    assert sum(row["label"] == "during" for row in metadata.values()) == 100
+    assert read_all(images) == images
+
+def test_compactor_folds_a_long_log(file_db, monkeypatch):
+    monkeypatch.setattr(imdb, "LOG_CHECKPOINT_MIN_RECORDS", 16)
+    images = write_images(40)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        with open(file_db, "rb") as f:
+            if imdb._load_v2(f)[3] < 40:
+                break
+        time.sleep(0.05)
+    else:
+        raise AssertionError("the log was not folded")
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(images)
+    assert read_all(images) == images
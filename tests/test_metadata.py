@@ -0,0 +1,54 @@
+import zlib
+from io import BytesIO
+
+import pandas as pd
+
+from imagineit_app import imdb
+
+from conftest import write_images, metadata_by_identity
+
+def sample_metadata() -> pd.DataFrame:
+    return pd.DataFrame({
+        "seed": [1, -2, 3],
+        "prompt": ["a, b", "ünïcode", ""],
+        "width": [512, 768, 1024],
+        "guidance_scale": [7.5, 1.0, 12.25],
+        "labeled": [True, False, True],
+        "label": ["x", None, "z"],
+        "identity": ["1$a", "2$b", "3$c"],
+    })
+
+###
+# Columnar sections
+###
+def test_section_round_trip():
+    metadata_df = sample_metadata()
+    section = imdb._serialize_metadata_v2(metadata_df)
+    parsed, end = imdb._read_metadata_section_v2(BytesIO(section + b"log"), 0)
+    assert end == len(section)
+    pd.testing.assert_frame_equal(parsed, metadata_df, check_dtype=False)
+    assert parsed["seed"].dtype.kind == "i" and parsed["guidance_scale"].dtype.kind == "f" and parsed["labeled"].dtype.kind == "b"
+
+def test_section_loads_only_requested_columns():
+    section = imdb._serialize_metadata_v2(sample_metadata())
+    parsed, _ = imdb._read_metadata_section_v2(BytesIO(section), 0, columns=["identity", "labeled"])
+    assert list(parsed.columns) == ["labeled", "identity"]
+    assert parsed["labeled"].tolist() == [True, False, True]
+
+def test_csv_section_is_still_read():
+    metadata_df = sample_metadata()
+    section = zlib.compress(metadata_df.to_csv(index=False).encode("utf-8"))
+    parsed, end = imdb._read_metadata_section_v2(BytesIO(section + b"log"), 0)
+    assert end == len(section)
+    assert parsed["identity"].tolist() == metadata_df["identity"].tolist()
+    assert parsed["seed"].tolist() == metadata_df["seed"].tolist()
+
+def test_read_metadata_columns(layout_db):
+    images = write_images(10)
+    imdb.checkpoint_v2()
+    imdb.write_v2(next(iter(images)), labeled=True, label="late")
+    full = metadata_by_identity(imdb.read_metadata_v2())
+    partial = imdb.read_metadata_v2(["identity", "labeled"])
+    assert sorted(partial.columns) == ["identity", "labeled"]
+    assert dict(zip(partial["identity"], partial["labeled"])) == {identity: row["labeled"] for identity, row in full.items()}
+    assert list(imdb.read_metadata_v2(["labeled"]).columns) == ["labeled"]
@@ -0,0 +1,114 @@
+import os
+import json
+
+import pytest
+
+from imagineit_app import imdb, migrate
+
+from conftest import make_image, write_images, metadata_by_identity, create_imdb
+
+class Interrupted(Exception):
+    pass
+
+def interrupt_sink(monkeypatch, sink_class, after_batches: int, committed: bool):
+    """
+    Makes writes to sink_class fail once after_batches batches went in, either before the failing
+    batch is committed or right after it, before the migration could record its progress.
+    """
+    write = sink_class.write
+    calls = []
+
+    def failing_write(self, records):
+        calls.append(len(records))
+        if len(calls) > after_batches:
+            if committed:
+                write(self, records)
+            raise Interrupted()
+        write(self, records)
+    monkeypatch.setattr(sink_class, "write", failing_write)
+
+def read_destination(monkeypatch, dst: str):
+    monkeypatch.setattr(imdb, "IMDB_PATH", dst)
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    return metadata, {identity: bytes(img) for identity, img in imdb.read_imgs_v2(list(metadata))}
+
+@pytest.mark.parametrize("committed", [False, True])
+@pytest.mark.parametrize("dst_format", ["v2", "v3"])
+def test_migration_resumes_after_interruption(file_db, tmp_path, monkeypatch, dst_format, committed):
+    images = write_images(10)
+    source_metadata = metadata_by_identity(imdb.read_metadata_v2())
+    dst = str(tmp_path / ("dst.imdb" if dst_format == "v2" else "dst"))
+    sink_class = migrate.SINKS[dst_format]
+    with monkeypatch.context() as patched:
+        interrupt_sink(patched, sink_class, after_batches=2, committed=committed)
+        with pytest.raises(Interrupted):
+            migrate.migrate(file_db, dst, dst_format=dst_format, batch_size=3, report=lambda message: None)
+    with open(migrate._progress_path(dst)) as f:
+        assert json.load(f)["consumed"] == 6
+    messages = []
+    stats = migrate.migrate(file_db, dst, dst_format=dst_format, batch_size=3, report=messages.append)
+    # a batch committed before the crash is recognized by the image count of the destination
+    resumed = 9 if committed else 6
+    assert messages[0] == f"resuming after {resumed} items ({resumed} images written)"
+    assert stats["images"] == 10 - resumed
+    assert not os.path.exists(migrate._progress_path(dst))
+    metadata, migrated = read_destination(monkeypatch, dst)
+    assert len(imdb.read_metadata_v2()) == len(images)
+    assert migrated == images
+    assert {identity: {name: row[name] for name in imdb.IDENTITY_FIELDS} for identity, row in metadata.items()} == {identity: {name: row[name] for name in imdb.IDENTITY_FIELDS} for identity, row in source_metadata.items()}
+
+def test_migration_to_segmented(file_db, tmp_path, monkeypatch):
+    images = write_images(10)
+    dst = str(tmp_path / "segmented")
+    migrate.migrate(file_db, dst, segment_bytes=4096, batch_size=4, report=lambda message: None)
+    assert read_destination(monkeypatch, dst)[1] == images
+
+###
+# Sources
+###
+@pytest.fixture
+def v1_source(tmp_path, monkeypatch) -> dict:
+    """
+    A v1 imdb as {"path", "images" by seed}.
+    """
+    path = str(tmp_path / "v1.imdb")
+    open(path, "wb").close()
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    images = {n: make_image(n) for n in range(7)}
+    for n, img in images.items():
+        imdb.add_img(img, n, f"prompt {n}, tag", "negative", 64, 64, 20, 7.5)
+    return {"path": path, "images": images}
+
+def test_v1_migration_resumes(v1_source, tmp_path, monkeypatch):
+    dst = str(tmp_path / "dst.imdb")
+    assert migrate.detect_format(v1_source["path"]) == "v1"
+    with monkeypatch.context() as patched:
+        interrupt_sink(patched, migrate.V2Sink, after_batches=1, committed=False)
+        with pytest.raises(Interrupted):
+            migrate.migrate(v1_source["path"], dst, batch_size=3, workers=2, report=lambda message: None)
+    assert migrate.migrate(v1_source["path"], dst, batch_size=3, workers=2, report=lambda message: None)["images"] == 4
+    metadata, migrated = read_destination(monkeypatch, dst)
+    assert {row["seed"]: migrated[identity] for identity, row in metadata.items()} == v1_source["images"]
+    assert all(imdb.identity_version_v2(identity) == imdb.IDENTITY_BLAKE2B for identity in metadata)
+    assert metadata_by_identity(imdb.read_metadata_v2())[next(iter(metadata))]["prompt"].endswith(",tag")
+
+def source_of(layout: str, tmp_path, monkeypatch, v1_source: dict):
+    if layout == "v1":
+        return migrate.V1Source(v1_source["path"])
+    path = create_imdb(str(tmp_path), layout)
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    write_images(7)
+    return migrate.SOURCES["v3" if layout == "v3" else "v2"](path)
+
+@pytest.mark.parametrize("layout", ["v1", "file", "segmented", "v3"])
+def test_sources_start_without_reading_skipped_blobs(layout, tmp_path, monkeypatch, v1_source):
+    source = source_of(layout, tmp_path, monkeypatch, v1_source)
+    items = list(source.items())
+    assert len(items) == 7
+    reads = []
+    pread = os.pread
+    monkeypatch.setattr(os, "pread", lambda fd, size, offset: reads.append(offset) or pread(fd, size, offset))
+    assert list(source.items(5)) == items[5:]
+    # v1 reads through one file object, its items are sliced the same way
+    if layout != "v1":
+        assert len(reads) == 2
@@ -0,0 +1,63 @@
+import pytest
+
+from imagineit_app import imdb
+from imagineit_app.resources.image import parse_range, sniff_media_type
+
+from conftest import make_image, write_images, write_pngs
+
+@pytest.mark.parametrize("byte_range, expected", [
+    (None, None),
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-200", (0, 99)),
+    ("bytes=50-500", (50, 99)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-1", None),
+    ("bytes=a-b", None),
+    ("bytes=-", None),
+])
+def test_parse_range(byte_range, expected):
+    assert parse_range(byte_range, 100) == expected
+
+@pytest.mark.parametrize("byte_range", ["bytes=100-", "bytes=-0", "bytes=9-5"])
+def test_unsatisfiable_range(byte_range):
+    with pytest.raises(ValueError):
+        parse_range(byte_range, 100)
+
+def test_sniff_media_type():
+    assert sniff_media_type(b"\xff\xd8\xff\xe0" + bytes(8)) == "image/jpeg"
+    assert sniff_media_type(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert sniff_media_type(make_image(0)) == "application/octet-stream"
+
+def test_original_is_served_as_stored(client, monkeypatch):
+    identity, img = next(iter(write_pngs(1).items()))
+    other = next(iter(write_images(1, start=1)))
+    codecs = []
+    decode = imdb._decode_blob_v2
+    with monkeypatch.context() as patched:
+        patched.setattr(imdb, "_decode_blob_v2", lambda blob, codec: codecs.append(codec) or decode(blob, codec))
+        response = client.get(f"/api/v1/{identity}/image", params={"level": 0})
+    # PNGs are stored raw and never decompressed on the way out
+    assert codecs == [imdb.BLOB_RAW]
+    assert response.status_code == 200 and response.content == img
+    assert response.headers["Content-Type"] == "image/png" and response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Length"] == str(len(img))
+    response = client.get(f"/api/v1/images/{other}", params={"compression_level": 0})
+    assert response.content == make_image(1) and response.headers["Content-Type"] == "application/octet-stream"
+
+def test_ranges(client):
+    identity, img = next(iter(write_pngs(1).items()))
+    url = f"/api/v1/{identity}/image?level=0"
+    etag = client.get(url).headers["ETag"]
+    part = client.get(url, headers={"Range": "bytes=10-19"})
+    assert part.status_code == 206 and part.content == img[10:20]
+    assert part.headers["Content-Range"] == f"bytes 10-19/{len(img)}" and part.headers["Content-Length"] == "10"
+    assert client.get(url, headers={"Range": "bytes=-16"}).content == img[-16:]
+    assert client.get(url, headers={"Range": "bytes=0-1,4-5"}).content == img
+    # If-Range naming the served version keeps the range, any other gets everything
+    assert client.get(url, headers={"Range": "bytes=10-19", "If-Range": etag}).status_code == 206
+    stale = client.get(url, headers={"Range": "bytes=10-19", "If-Range": '"stale"'})
+    assert stale.status_code == 200 and stale.content == img
+    unsatisfiable = client.get(url, headers={"Range": f"bytes={len(img)}-"})
+    assert unsatisfiable.status_code == 416 and unsatisfiable.headers["Content-Range"] == f"bytes */{len(img)}"
@@ -0,0 +1,115 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from imagineit_app import imdb
+
+from conftest import make_image, write_images
+
+def append_from_another_writer(path: str, n: int) -> tuple:
+    """
+    Appends an insert record the way a writer in another process would, bypassing this
+    process's index. Returns (identity, image).
+    """
+    img = make_image(n)
+    meta, blob = imdb._new_record_v2(img, {"seed": n, "prompt": f"prompt {n}", "negative_prompt": "negative", "width": 64, "height": 64, "steps": 20, "guidance_scale": 7.5})
+    with open(path, "ab") as f:
+        f.write(imdb._encode_log_record(imdb.LOG_INSERT, meta, blob))
+    return meta["identity"], img
+
+###
+# Identity index
+###
+def test_index_is_loaded_once(file_db, monkeypatch):
+    images = write_images(10)
+    index = imdb._identity_index_v2(file_db)
+    monkeypatch.setattr(imdb, "_load_identity_index_v2", lambda *args: 1 / 0)
+    for identity, img in images.items():
+        assert bytes(imdb.read_img_v2(identity)) == img
+    assert imdb._identity_index_v2(file_db) is index
+
+def test_index_catches_up_with_other_writers(file_db, monkeypatch):
+    write_images(3)
+    imdb._identity_index_v2(file_db)
+    monkeypatch.setattr(imdb, "_load_identity_index_v2", lambda *args: 1 / 0)
+    # only the new records are read
+    identity, img = append_from_another_writer(file_db, 3)
+    assert bytes(imdb.read_img_v2(identity)) == img
+    assert imdb._identity_index_v2(file_db)["records"] == 4
+
+def test_index_reloads_a_replaced_file(file_db, tmp_path, monkeypatch):
+    old = write_images(3)
+    other = str(tmp_path / "other.imdb")
+    monkeypatch.setattr(imdb, "IMDB_PATH", other)
+    new = write_images(2, start=10)
+    os.replace(other, file_db)
+    monkeypatch.setattr(imdb, "IMDB_PATH", file_db)
+    assert all(imdb.read_img_v2(identity) is None for identity in old)
+    assert {identity: bytes(imdb.read_img_v2(identity)) for identity in new} == new
+
+###
+# Shared mapping
+###
+def raw_image(n: int) -> bytes:
+    # signed like a PNG so it is stored raw
+    return b"\x89PNG\r\n\x1a\n" + make_image(n)
+
+def test_raw_blobs_are_views_of_one_mapping(file_db):
+    identities = [imdb.write_v2(None, raw_image(n), n, "a", "b", 64, 64, 20, 7.5) for n in range(3)]
+    views = [imdb.read_img_v2(identity) for identity in identities]
+    assert all(isinstance(view, memoryview) for view in views)
+    assert len({id(view.obj) for view in views}) == 1
+    assert [bytes(view) for view in views] == [raw_image(n) for n in range(3)]
+
+def test_views_survive_appends(file_db):
+    identity = imdb.write_v2(None, raw_image(0), 0, "a", "b", 64, 64, 20, 7.5)
+    view = imdb.read_img_v2(identity)
+    last = imdb.write_v2(None, raw_image(1), 1, "a", "b", 64, 64, 20, 7.5)
+    # reading past the mapped length remaps the file, the old mapping stays alive for the view
+    assert imdb.read_img_v2(last).obj is not view.obj
+    assert bytes(view) == raw_image(0)
+    assert bytes(imdb.read_img_v2(identity)) == raw_image(0)
+
+def test_concurrent_readers(file_db):
+    images = write_images(40)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda identity: bytes(imdb.read_img_v2(identity)), list(images) * 5))
+    assert results == list(images.values()) * 5
+
+###
+# Batched reads
+###
+def test_read_imgs_in_file_order(file_db):
+    images = write_images(20)
+    identities = list(images)
+    asked = identities[::-1] + ["0$unknown"] + identities[:3]
+    results = list(imdb.read_imgs_v2(asked))
+    # unknown identities first, then each identity once in offset order
+    assert results[0] == ("0$unknown", None)
+    assert [identity for identity, _ in results[1:]] == identities
+    assert {identity: bytes(img) for identity, img in results[1:]} == images
+
+def test_read_imgs_is_lazy(file_db, monkeypatch):
+    images = write_images(5)
+    results = imdb.read_imgs_v2(list(images))
+    # nothing is resolved until the first image is asked for
+    monkeypatch.setattr(imdb, "_locate_v2", lambda identity: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        next(results)
+
+def test_read_imgs_on_every_layout(layout_db):
+    images = write_images(10)
+    deleted = next(iter(images))
+    imdb.del_img_v2(deleted)
+    images.pop(deleted)
+    results = {identity: None if img is None else bytes(img) for identity, img in imdb.read_imgs_v2([deleted, *images])}
+    assert results == {deleted: None, **images}
+
+def test_export(layout_db, tmp_path):
+    images = write_images(6)
+    chosen = list(images)[:4] + ["0$unknown"]
+    imdb.export_v2(str(tmp_path / "export"), chosen)
+    exported = {name[:-4]: (tmp_path / "export" / name).read_bytes() for name in os.listdir(tmp_path / "export") if name.endswith(".png")}
+    assert exported == {identity: images[identity] for identity in chosen[:4]}
+    assert len((tmp_path / "export" / "metadata.csv").read_text().splitlines()) == 5
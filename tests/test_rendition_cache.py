@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from imagineit_app import imdb
+from imagineit_app.thumbnails import RenditionCache, RENDITION_CACHE
+
+from conftest import make_png, write_pngs
+
+def rendition(size: int):
+    async def render():
+        return b"x" * size, "png", 0
+    return render
+
+def test_evicts_least_recently_used_bytes():
+    cache = RenditionCache(max_bytes=100)
+
+    async def fill():
+        for key in "ab":
+            await cache.get(key, rendition(40))
+        await cache.get("a", rendition(40))
+        # b is the least recently used
+        await cache.get("c", rendition(40))
+        # larger than the whole budget, served but not kept
+        assert await cache.get("d", rendition(101)) == (b"x" * 101, "png", 0)
+    asyncio.run(fill())
+    assert list(cache._entries) == ["a", "c"]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 4, 1)
+    assert stats["bytes"] == 80 and stats["entries"] == 2
+
+def test_concurrent_misses_render_once():
+    cache = RenditionCache()
+    renders = []
+
+    async def render():
+        renders.append(1)
+        await asyncio.sleep(0.05)
+        return b"content", "webp", 10
+
+    async def requests():
+        return await asyncio.gather(*(cache.get("key", render) for _ in range(8)))
+    assert asyncio.run(requests()) == [(b"content", "webp", 10)] * 8
+    assert len(renders) == 1
+    stats = cache.stats()
+    assert (stats["misses"], stats["coalesced"], stats["hit_ratio"]) == (1, 7, 7 / 8)
+
+def test_failures_and_none_are_not_cached():
+    cache = RenditionCache()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("cannot render")
+
+    async def none():
+        return None
+
+    async def requests():
+        results = await asyncio.gather(*(cache.get("key", fail) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert await cache.get("gone", none) is None
+        return await cache.get("key", rendition(4)), await cache.get("gone", rendition(4))
+    assert asyncio.run(requests()) == ((b"xxxx", "png", 0),) * 2
+    assert (cache.stats()["misses"], cache.stats()["coalesced"]) == (4, 2)
+
+def counted(stats: dict, before: dict) -> tuple:
+    return stats["hits"] - before["hits"], stats["misses"] - before["misses"], stats["entries"]
+
+@pytest.mark.parametrize("layout_db", ["file"], indirect=True)
+def test_responses_are_cached(client):
+    identity = next(iter(write_pngs(1)))
+    before = client.get("/api/v1/images/cache").json()
+    first = client.get(f"/api/v1/{identity}/image", params={"level": 1})
+    assert client.get(f"/api/v1/{identity}/image", params={"level": 1}).content == first.content
+    stats = client.get("/api/v1/images/cache").json()
+    assert counted(stats, before) == (1, 1, 1)
+    assert stats["bytes"] == len(first.content) and stats["max_bytes"] == RENDITION_CACHE.max_bytes
+    # a copy hits, a replaced image misses
+    copy = imdb.write_v2(None, make_png(0), 5, "copy", "negative", 64, 64, 20, 7.5)
+    client.get(f"/api/v1/{copy}/image", params={"level": 1})
+    imdb.write_v2(identity, make_png(9))
+    replaced = client.get(f"/api/v1/{identity}/image", params={"level": 1})
+    assert replaced.content != first.content
+    assert counted(client.get("/api/v1/images/cache").json(), before) == (2, 2, 2)
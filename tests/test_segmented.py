@@ -0,0 +1,99 @@
+import os
+import json
+import threading
+import multiprocessing
+
+from imagineit_app import imdb
+
+from conftest import make_image, write_images, metadata_by_identity, read_all
+
+def segmented_db(tmp_path, monkeypatch, segment_bytes: int=imdb.SEGMENT_BYTES) -> str:
+    path = str(tmp_path / "segmented")
+    imdb.create_segmented_v2(path, segment_bytes)
+    monkeypatch.setattr(imdb, "IMDB_PATH", path)
+    return path
+
+def manifest(path: str) -> dict:
+    with open(os.path.join(path, imdb.MANIFEST_NAME)) as f:
+        return json.load(f)
+
+def contents(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def write_in_process(path: str, start: int, count: int):
+    imdb.IMDB_PATH = path
+    write_images(count, start)
+
+###
+# Segments
+###
+def test_segments_are_sealed_and_left_alone(tmp_path, monkeypatch):
+    path = segmented_db(tmp_path, monkeypatch, segment_bytes=4096)
+    images = write_images(30)
+    segments = manifest(path)["segments"]
+    sealed = [segment["name"] for segment in segments if segment["sealed"]]
+    assert len(sealed) >= 2 and not segments[-1]["sealed"]
+    before = {name: contents(os.path.join(path, name)) for name in sealed}
+    images.update(write_images(5, start=30))
+    imdb.write_v2(next(iter(images)), labeled=True, label="relabeled")
+    imdb.del_img_v2(list(images)[1])
+    images.pop(list(images)[1])
+    assert {name: contents(os.path.join(path, name)) for name in sealed} == before
+    assert read_all(images) == images
+    assert set(metadata_by_identity(imdb.read_metadata_v2())) == set(images)
+
+def test_writer_threads_fill_their_own_segments(tmp_path, monkeypatch):
+    path = segmented_db(tmp_path, monkeypatch)
+    barrier = threading.Barrier(4)
+    images = {}
+
+    def writer(start):
+        images.update(write_images(1, start))
+        # every thread holds its claim here
+        barrier.wait()
+        images.update(write_images(9, start + 1))
+    threads = [threading.Thread(target=writer, args=(n * 10,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(manifest(path)["segments"]) == 4
+    assert read_all(images) == images
+    assert set(metadata_by_identity(imdb.read_metadata_v2())) == set(images)
+
+def test_writer_processes(tmp_path, monkeypatch):
+    path = segmented_db(tmp_path, monkeypatch)
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=write_in_process, args=(path, n * 10, 10)) for n in range(2)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert len(metadata) == 20 and len(manifest(path)["segments"]) == 2
+    assert all(bytes(imdb.read_img_v2(identity)) == make_image(row["seed"]) for identity, row in metadata.items())
+
+###
+# Journal
+###
+def test_journal_compaction(tmp_path, monkeypatch):
+    path = segmented_db(tmp_path, monkeypatch)
+    images = write_images(10)
+    identities = list(images)
+    for n in range(5):
+        imdb.write_v2(identities[0], labeled=True, label=f"label {n}")
+    imdb.write_v2(identities[1], make_image(100))
+    images[identities[1]] = make_image(100)
+    imdb.del_img_v2(identities[2])
+    images.pop(identities[2])
+    before = metadata_by_identity(imdb.read_metadata_v2())
+    imdb.checkpoint_v2()
+    journal = imdb._identity_index_v2(os.path.join(path, imdb.JOURNAL_NAME))
+    assert len(journal["journal"]["entries"]) == 3
+    with open(os.path.join(path, imdb.JOURNAL_NAME), "rb") as f:
+        assert imdb._load_v2(f)[3] == 3
+    assert metadata_by_identity(imdb.read_metadata_v2()) == before
+    assert before[identities[0]]["label"] == "label 4"
+    assert read_all(images) == images
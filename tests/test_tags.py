@@ -0,0 +1,42 @@
+from imagineit_app import imdb
+
+from conftest import write_images
+
+def tagged(include: dict=None, exclude: dict=None) -> set:
+    return set(imdb.select_tags_v2(include, exclude))
+
+def test_select_tags(layout_db):
+    identities = list(write_images(6))
+    assert tagged({"prompt": ["tag0"]}) == {identities[0], identities[3]}
+    assert tagged({"prompt": ["tag0", "tag1"]}) == set(identities) - {identities[2], identities[5]}
+    assert tagged({"prompt": ["tag0"]}, {"prompt": ["prompt 3"]}) == {identities[0]}
+    assert tagged(exclude={"negative_prompt": ["negative"]}) == set()
+    assert tagged({"prompt": [" tag2 ,"]}) == {identities[2], identities[5]}
+    assert tagged({"prompt": ["unknown"]}) == set()
+
+def test_tag_counts(layout_db):
+    write_images(5)
+    counts = imdb.tag_counts_v2("prompt")
+    assert {tag: counts[tag] for tag in ("tag0", "tag1", "tag2")} == {"tag0": 2, "tag1": 2, "tag2": 1}
+    assert imdb.tag_counts_v2("negative_prompt") == {"negative": 5}
+
+def test_index_follows_writes(layout_db):
+    identities = list(write_images(4))
+    imdb.del_img_v2(identities[0])
+    renamed = imdb.write_v2(identities[1], prompt="other, tag0")
+    # labels are not indexed
+    imdb.write_v2(identities[2], labeled=True, label="tag0")
+    assert tagged({"prompt": ["tag0"]}) == {identities[3], renamed}
+    assert tagged({"prompt": ["tag1"]}) == set()
+    assert imdb.tag_counts_v2()["tag0"] == 2
+    imdb.checkpoint_v2()
+    imdb._IDENTITY_INDEXES.clear()
+    assert tagged({"prompt": ["tag0"]}) == {identities[3], renamed}
+    assert imdb.tag_counts_v2()["other"] == 1
+
+def test_tag_endpoints(client):
+    identities = list(write_images(4))
+    assert set(client.get("/api/v1/tags").json()) == {"prompt 0", "prompt 1", "prompt 2", "prompt 3", "tag0", "tag1", "tag2"}
+    assert client.get("/api/v1/tags", params={"counts": True}).json()["tag0"] == 2
+    listed = client.get("/api/v1/imghashlist", params={"include_filter_prompt": "tag0,tag1", "exclude_filter_prompt": "prompt 1"}).json()
+    assert listed == [identities[0], identities[3]]
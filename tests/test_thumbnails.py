@@ -0,0 +1,53 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from imagineit_app import imdb, thumbnails
+
+from conftest import make_png, write_pngs
+
+def size_of(png: bytes) -> tuple:
+    return Image.open(BytesIO(png)).size
+
+def stored_levels(source: str) -> set:
+    mapper = imdb._identity_index_v2(thumbnails.thumbs_path(imdb.IMDB_PATH))["mapper"]
+    return {level for level in range(thumbnails.MAX_THUMBNAIL_LEVEL + 1) if thumbnails._thumb_key(source, level, thumbnails.DOWNSCALE_TIER) in mapper}
+
+def test_pyramid_is_stored_on_first_request(layout_db):
+    identity = next(iter(write_pngs(1)))
+    assert size_of(thumbnails.read_thumbnail(identity, 2)) == (16, 16)
+    source = thumbnails._source_key(identity, imdb.content_digest_v2(make_png(0)))
+    assert stored_levels(source) == set(thumbnails.THUMBNAIL_LEVELS)
+    # the renditions outlive the image and serve any copy of its content
+    imdb.del_img_v2(identity)
+    assert thumbnails.read_thumbnail(identity, 1) is None
+    copy = imdb.write_v2(None, make_png(0), 1, "copy", "negative", 64, 64, 20, 7.5)
+    assert size_of(thumbnails.read_thumbnail(copy, 1)) == (32, 32)
+    assert size_of(thumbnails.read_thumbnail(copy, 6)) == (1, 1)
+    assert stored_levels(source) == {*thumbnails.THUMBNAIL_LEVELS, 6}
+
+def test_build_thumbnails(layout_db):
+    images = write_pngs(3)
+    # a copy shares the renditions of its content
+    imdb.write_v2(None, make_png(0), 10, "copy", "negative", 64, 64, 20, 7.5)
+    reports = []
+    stats = thumbnails.build_thumbnails(workers=2, report=reports.append)
+    assert stats["images"] == 4 and stats["rendered"] == 3 * len(thumbnails.THUMBNAIL_LEVELS) and reports
+    assert thumbnails.build_thumbnails(workers=2, report=reports.append)["rendered"] == 0
+    for identity, img in images.items():
+        assert stored_levels(thumbnails._source_key(identity, imdb.content_digest_v2(img))) == set(thumbnails.THUMBNAIL_LEVELS)
+    imdb.del_img_v2(next(iter(images)))
+    assert thumbnails.build_thumbnails(workers=2, prune=True, report=reports.append)["pruned"] == 0
+    imdb.del_img_v2(list(images)[1])
+    assert thumbnails.build_thumbnails(workers=2, prune=True, report=reports.append)["pruned"] == len(thumbnails.THUMBNAIL_LEVELS)
+
+def test_levels_are_bounded(client):
+    identity = next(iter(write_pngs(1)))
+    for level in (-1, thumbnails.MAX_THUMBNAIL_LEVEL + 1, 1 << 16):
+        assert client.get(f"/api/v1/{identity}/image", params={"level": level}).status_code == 422
+        assert client.get(f"/api/v1/images/{identity}", params={"compression_level": level}).status_code == 422
+    response = client.get(f"/api/v1/{identity}/image", params={"level": 2})
+    assert response.status_code == 200 and size_of(response.content) == (16, 16)
+    with pytest.raises(AssertionError):
+        thumbnails._thumb_key("source", 1 << 16, "best")
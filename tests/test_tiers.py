@@ -0,0 +1,57 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from imagineit_app import imdb, thumbnails
+from imagineit_app.thumbnails import DOWNSCALE_TIERS, downscale, render_pyramid
+
+from conftest import write_pngs
+
+def gradient(size: tuple, mode: str="RGB") -> Image.Image:
+    x, y = np.meshgrid(np.linspace(0, 255, size[0]), np.linspace(0, 255, size[1]))
+    return Image.fromarray(np.stack([x, y, (x + y) / 2], axis=-1).astype(np.uint8), "RGB").convert(mode)
+
+def encoded(image: Image.Image, format: str="PNG") -> bytes:
+    buf = BytesIO()
+    image.save(buf, format=format)
+    return buf.getvalue()
+
+@pytest.mark.parametrize("tier", DOWNSCALE_TIERS)
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "LA", "P", "I", "F"])
+def test_sizes(tier, mode):
+    image = gradient((67, 45), mode)
+    scaled = downscale(image, (16, 11), tier)
+    assert scaled.size == (16, 11)
+    if mode == "P":
+        assert scaled.mode == "RGB"
+
+@pytest.mark.parametrize("tier", DOWNSCALE_TIERS)
+@pytest.mark.parametrize("format", ["PNG", "JPEG"])
+def test_tiers_agree(tier, format):
+    image = gradient((256, 192))
+    renditions = render_pyramid(encoded(image, format), (1, 3, 9), tier)
+    assert [renditions[level][:2] for level in (1, 3, 9)] == [(128, 96), (32, 24), (1, 1)]
+    best = render_pyramid(encoded(image, format), (3,), "best")[3][2]
+    difference = np.abs(np.asarray(Image.open(BytesIO(renditions[3][2])), dtype=float) - np.asarray(Image.open(BytesIO(best)), dtype=float))
+    assert difference.mean() < 4
+
+def test_block_average():
+    image = Image.fromarray(np.arange(16, dtype=np.uint8).reshape(4, 4) * 10, "L")
+    assert np.asarray(thumbnails._block_average(image, 2)).tolist() == [[25, 45], [105, 125]]
+
+def test_tiers_are_stored_apart(client):
+    identity = next(iter(write_pngs(1, size=(128, 128))))
+    etags = set()
+    for tier in DOWNSCALE_TIERS:
+        response = client.get(f"/api/v1/{identity}/image", params={"level": 2, "tier": tier})
+        assert response.status_code == 200 and Image.open(BytesIO(response.content)).size == (32, 32)
+        etags.add(response.headers["ETag"])
+    assert len(etags) == len(DOWNSCALE_TIERS)
+    mapper = imdb._identity_index_v2(thumbnails.thumbs_path(imdb.IMDB_PATH))["mapper"]
+    source = thumbnails.source_key(identity)
+    assert {thumbnails._thumb_key(source, 2, tier) for tier in DOWNSCALE_TIERS} <= set(mapper)
+    assert len({thumbnails._thumb_key(source, 2, tier) for tier in DOWNSCALE_TIERS}) == len(DOWNSCALE_TIERS)
+    unknown = client.get(f"/api/v1/images/{identity}", params={"compression_level": 2, "tier": "fastest"})
+    assert unknown.status_code == 400 and "balanced" in unknown.text
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from imagineit_app import thumbnails
+from imagineit_app.thumbnails import TransformPool, TransformPoolBusy
+
+from conftest import write_pngs
+
+@pytest.fixture
+def pool():
+    pool = TransformPool(workers=1, max_pending=2)
+    yield pool
+    pool.shutdown()
+
+def test_counts_outcomes(pool):
+    async def transforms():
+        assert await asyncio.gather(pool.run(pow, 2, 10), pool.run(pow, 3, 2)) == [1024, 9]
+        with pytest.raises(ValueError):
+            await pool.run(int, "not a number")
+        results = await asyncio.gather(*(pool.run(pow, 2, n) for n in range(3)), return_exceptions=True)
+        assert results[:2] == [1, 2] and isinstance(results[2], TransformPoolBusy)
+    asyncio.run(transforms())
+    stats = pool.stats()
+    assert (stats["completed"], stats["failed"], stats["rejected"], stats["pending"]) == (4, 1, 1, 0)
+    assert (stats["workers"], stats["max_pending"]) == (1, 2)
+
+@pytest.mark.parametrize("layout_db", ["file"], indirect=True)
+def test_busy_pool_answers_503(client, monkeypatch):
+    identity, other = write_pngs(2)
+    assert client.get(f"/api/v1/{identity}/image", params={"level": 1}).status_code == 200
+    before = client.get("/api/v1/images/transforms").json()
+    with monkeypatch.context() as patched:
+        patched.setattr(thumbnails.TRANSFORM_POOL, "max_pending", 0)
+        busy = client.get(f"/api/v1/{other}/image", params={"level": 1})
+        assert busy.status_code == 503 and busy.headers["Retry-After"] == "1"
+        assert client.get(f"/api/v1/images/{other}", params={"compression_level": 2}).status_code == 503
+        # cached renditions and originals need no transform
+        assert client.get(f"/api/v1/{identity}/image", params={"level": 1}).status_code == 200
+        assert client.get(f"/api/v1/{other}/image", params={"level": 0}).status_code == 200
+    stats = client.get("/api/v1/images/transforms").json()
+    assert stats["rejected"] - before["rejected"] == 2 and stats["completed"] == before["completed"]
+    assert client.get(f"/api/v1/{other}/image", params={"level": 1}).status_code == 200
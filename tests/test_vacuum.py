@@ -0,0 +1,95 @@
+import os
+import threading
+
+from imagineit_app import imdb
+
+from conftest import write_images, metadata_by_identity, read_all, load_file
+
+###
+# Tombstones
+###
+def test_delete(layout_db):
+    images = write_images(6)
+    identities = list(images)
+    assert imdb.del_img_v2(identities[2])
+    assert not imdb.del_img_v2(identities[2])
+    assert not imdb.del_img_v2("0$unknown")
+    images.pop(identities[2])
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert set(metadata) == set(images)
+    assert imdb.read_img_v2(identities[2]) is None
+    assert read_all(images) == images
+
+def test_delete_appends_a_tombstone(file_db):
+    images = write_images(20)
+    size = os.path.getsize(file_db)
+    imdb.del_img_v2(next(iter(images)))
+    assert 0 < os.path.getsize(file_db) - size < 256
+    stats = imdb.fragmentation_v2()
+    assert stats["tombstones"] == 1 and stats["live_images"] == 19
+    assert stats["dead_bytes"] > 0 and 0 < stats["fragmentation"] < 1
+
+###
+# Vacuum
+###
+def test_vacuum_preserves_data(layout_db):
+    images = write_images(30)
+    identities = list(images)
+    for identity in identities[::2]:
+        imdb.del_img_v2(identity)
+        images.pop(identity)
+    imdb.write_v2(identities[1], labeled=True, label="kept")
+    before = metadata_by_identity(imdb.read_metadata_v2())
+    result = imdb.vacuum_v2()
+    assert result["after"]["dead_bytes"] <= result["before"]["dead_bytes"]
+    assert metadata_by_identity(imdb.read_metadata_v2()) == before
+    assert read_all(images) == images
+    assert all(imdb.read_img_v2(identity) is None for identity in identities[::2])
+    images.update(write_images(3, start=30))
+    assert read_all(images) == images
+
+def test_vacuum_reclaims_space(file_db):
+    images = write_images(20)
+    for identity in list(images)[:15]:
+        imdb.del_img_v2(identity)
+    size = os.path.getsize(file_db)
+    imdb.vacuum_v2()
+    assert os.path.getsize(file_db) < size
+    assert imdb.fragmentation_v2()["fragmentation"] == 0.0
+
+def test_vacuum_in_small_chunks(file_db):
+    images = write_images(20)
+    for identity in list(images)[5:10]:
+        imdb.del_img_v2(identity)
+        images.pop(identity)
+    imdb.vacuum_v2(chunk_size=300)
+    assert read_all(images) == images
+
+def test_readers_and_writers_during_vacuum(file_db):
+    images = write_images(200)
+    identities = list(images)
+    for identity in identities[:100]:
+        imdb.del_img_v2(identity)
+        images.pop(identity)
+    view = imdb.read_img_v2(identities[150])
+    written = {}
+    done = threading.Event()
+
+    def writer():
+        n = 1000
+        while not done.is_set():
+            written.update(write_images(1, start=n))
+            n += 1
+    thread = threading.Thread(target=writer)
+    thread.start()
+    try:
+        imdb.vacuum_v2()
+    finally:
+        done.set()
+        thread.join()
+    # readers holding a view of the old file keep it
+    assert bytes(view) == images[identities[150]]
+    images.update(written)
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(images)
+    assert read_all(images) == images
@@ -0,0 +1,35 @@
+import pytest
+
+from imagineit_app import imdb
+
+from conftest import make_image, metadata_by_identity, read_all, load_file
+
+def params(n: int, **extra) -> dict:
+    return {"seed": n, "prompt": f"prompt {n}", "negative_prompt": "b", "width": 64, "height": 64, "steps": 20, "guidance_scale": 7.5, **extra}
+
+def test_write_many(layout_db):
+    identities = imdb.write_many((make_image(n), params(n, labeled=n % 2 == 0, label=f"label {n}")) for n in range(25))
+    metadata = metadata_by_identity(imdb.read_metadata_v2())
+    assert len(identities) == len(set(identities)) == len(metadata) == 25
+    # identities come back in input order
+    assert [metadata[identity]["seed"] for identity in identities] == list(range(25))
+    assert [metadata[identity]["label"] for identity in identities] == [f"label {n}" for n in range(25)]
+    assert [bool(metadata[identity]["labeled"]) for identity in identities] == [n % 2 == 0 for n in range(25)]
+    assert read_all(identities) == {identity: make_image(n) for n, identity in enumerate(identities)}
+
+def test_one_append_per_batch_and_one_checkpoint(file_db, monkeypatch):
+    appends = []
+    append = imdb._append_many_v2
+    monkeypatch.setattr(imdb, "WRITE_MANY_BATCH", 4)
+    monkeypatch.setattr(imdb, "_append_many_v2", lambda path, records: appends.append(len(records)) or append(path, records))
+    identities = imdb.write_many((make_image(n), params(n)) for n in range(10))
+    assert appends == [4, 4, 2]
+    mapper, metadata = load_file(file_db)
+    assert set(mapper) == set(metadata) == set(identities)
+    with open(file_db, "rb") as f:
+        assert imdb._load_v2(f)[3] == 0
+
+def test_missing_params(file_db):
+    with pytest.raises(ValueError):
+        imdb.write_many([(make_image(0), {"seed": 0})])
+    assert imdb.write_many([]) == []
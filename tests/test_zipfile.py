@@ -0,0 +1,45 @@
+import zipfile
+from io import BytesIO
+
+from imagineit_app import imdb
+from imagineit_app.app import ZipFilePayload, _stream_zip
+
+from conftest import write_pngs
+
+def payload(img_hashes: list, **values) -> dict:
+    return {"zip_file_name": "export", "is_train_data": False, "img_hashes": img_hashes, "return_file": True, **values}
+
+def test_streamed_archive(client):
+    images = write_pngs(3)
+    response = client.post("/api/v1/zipfile", json=payload([*images, "2$unknown"], zip_file_name="some/dir/export"))
+    assert response.status_code == 200 and response.headers["Content-Type"] == "application/zip"
+    assert response.headers["Content-Disposition"] == 'attachment; filename="export.zip"'
+    with zipfile.ZipFile(BytesIO(response.content)) as archive:
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist())
+        assert {name: archive.read(name) for name in archive.namelist()} == {f"images/{identity}.png": img for identity, img in images.items()}
+
+def test_train_data(client):
+    identities = list(write_pngs(3))
+    imdb.write_v2(identities[1], labeled=True, label="a label")
+    response = client.post("/api/v1/zipfile", json=payload(identities, is_train_data=True))
+    with zipfile.ZipFile(BytesIO(response.content)) as archive:
+        assert sorted(archive.namelist()) == [f"train_data/{identities[1]}.png", f"train_data/{identities[1]}.txt"]
+        assert archive.read(f"train_data/{identities[1]}.txt") == b"a label"
+
+def test_entries_are_streamed(file_db):
+    images = write_pngs(4)
+    chunks = _stream_zip(ZipFilePayload(**payload(list(images))))
+    # every entry is handed out once written
+    first = next(chunks)
+    assert first.startswith(b"PK\x03\x04")
+    rest = list(chunks)
+    assert len(rest) >= 4
+    with zipfile.ZipFile(BytesIO(b"".join([first, *rest]))) as archive:
+        assert len(archive.namelist()) == 4 and archive.testzip() is None
+
+def test_archive_on_the_server(client, tmp_path):
+    images = write_pngs(2)
+    name = str(tmp_path / "server")
+    assert client.post("/api/v1/zipfile", json=payload(list(images), zip_file_name=name, return_file=False)).json() == {"status": "success"}
+    with zipfile.ZipFile(name + ".zip") as archive:
+        assert {name: archive.read(name) for name in archive.namelist()} == {f"images/{identity}.png": img for identity, img in images.items()}